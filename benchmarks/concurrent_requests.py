@@ -0,0 +1,59 @@
+# Measures throughput of concurrent requests whose handlers wait for the database - synchronous session (how handlers worked before) against the async session
+# Usage (from the repository root, DATABASE_URL must point to Postgres): python benchmarks/concurrent_requests.py [requests] [query seconds]
+# Every request runs one query that takes the given time (pg_sleep), so the numbers show how many requests wait for the database at the same time
+
+# External imports
+from fastapi import FastAPI
+from sqlmodel import Session, text
+import httpx
+import asyncio
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# Internal imports
+from database import engine, async_engine, async_session
+
+app = FastAPI()
+
+# Blocks the event loop for the whole query - no other request is handled meanwhile
+@app.get("/sync")
+async def sync_query(delay: float):
+    with Session(engine) as session:
+        session.execute(text("SELECT pg_sleep(:delay)"), {"delay": delay})
+
+    return True
+
+@app.get("/async")
+async def async_query(delay: float):
+    async with async_session() as session:
+        await session.execute(text("SELECT pg_sleep(:delay)"), {"delay": delay})
+
+    return True
+
+async def measure(client: httpx.AsyncClient, path: str, requests: int, delay: float) -> float:
+    await client.get(path, params={"delay": 0}) # Opens a connection of the pool
+
+    started = time.perf_counter()
+    responses = await asyncio.gather(*[client.get(path, params={"delay": delay}) for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+
+    assert all(response.status_code == 200 for response in responses), "Some requests failed!"
+
+    return elapsed
+
+async def main(requests: int, delay: float):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        sync_elapsed = await measure(client=client, path="/sync", requests=requests, delay=delay)
+        async_elapsed = await measure(client=client, path="/async", requests=requests, delay=delay)
+
+    await async_engine.dispose()
+
+    print(f"{requests} concurrent requests, {delay * 1000:.0f} ms query each")
+    print(f"  sync session   {sync_elapsed:6.2f} s  {requests / sync_elapsed:8.1f} requests/s")
+    print(f"  async session  {async_elapsed:6.2f} s  {requests / async_elapsed:8.1f} requests/s  speedup {sync_elapsed / async_elapsed:5.2f}x")
+
+if __name__ == "__main__":
+    asyncio.run(main(requests=int(sys.argv[1]) if len(sys.argv) > 1 else 100, delay=float(sys.argv[2]) if len(sys.argv) > 2 else 0.05))
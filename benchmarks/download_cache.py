@@ -0,0 +1,133 @@
+# Measures 'GET /files/{id}/download' under concurrent load - file location looked up in the database for every request against FileLocationCache
+# Usage (from the repository root, DATABASE_URL must point to Postgres and SAVE_DIR must be writable): python benchmarks/download_cache.py [requests] [concurrency] [files]
+# Popularity of the files is skewed (Zipf-like, as real downloads are), requests are full downloads of a 4 KiB file and revalidations (If-None-Match, 304)
+# Rows and files created by the benchmark are removed at the end
+
+# External imports
+from fastapi import FastAPI
+from sqlmodel import delete
+from sqlalchemy import event
+import statistics
+import random
+import httpx
+import asyncio
+import shutil
+import time
+import uuid
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# Internal imports
+from database import initialize_database, async_engine, async_session
+from files.models import Files
+from files.routes import files_router
+from files.utils import file_location_cache, get_file_etag, get_upload_file_path
+from uploads.models import Uploads
+from users.models import Users
+from config import SAVE_DIR, FILE_LOCATION_CACHE_SIZE
+
+FILE_SIZE = 4 * 1024
+
+app = FastAPI()
+app.include_router(files_router)
+
+async def create_files(files_count: int) -> tuple[Users, Uploads, list[Files]]:
+    name = f"benchmark_{uuid.uuid4().hex}"
+
+    async with async_session() as session:
+        user = Users(username=name, password=None)
+        session.add(user)
+        await session.flush()
+
+        upload = Uploads(title=name, type="application/octet-stream", metadata_json=None, created_by=user.id)
+        session.add(upload)
+        await session.flush()
+
+        # Total count listeners are not set up here, so the counters are not changed by the rows of the benchmark
+        files = [Files(upload_id=upload.id, original_filename=f"file {index}", generated_filename=str(index), file_size=FILE_SIZE, file_mime="application/octet-stream", file_ext="bin", content_hash=uuid.uuid4().hex * 2, created_by=user.id) for index in range(files_count)]
+        session.add_all(files)
+        await session.commit()
+
+        for file in files:
+            await session.refresh(file)
+
+    content = os.urandom(FILE_SIZE)
+
+    for file in files:
+        file_path = get_upload_file_path(upload_id=file.upload_id, generated_filename=file.generated_filename, file_ext=file.file_ext)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with open(file_path, "wb") as out_file:
+            out_file.write(content)
+
+    return user, upload, files
+
+async def remove_files(user: Users, upload: Uploads):
+    async with async_session() as session:
+        await session.execute(delete(Files).where(Files.upload_id == upload.id))
+        await session.execute(delete(Uploads).where(Uploads.id == upload.id))
+        await session.execute(delete(Users).where(Users.id == user.id))
+        await session.commit()
+
+    shutil.rmtree(os.path.join(SAVE_DIR, "uploads", str(upload.id)), ignore_errors=True)
+
+# Same sequence of requests for both runs, every second request revalidates the file
+def get_requests(files: list[Files], requests: int) -> list[tuple[int, dict]]:
+    randomizer = random.Random(0)
+    weights = [1 / rank for rank in range(1, len(files) + 1)]
+    chosen_files = randomizer.choices(files, weights=weights, k=requests)
+
+    return [(file.id, {"If-None-Match": get_file_etag(file=file)} if index % 2 else {}) for index, file in enumerate(chosen_files)]
+
+async def measure(client: httpx.AsyncClient, requests: list[tuple[int, dict]], concurrency: int) -> tuple[float, list[float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def download(file_id: int, headers: dict):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.get(f"/files/{file_id}/download", headers=headers)
+            latencies.append(time.perf_counter() - started)
+
+            assert response.status_code == (304 if headers else 200), response.text
+
+    started = time.perf_counter()
+    await asyncio.gather(*[download(file_id=file_id, headers=headers) for file_id, headers in requests])
+
+    return time.perf_counter() - started, latencies
+
+async def main(requests_count: int, concurrency: int, files_count: int):
+    initialize_database()
+    user, upload, files = await create_files(files_count=files_count)
+    requests = get_requests(files=files, requests=requests_count)
+    queries = []
+
+    def count_query(*args):
+        queries.append(1)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_query)
+
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+            await client.get(f"/files/{files[0].id}/download") # Opens a connection of the pool
+
+            print(f"{requests_count} requests, {concurrency} concurrent, {files_count} files (half of the requests are revalidations)")
+
+            for name, max_size in [("no cache", 0), ("cache", FILE_LOCATION_CACHE_SIZE or files_count)]:
+                file_location_cache.max_size = max_size
+                file_location_cache.clear()
+                queries.clear()
+
+                elapsed, latencies = await measure(client=client, requests=requests, concurrency=concurrency)
+                latencies.sort()
+
+                print(f"  {name:<9} {requests_count / elapsed:8.1f} requests/s  p50 {statistics.median(latencies) * 1000:7.2f} ms  p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.2f} ms  {len(queries):6} queries")
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", count_query)
+        await remove_files(user=user, upload=upload)
+        await async_engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main(requests_count=int(sys.argv[1]) if len(sys.argv) > 1 else 5000, concurrency=int(sys.argv[2]) if len(sys.argv) > 2 else 50, files_count=int(sys.argv[3]) if len(sys.argv) > 3 else 1000))
@@ -0,0 +1,86 @@
+# Measures latency of listing pages at growing depth - offset pagination against keyset pagination (cursor from 'X-Next-Cursor')
+# Usage (from the repository root, DATABASE_URL must point to Postgres): python benchmarks/keyset_pagination.py [rows] [page size]
+# Rows are tags of a user created by the benchmark (ordered by the indexed 'id' and 'name' columns), they are removed at the end
+
+# External imports
+from sqlmodel import delete, text
+import statistics
+import asyncio
+import time
+import uuid
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# Internal imports
+from database import initialize_database, async_engine, async_session
+from tags.models import Tags
+from users.models import Users
+from utils import build_sqlmodel_get_all_query, encode_cursor
+
+REPEATS = 7
+DEPTHS = [0, 0.01, 0.1, 0.5, 0.99] # Position of the page in the listing
+
+async def create_tags(rows: int) -> Users:
+    name = f"benchmark_{uuid.uuid4().hex}"
+
+    async with async_session() as session:
+        user = Users(username=name, password=None)
+        session.add(user)
+        await session.flush()
+
+        # Total count listeners are not set up here, so the counters are not changed by the rows of the benchmark
+        await session.execute(text("INSERT INTO tags (name, created_by, created_at, updated_at) SELECT :prefix || lpad(n::text, 9, '0'), :user_id, n, n FROM generate_series(1, :rows) AS n"), {"prefix": f"{name}_", "user_id": user.id, "rows": rows})
+        await session.execute(text("ANALYZE tags"))
+        await session.commit()
+
+    return user
+
+async def remove_tags(user: Users):
+    async with async_session() as session:
+        await session.execute(delete(Tags).where(Tags.created_by == user.id))
+        await session.execute(delete(Users).where(Users.id == user.id))
+        await session.commit()
+
+# Median milliseconds of the page query
+async def measure(statement) -> float:
+    elapsed = []
+
+    async with async_session() as session:
+        for _ in range(REPEATS):
+            started = time.perf_counter()
+            results = await session.exec(statement)
+            results.all()
+            elapsed.append(time.perf_counter() - started)
+
+    return statistics.median(elapsed) * 1000
+
+async def main(rows: int, limit: int):
+    initialize_database()
+    user = await create_tags(rows=rows)
+
+    try:
+        print(f"{rows} rows, {limit} per page, median of {REPEATS} runs")
+
+        for order_by in ["id", "name"]:
+            for depth in DEPTHS:
+                offset = int((rows - limit) * depth)
+
+                # Cursor the previous page would have returned (its last row)
+                async with async_session() as session:
+                    statement = build_sqlmodel_get_all_query(model=Tags, offset=offset - 1, limit=1, created_by=user.id, order_by=order_by) if offset else None
+                    last_tag = (await session.exec(statement)).first() if statement is not None else None
+
+                cursor = encode_cursor(value=getattr(last_tag, order_by), id=last_tag.id, order_by=order_by) if last_tag is not None else None
+
+                offset_elapsed = await measure(build_sqlmodel_get_all_query(model=Tags, offset=offset, limit=limit, created_by=user.id, order_by=order_by))
+                cursor_elapsed = await measure(build_sqlmodel_get_all_query(model=Tags, limit=limit, cursor=cursor, created_by=user.id, order_by=order_by))
+
+                print(f"  order_by {order_by:<5} row {offset:>9}  offset {offset_elapsed:8.2f} ms  cursor {cursor_elapsed:8.2f} ms")
+    finally:
+        await remove_tags(user=user)
+        await async_engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main(rows=int(sys.argv[1]) if len(sys.argv) > 1 else 500_000, limit=int(sys.argv[2]) if len(sys.argv) > 2 else 50))
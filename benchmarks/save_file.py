@@ -0,0 +1,77 @@
+# Measures how fast an uploaded file that already rolled over to disk is saved - the old per-chunk aiofiles loop against stream_save_file
+# Usage (from the repository root): python benchmarks/save_file.py [size in MiB ...], default sizes are 100, 500, 1000 and 2000 MiB
+# SAVE_DIR is where the files are written, use the filesystem of the real SAVE_DIR to get numbers that mean something
+
+# External imports
+from fastapi import UploadFile
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from starlette.formparsers import MultiPartParser
+import aiofiles
+import asyncio
+import hashlib
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# Internal imports
+from config import FILE_READ_CHUNK
+from files.utils import stream_save_file
+
+# Saving as it was done before - chunk by chunk, every read and write is a separate await (hash is computed in the same pass, as the new path does)
+async def old_stream_save_file(file: UploadFile, target: str) -> tuple[int, str]:
+    file_size = 0
+    file_hash = hashlib.sha256()
+
+    await file.seek(0)
+
+    async with aiofiles.open(target, "wb") as out_file:
+        while content := await file.read(FILE_READ_CHUNK):
+            file_size += len(content)
+            file_hash.update(content)
+            await out_file.write(content)
+
+    return file_size, file_hash.hexdigest()
+
+# Spooled file like the one Starlette gives to request handlers, filled past the spool size so it is on disk
+def create_upload_file(size: int, directory: str) -> UploadFile:
+    spooled_file = SpooledTemporaryFile(max_size=MultiPartParser.spool_max_size, dir=directory)
+    block = os.urandom(FILE_READ_CHUNK)
+    written = 0
+
+    while written < size:
+        written += spooled_file.write(block[:size - written])
+
+    spooled_file.seek(0)
+
+    return UploadFile(file=spooled_file, size=size, filename="benchmark.bin")
+
+async def measure(function, file: UploadFile, target: str) -> tuple[float, str]:
+    started = time.perf_counter()
+    file_hash = (await function(file, target))[1]
+    elapsed = time.perf_counter() - started
+
+    os.remove(target)
+
+    return elapsed, file_hash
+
+async def main(sizes: list[int]):
+    save_dir = os.getenv("SAVE_DIR") or None
+
+    with TemporaryDirectory(dir=save_dir) as directory:
+        for size in sizes:
+            file = create_upload_file(size=size * 1024 * 1024, directory=directory)
+            target = os.path.join(directory, "saved.bin")
+
+            old_elapsed, old_hash = await measure(old_stream_save_file, file, target)
+            new_elapsed, new_hash = await measure(lambda file, target: stream_save_file(file=file, target=target, max_file_size=None), file, target)
+
+            assert old_hash == new_hash, "Saved files differ!"
+
+            print(f"{size:>6} MiB  old {size / old_elapsed:8.1f} MiB/s  new {size / new_elapsed:8.1f} MiB/s  speedup {old_elapsed / new_elapsed:5.2f}x")
+
+            await file.close()
+
+if __name__ == "__main__":
+    asyncio.run(main([int(size) for size in sys.argv[1:]] or [100, 500, 1000, 2000]))
@@ -0,0 +1,65 @@
+# Measures thumbnail throughput of large images - the old path (whole image decoded and copied, one LANCZOS resize) against create_thumbnail
+# (JPEG decoded at reduced resolution with draft, integer reduce before the LANCZOS resample with reducing_gap)
+# Usage (from the repository root): python benchmarks/thumbnail.py [side in pixels ...], default sides are 2000, 4000 and 8000 (square JPEG and PNG images)
+
+# External imports
+from tempfile import TemporaryDirectory
+from PIL import Image
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# Internal imports
+from config import TARGET_THUMBNAIL_HEIGHT
+from uploads.utils import create_thumbnail
+
+MIN_DURATION = 2 # Seconds each path is repeated for
+
+# Thumbnail as it was created before - full decode into a copy, resize straight from the full size
+def old_create_thumbnail(file_mime: str, source: str, thumbnail_location: str):
+    with Image.open(source) as img:
+        thumbnail = img.copy()
+
+    width, height = thumbnail.size
+
+    if height > TARGET_THUMBNAIL_HEIGHT:
+        target_width = int(TARGET_THUMBNAIL_HEIGHT * width / height)
+        thumbnail = thumbnail.resize((target_width, TARGET_THUMBNAIL_HEIGHT), Image.Resampling.LANCZOS)
+
+    thumbnail.convert("RGB").save(thumbnail_location, "JPEG")
+
+# Gradients compress like photos do (noise would make the files unrealistically large)
+def save_image(path: str, side: int, image_format: str):
+    gradient = Image.linear_gradient("L").resize((side, side))
+    image = Image.merge("RGB", [gradient, gradient.transpose(Image.Transpose.ROTATE_90), Image.radial_gradient("L").resize((side, side))])
+    image.save(path, image_format, quality=90)
+
+# Thumbnails per second, repeated for at least MIN_DURATION seconds
+def measure(function, file_mime: str, source: str, thumbnail_location: str) -> float:
+    function(file_mime=file_mime, source=source, thumbnail_location=thumbnail_location) # Not measured, file gets into the page cache
+    count = 0
+    started = time.perf_counter()
+
+    while (elapsed := time.perf_counter() - started) < MIN_DURATION:
+        function(file_mime=file_mime, source=source, thumbnail_location=thumbnail_location)
+        count += 1
+
+    return count / elapsed
+
+def main(sides: list[int]):
+    with TemporaryDirectory() as directory:
+        for image_format, file_mime in [("JPEG", "image/jpeg"), ("PNG", "image/png")]:
+            for side in sides:
+                source = os.path.join(directory, f"{side}.{image_format.lower()}")
+                thumbnail_location = os.path.join(directory, "thumbnail.jpg")
+                save_image(path=source, side=side, image_format=image_format)
+
+                old_rate = measure(old_create_thumbnail, file_mime, source, thumbnail_location)
+                new_rate = measure(create_thumbnail, file_mime, source, thumbnail_location)
+
+                print(f"{image_format:>4} {side:>5}x{side:<5}  old {old_rate:7.2f} thumbnails/s  new {new_rate:7.2f} thumbnails/s  speedup {new_rate / old_rate:5.2f}x")
+
+if __name__ == "__main__":
+    main(sides=[int(side) for side in sys.argv[1:]] or [2000, 4000, 8000])
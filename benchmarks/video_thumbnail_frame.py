@@ -0,0 +1,60 @@
+# Measures how fast the thumbnail frame of a video is extracted - moviepy (decodes every frame up to 1/10th of the video) against ffmpeg keyframe seeking
+# Usage (from the repository root, ffmpeg and ffprobe must be installed, see FFMPEG_PATH and FFPROBE_PATH): python benchmarks/video_thumbnail_frame.py [duration in seconds ...]
+# Default durations are 10, 60 and 300 seconds, test videos are 720p H.264 with a keyframe every 10 seconds (encoded once, before measuring)
+
+# External imports
+from tempfile import TemporaryDirectory
+import subprocess
+import statistics
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# Internal imports
+from config import FFMPEG_PATH, FFPROBE_PATH
+from uploads.utils import extract_video_thumbnail_frame
+
+REPEATS = 5
+
+# Thumbnail frame as it was extracted before - moviepy decodes from the start of the video up to the requested time
+def old_extract_video_thumbnail_frame(file_path: str):
+    from moviepy import VideoFileClip
+
+    with VideoFileClip(file_path) as video:
+        return video.get_frame(video.duration / 10)
+
+def create_video(path: str, duration: int):
+    command = [FFMPEG_PATH, "-v", "error", "-y", "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={duration}", "-c:v", "libx264", "-preset", "ultrafast", "-g", "300", "-pix_fmt", "yuv420p", path]
+    subprocess.run(command, check=True)
+
+# Median of the repeated runs, the first run is not measured (page cache and imports)
+def measure(function, file_path: str) -> float:
+    function(file_path)
+    elapsed = []
+
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        function(file_path)
+        elapsed.append(time.perf_counter() - started)
+
+    return statistics.median(elapsed)
+
+def main(durations: list[int]):
+    if shutil.which(FFMPEG_PATH) is None or shutil.which(FFPROBE_PATH) is None:
+        sys.exit(f"'{FFMPEG_PATH}' and '{FFPROBE_PATH}' are needed, without them extract_video_thumbnail_frame falls back to moviepy")
+
+    with TemporaryDirectory() as directory:
+        for duration in durations:
+            file_path = os.path.join(directory, f"{duration}.mp4")
+            create_video(path=file_path, duration=duration)
+
+            old_elapsed = measure(old_extract_video_thumbnail_frame, file_path)
+            new_elapsed = measure(extract_video_thumbnail_frame, file_path)
+
+            print(f"{duration:>6} s video  moviepy {old_elapsed * 1000:8.1f} ms  ffmpeg {new_elapsed * 1000:8.1f} ms  speedup {old_elapsed / new_elapsed:6.2f}x")
+
+if __name__ == "__main__":
+    main(durations=[int(duration) for duration in sys.argv[1:]] or [10, 60, 300])
@@ -1,5 +1,6 @@
 # External imports
 from fastapi import FastAPI
+import asyncio
 import uvicorn
 
 # Internal imports
@@ -10,8 +11,10 @@ from files.routes import files_router
 from scatter_collections.routes import collections_router
 from tags.routes import tags_router
 
-from database import initialize_database, setup_database_defaults
-from config import PORT
+from database import initialize_database, setup_database_defaults, setup_tag_upload_counts, setup_total_counts, async_engine
+from jobs.utils import start_job_workers, stop_job_workers
+from files.utils import run_upload_session_cleanup
+from config import PORT, ENABLE_JOB_WORKERS
 
 app = FastAPI(
     title="FastAPI",
@@ -32,9 +35,28 @@ async def root():
     return {"message": "Welcome to the API, for documentation open '/docs' or '/redoc'"}
 
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     initialize_database()
+    setup_total_counts() # Before defaults, inserted defaults are then counted by the listeners
     setup_database_defaults()
+    setup_tag_upload_counts()
+
+    # Removes abandoned resumable upload sessions
+    app.state.upload_session_cleanup_task = asyncio.create_task(run_upload_session_cleanup())
+
+    # Background workers (thumbnail generation)
+    if ENABLE_JOB_WORKERS:
+        app.state.job_executor, app.state.job_tasks = await start_job_workers()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.upload_session_cleanup_task.cancel()
+    await asyncio.gather(app.state.upload_session_cleanup_task, return_exceptions=True)
+
+    if ENABLE_JOB_WORKERS:
+        await stop_job_workers(executor=app.state.job_executor, tasks=app.state.job_tasks)
+
+    await async_engine.dispose()
 
 # Entry point for running with `python main.py`
 if __name__ == "__main__":
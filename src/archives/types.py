@@ -0,0 +1,7 @@
+# External imports
+from enum import Enum
+
+class ArchiveFormats(Enum):
+    ZIP = "zip" # Stored (uncompressed), supports ranges
+    TAR = "tar" # Supports ranges
+    TAR_GZ = "tar.gz" # Compressed, size is not known in advance so ranges are not supported
@@ -0,0 +1,298 @@
+# External imports
+from fastapi import Request, Response, status
+from fastapi.responses import StreamingResponse
+from email.utils import formatdate
+from urllib.parse import quote
+from typing import AsyncIterator
+import aiofiles
+import asyncio
+import tarfile
+import struct
+import time
+import zlib
+import os
+
+# Internal imports
+from archives.types import ArchiveFormats
+from files.models import Files
+from files.utils import get_upload_file_path, make_etag, is_not_modified, is_range_valid, parse_range_header
+from uploads.models import Uploads
+from config import SAVE_DIR, FILE_SERVE_CHUNK
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FLAGS = 0x0808 # Data descriptor after file data (CRC is computed while streaming) and UTF-8 names
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+# Removes path separators and leading dots so a name can not escape its folder in the archive
+def get_archive_name(name: str) -> str:
+    name = name.replace("/", "_").replace("\\", "_").strip().lstrip(".")
+
+    return name or "_"
+
+# Entries of one upload (files by their original names and metadata.json), prefix is used to put uploads of a collection into folders
+def get_upload_archive_entries(upload: Uploads, files: list[Files], prefix: str = "") -> list[dict]:
+    entries = []
+    used_names = set()
+
+    for file in files:
+        path = get_upload_file_path(upload_id=file.upload_id, generated_filename=file.generated_filename, file_ext=file.file_ext)
+        name = get_archive_name(f"{file.original_filename}.{file.file_ext}")
+
+        # Same original name can be used more than once in an upload
+        base_name, ext = os.path.splitext(name)
+        counter = 1
+        while name in used_names:
+            name = f"{base_name} ({counter}){ext}"
+            counter += 1
+
+        used_names.add(name)
+        entries.append({"name": prefix + name, "path": path, "size": file.file_size, "mtime": int(file.created_at), "crc": file.crc32})
+
+    metadata_path = os.path.join(SAVE_DIR, "uploads", str(upload.id), "metadata.json")
+
+    if os.path.exists(metadata_path):
+        entries.append({"name": prefix + "metadata.json", "path": metadata_path, "size": os.path.getsize(metadata_path), "mtime": int(upload.created_at)})
+
+    return entries
+
+def get_dos_datetime(mtime: int) -> tuple[int, int]:
+    local_time = time.localtime(mtime)
+
+    if local_time.tm_year < 1980: # Earliest date ZIP can store
+        return 0, (1 << 5) | 1
+
+    dos_time = (local_time.tm_hour << 11) | (local_time.tm_min << 5) | (local_time.tm_sec // 2)
+    dos_date = ((local_time.tm_year - 1980) << 9) | (local_time.tm_mon << 5) | local_time.tm_mday
+
+    return dos_time, dos_date
+
+# Layout of a stored ZIP as segments: ("bytes", data), ("file", entry) or ("crc", length, paths, build) for parts that depend on CRCs of the files
+# Sizes are known in advance so every offset (and Content-Length) is known before anything is read
+def get_zip_segments(entries: list[dict]) -> list[tuple]:
+    segments = []
+    central_directory_length = 0
+    offset = 0
+
+    for entry in entries:
+        name = entry["name"].encode("utf-8")
+        dos_time, dos_date = get_dos_datetime(entry["mtime"])
+        entry["zip64"] = entry["size"] >= ZIP64_LIMIT
+        entry["offset"] = offset
+
+        if entry["zip64"]:
+            extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+            local_header = struct.pack("<IHHHHHIIIHH", 0x04034B50, 45, ZIP_FLAGS, 0, dos_time, dos_date, 0, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra)) + name + extra
+            descriptor_length = 24
+        else:
+            local_header = struct.pack("<IHHHHHIIIHH", 0x04034B50, 20, ZIP_FLAGS, 0, dos_time, dos_date, 0, 0, 0, len(name), 0) + name
+            descriptor_length = 16
+
+        segments.append(("bytes", local_header))
+        segments.append(("file", entry))
+        segments.append(("crc", descriptor_length, [entry["path"]], lambda crcs, entry=entry: build_zip_data_descriptor(entry=entry, crc=crcs[entry["path"]])))
+
+        offset += len(local_header) + entry["size"] + descriptor_length
+        central_directory_length += len(build_zip_central_directory_header(entry=entry, crc=0))
+
+    central_directory_offset = offset
+    segments.append(("crc", central_directory_length, [entry["path"] for entry in entries], lambda crcs: b"".join(build_zip_central_directory_header(entry=entry, crc=crcs[entry["path"]]) for entry in entries)))
+    segments.append(("bytes", build_zip_end_records(entries_count=len(entries), central_directory_offset=central_directory_offset, central_directory_length=central_directory_length)))
+
+    return segments
+
+def build_zip_data_descriptor(entry: dict, crc: int) -> bytes:
+    if entry["zip64"]:
+        return struct.pack("<IIQQ", 0x08074B50, crc, entry["size"], entry["size"])
+
+    return struct.pack("<IIII", 0x08074B50, crc, entry["size"], entry["size"])
+
+def build_zip_central_directory_header(entry: dict, crc: int) -> bytes:
+    name = entry["name"].encode("utf-8")
+    dos_time, dos_date = get_dos_datetime(entry["mtime"])
+    size = entry["size"]
+    offset = entry["offset"]
+
+    # Values too large for 4 bytes are moved to the ZIP64 extra field (in this order)
+    zip64_values = []
+
+    if size >= ZIP64_LIMIT:
+        zip64_values += [size, size]
+        size = ZIP64_LIMIT
+
+    if offset >= ZIP64_LIMIT:
+        zip64_values.append(offset)
+        offset = ZIP64_LIMIT
+
+    extra = struct.pack(f"<HH{len(zip64_values)}Q", 0x0001, 8 * len(zip64_values), *zip64_values) if zip64_values else b""
+    version = 45 if zip64_values or entry["zip64"] else 20
+
+    return struct.pack("<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | version, version, ZIP_FLAGS, 0, dos_time, dos_date, crc, size, size, len(name), len(extra), 0, 0, 0, 0o100644 << 16, offset) + name + extra
+
+def build_zip_end_records(entries_count: int, central_directory_offset: int, central_directory_length: int) -> bytes:
+    records = b""
+
+    if entries_count >= 0xFFFF or central_directory_offset >= ZIP64_LIMIT or central_directory_length >= ZIP64_LIMIT:
+        zip64_end_offset = central_directory_offset + central_directory_length
+        records += struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, entries_count, entries_count, central_directory_length, central_directory_offset)
+        records += struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1)
+
+        entries_count = min(entries_count, 0xFFFF)
+        central_directory_offset = min(central_directory_offset, ZIP64_LIMIT)
+        central_directory_length = min(central_directory_length, ZIP64_LIMIT)
+
+    return records + struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, entries_count, entries_count, central_directory_length, central_directory_offset, 0)
+
+# Layout of a TAR (PAX headers for long/UTF-8 names), nothing depends on file content
+def get_tar_segments(entries: list[dict]) -> list[tuple]:
+    segments = []
+
+    for entry in entries:
+        tar_info = tarfile.TarInfo(name=entry["name"])
+        tar_info.size = entry["size"]
+        tar_info.mtime = entry["mtime"]
+        tar_info.mode = 0o644
+
+        segments.append(("bytes", tar_info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8")))
+        segments.append(("file", entry))
+
+        if entry["size"] % TAR_BLOCK_SIZE:
+            segments.append(("bytes", bytes(TAR_BLOCK_SIZE - entry["size"] % TAR_BLOCK_SIZE)))
+
+    segments.append(("bytes", bytes(2 * TAR_BLOCK_SIZE))) # End of archive
+
+    return segments
+
+def get_segment_length(segment: tuple) -> int:
+    if segment[0] == "bytes":
+        return len(segment[1])
+
+    if segment[0] == "file":
+        return segment[1]["size"]
+
+    return segment[1]
+
+def get_segments_length(segments: list[tuple]) -> int:
+    return sum(get_segment_length(segment) for segment in segments)
+
+async def get_file_crc(path: str) -> int:
+    crc = 0
+
+    async with aiofiles.open(path, "rb") as file:
+        while content := await file.read(FILE_SERVE_CHUNK):
+            crc = zlib.crc32(content, crc)
+
+    return crc
+
+# Streams bytes start..end (inclusive) of the archive. Only one chunk is in memory at a time, CRCs stored with the files are used as they are,
+# other files before the range are read only if a CRC after the range start needs them (ZIP), files are never read for TAR ranges
+async def iter_archive_segments(segments: list[tuple], start: int, end: int, compute_crc: bool) -> AsyncIterator[bytes]:
+    crcs = {segment[1]["path"]: segment[1]["crc"] for segment in segments if segment[0] == "file" and segment[1].get("crc") is not None} if compute_crc else {}
+    segment_start = 0
+
+    for segment in segments:
+        segment_length = get_segment_length(segment)
+        segment_end = segment_start + segment_length - 1
+
+        if segment_start > end:
+            break
+
+        if segment_end >= start and segment_length > 0:
+            skip = max(start - segment_start, 0)
+            length = min(end, segment_end) - segment_start + 1 - skip
+
+            if segment[0] == "bytes":
+                yield segment[1][skip:skip + length]
+            elif segment[0] == "file":
+                entry = segment[1]
+                compute_file_crc = compute_crc and entry["path"] not in crcs
+
+                async with aiofiles.open(entry["path"], "rb") as file:
+                    # CRC needs the whole file, so the skipped part is read too (but not sent)
+                    position = 0 if compute_file_crc else skip
+                    await file.seek(position)
+                    crc = 0
+
+                    while position < skip + length:
+                        content = await file.read(min(FILE_SERVE_CHUNK, skip + length - position))
+
+                        if not content:
+                            raise RuntimeError(f"File '{entry['path']}' is smaller than expected!")
+
+                        if compute_file_crc:
+                            crc = zlib.crc32(content, crc)
+
+                        content_start = max(skip - position, 0)
+                        position += len(content)
+
+                        if content_start < len(content):
+                            yield content[content_start:]
+
+                if compute_file_crc and skip + length == entry["size"]:
+                    crcs[entry["path"]] = crc
+            else:
+                # CRCs of files that were not read in this request (before the range start)
+                for path in segment[2]:
+                    if path not in crcs:
+                        crcs[path] = await get_file_crc(path=path)
+
+                content = segment[3](crcs)
+                yield content[skip:skip + length]
+
+        segment_start += segment_length
+
+async def iter_gzip(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31) # gzip container
+
+    async for content in stream:
+        compressed = await asyncio.to_thread(compressor.compress, content)
+
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+# Streams the archive built on the fly (no temporary archive), stored ZIP and TAR support a single byte range for resuming downloads
+async def build_archive_response(request: Request, entries: list[dict], archive_format: ArchiveFormats, archive_name: str) -> Response:
+    filename = f"{get_archive_name(archive_name)}.{archive_format.value}"
+    last_modified = max([entry["mtime"] for entry in entries], default=0)
+    etag = make_etag(archive_format.value, *[f"{entry['name']}:{entry['size']}:{entry['mtime']}" for entry in entries])
+    headers = {"ETag": etag, "Last-Modified": formatdate(float(last_modified), usegmt=True), "Cache-Control": "no-cache", "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"}
+
+    if archive_format == ArchiveFormats.ZIP:
+        segments = get_zip_segments(entries=entries)
+        media_type = "application/zip"
+    else:
+        segments = get_tar_segments(entries=entries)
+        media_type = "application/x-tar"
+
+    if archive_format == ArchiveFormats.TAR_GZ:
+        stream = iter_archive_segments(segments=segments, start=0, end=get_segments_length(segments) - 1, compute_crc=False)
+        return StreamingResponse(iter_gzip(stream=stream), media_type="application/gzip", headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    archive_size = get_segments_length(segments)
+    compute_crc = archive_format == ArchiveFormats.ZIP
+
+    if is_not_modified(request=request, etag=etag, last_modified=last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    range_header = request.headers.get("range")
+
+    if range_header is not None and is_range_valid(request=request, etag=etag, last_modified=last_modified):
+        try:
+            ranges = parse_range_header(range_header=range_header, file_size=archive_size)
+
+            if ranges is None:
+                return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={**headers, "Content-Range": f"bytes */{archive_size}"})
+        except ValueError:
+            ranges = None # Invalid header is ignored (full response)
+
+        # Only a single range is supported (enough for resuming), multiple ranges get the full archive
+        if ranges is not None and len(ranges) == 1:
+            start, end = ranges[0]
+            stream = iter_archive_segments(segments=segments, start=start, end=end, compute_crc=compute_crc)
+            return StreamingResponse(stream, status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=media_type, headers={**headers, "Content-Range": f"bytes {start}-{end}/{archive_size}", "Content-Length": str(end - start + 1)})
+
+    stream = iter_archive_segments(segments=segments, start=0, end=archive_size - 1, compute_crc=compute_crc)
+
+    return StreamingResponse(stream, media_type=media_type, headers={**headers, "Content-Length": str(archive_size)})
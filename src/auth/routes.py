@@ -1,11 +1,11 @@
 # External imports
 from fastapi import APIRouter, Depends, HTTPException, status, Body
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlmodel import Session, select
+from sqlmodel import select
 
 # Internal imports
 from users.models import Users
-from database import engine
+from database import async_session
 from auth.utils import verify_password, create_token, verify_token
 from auth.types import TokenTypes
 from auth.models import TokenResponse, RefreshTokenResponse
@@ -17,9 +17,9 @@ auth_router = APIRouter()
 # Login and generate token
 @auth_router.post("/token", tags=["auth"], response_model=TokenResponse)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Users).where(Users.username == form_data.username)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         user = results.first()
 
     if user is None:
@@ -38,7 +38,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 @auth_router.post("/refresh-token", tags=["auth"], response_model=RefreshTokenResponse)
 async def refresh_access_token(refresh_token: str = Body(embed=True)):
     token_payload = verify_token(token=refresh_token)
-    current_user = verify_authenticated_user(token_payload=token_payload)
+    current_user = await verify_authenticated_user(token_payload=token_payload)
 
     # Maybe not needed - just a fail-safe
     if current_user.username == ANONYMOUS_USER: # Login of anonymous user is not allowed in this endpoint
@@ -0,0 +1,149 @@
+# External imports
+from fastapi import Request, Response, status
+from pydantic import TypeAdapter
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Awaitable, Callable
+import hashlib
+import gzip
+import json
+import time
+
+# Internal imports
+from config import CACHE_BACKEND, REDIS_URL, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_COMPRESS_MIN_SIZE
+
+class CacheEntities(Enum):
+    UPLOADS = "uploads"
+    TAGS = "tags"
+    COLLECTIONS = "collections"
+    USERS = "users"
+
+# In-process backend - every API process has its own cache, invalidation of other processes is limited by TTL
+class MemoryCacheBackend:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (expires_at, value)
+        self.versions = {}
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self.entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            return None
+
+        self.entries.move_to_end(key)
+
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get_version(self, entity: str) -> int:
+        return self.versions.get(entity, 0)
+
+    async def increment_version(self, entity: str):
+        self.versions[entity] = self.versions.get(entity, 0) + 1
+
+# Shared backend - all API processes see the same entries and invalidations (needs 'redis' package)
+class RedisCacheBackend:
+    def __init__(self, url: str):
+        import redis.asyncio as redis # Optional dependency, only needed with CACHE_BACKEND=redis
+
+        self.client = redis.from_url(url)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        await self.client.set(key, value, ex=ttl)
+
+    async def get_version(self, entity: str) -> int:
+        return int(await self.client.get(f"version:{entity}") or 0)
+
+    async def increment_version(self, entity: str):
+        await self.client.incr(f"version:{entity}")
+
+def get_cache_backend() -> MemoryCacheBackend | RedisCacheBackend:
+    if CACHE_BACKEND == "redis":
+        return RedisCacheBackend(url=REDIS_URL)
+
+    return MemoryCacheBackend(max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+
+cache_backend = get_cache_backend()
+
+# Cached responses of an entity become unreachable when its version changes (call after the write is committed)
+async def invalidate_cache(*entities: CacheEntities):
+    for entity in entities:
+        try:
+            await cache_backend.increment_version(entity=entity.value)
+        except Exception as e:
+            print(f"Cache invalidation error: {e}")
+
+# Key is made of the path, normalized query parameters (sorted, so order does not matter) and versions of the entities the response depends on
+async def get_response_cache_key(request: Request, entities: list[CacheEntities]) -> str:
+    query = "&".join(f"{key}={value}" for key, value in sorted(request.query_params.multi_items()))
+    versions = ",".join([str(await cache_backend.get_version(entity=entity.value)) for entity in entities])
+
+    return f"response:{request.url.path}:{versions}:{hashlib.sha256(query.encode()).hexdigest()}"
+
+# Cached value is ETag, encoding, additional headers (JSON) and already serialized (and compressed if large enough) JSON body
+def pack_cached_response(body: bytes, headers: dict) -> bytes:
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = json.dumps(headers).encode()
+
+    if len(body) >= RESPONSE_CACHE_COMPRESS_MIN_SIZE:
+        return b"\n".join([etag.encode(), b"gzip", headers, gzip.compress(body, compresslevel=6)])
+
+    return b"\n".join([etag.encode(), b"identity", headers, body])
+
+def unpack_cached_response(value: bytes) -> tuple[str, str, dict, bytes]:
+    etag, encoding, headers, body = value.split(b"\n", 3)
+
+    return etag.decode(), encoding.decode(), json.loads(headers), body
+
+# Returns JSON response of a listing endpoint from the cache (build is called and its result serialized only on a miss), answers If-None-Match with 304
+# build_headers returns additional headers for the built result (for example 'X-Next-Cursor'), they are cached with the body
+# exclude_unset leaves out fields the built result does not contain (same as 'response_model_exclude_unset')
+# Errors of the cache backend never fail the request, the response is then built without the cache
+async def cached_response(request: Request, entities: list[CacheEntities], response_model: Any, build: Callable[[], Awaitable[Any]], build_headers: Callable[[Any], dict] | None = None, exclude_unset: bool = False) -> Response:
+    value = None
+    key = None
+
+    try:
+        key = await get_response_cache_key(request=request, entities=entities)
+        value = await cache_backend.get(key=key)
+    except Exception as e:
+        print(f"Cache error: {e}")
+
+    if value is None:
+        adapter = TypeAdapter(response_model)
+        result = await build()
+        body = adapter.dump_json(adapter.validate_python(result, from_attributes=True), exclude_unset=exclude_unset)
+        value = pack_cached_response(body=body, headers=build_headers(result) if build_headers is not None else {})
+
+        if key is not None:
+            try:
+                await cache_backend.set(key=key, value=value, ttl=RESPONSE_CACHE_TTL)
+            except Exception as e:
+                print(f"Cache error: {e}")
+
+    etag, encoding, additional_headers, body = unpack_cached_response(value=value)
+    headers = {**additional_headers, "ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    if_none_match = request.headers.get("if-none-match")
+
+    if if_none_match is not None and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if encoding == "gzip":
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+        else:
+            body = gzip.decompress(body)
+
+    return Response(content=body, media_type="application/json", headers=headers)
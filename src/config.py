@@ -1,5 +1,6 @@
 # External imports
 from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
 import os
 
 load_dotenv()
@@ -9,6 +10,10 @@ PORT = int(os.getenv("PORT", 8000))
 
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", make_url(DATABASE_URL).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False) if DATABASE_URL else None) # Used by request handlers so database calls do not block the event loop (any driver of DATABASE_URL is replaced by asyncpg)
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 10))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 20))
+TOTAL_COUNT_SHARDS = int(os.getenv("TOTAL_COUNT_SHARDS", 16)) # Rows every total counter is split into (concurrent inserts update different rows), can be changed at any time
 ANONYMOUS_USER = os.getenv("ANONYMOUS_USER", "Anonymous")
 
 # Tokens
@@ -18,8 +23,57 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60))
 REFRESH_TOKEN_EXPIRE_MINUTES = int(os.getenv("REFRESH_TOKEN_EXPIRE_MINUTES", 10080)) # Refresh token default is 10080 minutes (7 days)
 
 # Uploads
-MAX_FILE_SIZE = os.getenv("MAX_FILE_SIZE", 2000 * 1024 * 1024) # Default is 2 GiB
-FILE_READ_CHUNK = os.getenv("FILE_READ_CHUNK", 1024) # Size of a chunk to be read from an uploaded file at time. Default is 1 MiB
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 2000 * 1024 * 1024)) # Default is 2 GiB
+FILE_READ_CHUNK = int(os.getenv("FILE_READ_CHUNK", 1024 * 1024)) # Size of a chunk to be read from an uploaded file at time. Default is 1 MiB
+FILE_WRITE_BUFFER = int(os.getenv("FILE_WRITE_BUFFER", 8 * 1024 * 1024)) # Size of a buffer used when an uploaded file cannot be copied by the kernel. Default is 8 MiB
+FILE_HASH_CHUNK = int(os.getenv("FILE_HASH_CHUNK", 8 * 1024 * 1024)) # Size of a chunk read when hashing a file that is already on disk. Default is 8 MiB
+UPLOAD_SESSION_HASH_CACHE_SIZE = int(os.getenv("UPLOAD_SESSION_HASH_CACHE_SIZE", 1000)) # Number of resumable upload sessions whose running hash is kept in process (others are hashed from disk on completion)
+UPLOAD_SESSION_EXPIRY = int(os.getenv("UPLOAD_SESSION_EXPIRY", 24 * 60 * 60)) # Seconds an unfinished resumable upload session is kept after its last chunk, then it is removed with its file. Default is 1 day
+UPLOAD_SESSION_CLEANUP_INTERVAL = int(os.getenv("UPLOAD_SESSION_CLEANUP_INTERVAL", 60 * 60)) # Seconds between removals of expired upload sessions
+FILE_SAVE_CONCURRENCY = int(os.getenv("FILE_SAVE_CONCURRENCY", 8)) # Maximum number of files of one upload that are written to disk at the same time
 SAVE_DIR = os.getenv("SAVE_DIR")
 TEMP_DIR = os.getenv("TEMP_DIR", "/tmp") # Default is for most linux systems
-TARGET_THUMBNAIL_HEIGHT = int(os.getenv("TARGET_THUMBNAIL_HEIGHT", 720))
\ No newline at end of file
+TARGET_THUMBNAIL_HEIGHT = int(os.getenv("TARGET_THUMBNAIL_HEIGHT", 720))
+RENDITION_HEIGHTS = [int(height) for height in os.getenv("RENDITION_HEIGHTS", "160,360,720").split(",")] # Heights of downscaled thumbnails and file previews
+RENDITION_FORMATS = [image_format.strip().lower() for image_format in os.getenv("RENDITION_FORMATS", "jpeg,webp").split(",")] # Supported: jpeg, webp
+RENDITION_QUALITY = int(os.getenv("RENDITION_QUALITY", 85))
+SEARCH_TEXT_CONFIG = os.getenv("SEARCH_TEXT_CONFIG", "simple") # Postgres text search configuration ('simple' does not stem, works for any language). Changing it requires dropping the 'search_vector' column
+MAX_SEARCH_LIMIT = int(os.getenv("MAX_SEARCH_LIMIT", 100)) # Maximum number of results of one search page
+SEARCH_MIN_PREFIX_LENGTH = int(os.getenv("SEARCH_MIN_PREFIX_LENGTH", 3)) # Last word of the search text matches as a prefix only from this length (shorter prefixes match most of the index)
+TAG_FACET_LIMIT = min(int(os.getenv("TAG_FACET_LIMIT", 50)), 100) # Maximum number of tags in 'X-Tag-Facets' header of '/uploads' (most used tags are returned), at most 100 so the header stays a few KB (proxies reject large response headers, nginx buffers 4-8 KB)
+MAX_THUMBNAIL_BATCH = int(os.getenv("MAX_THUMBNAIL_BATCH", 200)) # Maximum number of uploads in one batch thumbnail request
+SPRITE_TILE_HEIGHT = int(os.getenv("SPRITE_TILE_HEIGHT", 160)) # Default height of thumbnails in a sprite sheet
+SPRITE_MAX_WIDTH = int(os.getenv("SPRITE_MAX_WIDTH", 2048)) # Thumbnails are placed in rows up to this width
+SPRITE_CACHE_MAX_FILES = int(os.getenv("SPRITE_CACHE_MAX_FILES", 1000)) # Maximum number of sprite sheets kept in SAVE_DIR/sprites, least recently used ones are removed first
+SPRITE_CACHE_MAX_AGE = int(os.getenv("SPRITE_CACHE_MAX_AGE", 7 * 24 * 60 * 60)) # Sprite sheets not used for this many seconds are removed. Default is 7 days
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg") # Used for seeking to a video frame, falls back to moviepy if not found
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", "ffprobe")
+VIDEO_FRAME_TIMEOUT = int(os.getenv("VIDEO_FRAME_TIMEOUT", 30)) # Seconds one ffmpeg/ffprobe call can take
+
+# Downloads
+FILE_SERVE_CHUNK = int(os.getenv("FILE_SERVE_CHUNK", 1024 * 1024)) # Size of a chunk sent at time when serving a file. Default is 1 MiB
+MAX_RANGES = int(os.getenv("MAX_RANGES", 16)) # Maximum number of ranges in one 'Range' request header
+FILE_CACHE_CONTROL = os.getenv("FILE_CACHE_CONTROL", "public, max-age=31536000, immutable") # Saved files never change
+THUMBNAIL_CACHE_CONTROL = os.getenv("THUMBNAIL_CACHE_CONTROL", "public, max-age=3600") # Thumbnails and renditions can be regenerated
+PROFILE_PICTURE_CACHE_CONTROL = os.getenv("PROFILE_PICTURE_CACHE_CONTROL", "public, no-cache") # Can be changed any time, always revalidate (answered with 304)
+FILE_SERVING_MODE = os.getenv("FILE_SERVING_MODE", "direct").lower() # 'direct', 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd), see README
+FILE_SERVING_INTERNAL_PREFIX = os.getenv("FILE_SERVING_INTERNAL_PREFIX", "/protected/").rstrip("/") + "/" # nginx 'internal' location aliased to SAVE_DIR
+FILE_LOCATION_CACHE_SIZE = int(os.getenv("FILE_LOCATION_CACHE_SIZE", 10000)) # Number of files kept in the in-process download cache (0 disables it)
+FILE_LOCATION_CACHE_TTL = float(os.getenv("FILE_LOCATION_CACHE_TTL", 300)) # Seconds, limits how long other API processes can serve a file deleted elsewhere
+FILE_LOCATION_CACHE_NEGATIVE_TTL = float(os.getenv("FILE_LOCATION_CACHE_NEGATIVE_TTL", 10)) # Seconds a missing file id is remembered
+
+# Cache
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower() # 'memory' (per process) or 'redis' (shared by all processes, needs 'redis' package)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 60)) # Seconds, also limits staleness of the memory backend in other processes
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000)) # Memory backend only
+RESPONSE_CACHE_COMPRESS_MIN_SIZE = int(os.getenv("RESPONSE_CACHE_COMPRESS_MIN_SIZE", 1024)) # Cached bodies at least this large are stored gzipped
+
+# Background jobs
+ENABLE_JOB_WORKERS = os.getenv("ENABLE_JOB_WORKERS", "true").lower() == "true" # Disable on API-only nodes
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", os.cpu_count() or 1)) # Number of processes generating thumbnails
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2)) # Seconds to wait when there are no pending jobs
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", 600)) # Seconds a job can run, a timed out job is failed (not retried). Job running for twice this long is considered abandoned (for example after a restart) and is claimed again
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = int(os.getenv("JOB_RETRY_DELAY", 30)) # Seconds before the first retry of a failed job, doubled with every next attempt
+RENDITION_BACKFILL_BATCH_SIZE = int(os.getenv("RENDITION_BACKFILL_BATCH_SIZE", 500)) # Uploads checked per query by the rendition backfill job
\ No newline at end of file
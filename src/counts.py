@@ -0,0 +1,149 @@
+# External imports
+from sqlmodel import Field, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event, inspect, func, literal
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.ext.compiler import compiles
+from enum import Enum
+from typing import Any
+import json
+
+# Internal imports
+from config import TOTAL_COUNT_SHARDS
+from uploads.models import Uploads
+from files.models import Files
+from tags.models import Tags
+from scatter_collections.models import Collections
+from users.models import Users
+
+class TotalCountModes(Enum):
+    EXACT = "exact" # COUNT(*) of the listing query
+    ESTIMATED = "estimated" # Number of rows estimated by the planner (EXPLAIN), fast but can be off
+    CACHED = "cached" # Counter rows (see TotalCounts), only for listings without filters or filtered only by creator
+
+# Number of not deleted rows of a table (created_by = 0) and of every creator, kept up to date on insert and soft-delete of counted models
+# Every counter is split into shards (count is their sum) - an update locks its row until the transaction ends, with one row per counter
+# concurrent inserts of the same table would wait for each other. Replaced 'totalcounts' table (one row per counter), which can be dropped
+class TotalCounts(SQLModel, table=True):
+    __tablename__ = "total_count_shards"
+
+    entity: str = Field(primary_key=True) # Table name
+    created_by: int = Field(primary_key=True) # 0 for rows of all creators
+    shard: int = Field(default=0, primary_key=True)
+    row_count: int = Field(default=0)
+
+counted_models = [Uploads, Files, Tags, Collections, Users]
+
+# EXPLAIN of a statement as an executable construct, so the statement is compiled with its parameters the usual way (it is planned, not run, unless 'analyze' is set)
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement: Any, analyze: bool = False):
+        self.statement = statement
+        self.analyze = analyze
+
+@compiles(Explain, "postgresql")
+def compile_explain(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN ({'ANALYZE, ' if element.analyze else ''}FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+# Counter rows of the row - whole table and its creator (when the model has one)
+def get_total_count_keys(entity: str, created_by: int | None) -> list[tuple[str, int]]:
+    keys = [(entity, 0)]
+
+    if created_by is not None:
+        keys.append((entity, created_by))
+
+    return keys
+
+# Statement adding delta to the counters, keys are sorted so concurrent updates cannot deadlock
+# Shard is picked by the connection (backend pid), so one transaction always updates the same shard of a counter and concurrent connections mostly different ones
+def get_update_total_counts_statement(keys: list[tuple[str, int]], delta: int):
+    row_counts = {}
+    for key in keys:
+        row_counts[key] = row_counts.get(key, 0) + delta
+
+    shard = func.pg_backend_pid() % TOTAL_COUNT_SHARDS
+    statement = insert(TotalCounts).values([{"entity": entity, "created_by": created_by, "shard": shard, "row_count": row_count} for (entity, created_by), row_count in sorted(row_counts.items())])
+
+    return statement.on_conflict_do_update(index_elements=[TotalCounts.entity, TotalCounts.created_by, TotalCounts.shard], set_={"row_count": TotalCounts.row_count + statement.excluded.row_count})
+
+# Counters of rows inserted by bulk statements (they do not emit ORM events), call in the same transaction as the insert
+async def add_total_counts(session: AsyncSession, rows: list[SQLModel]):
+    keys = [key for row in rows if row.deleted_at is None for key in get_total_count_keys(entity=row.__tablename__, created_by=getattr(row, "created_by", None))]
+
+    if keys:
+        await session.execute(get_update_total_counts_statement(keys=keys, delta=1))
+
+def update_total_counts_on_insert(mapper, connection, target: SQLModel):
+    if target.deleted_at is None:
+        connection.execute(get_update_total_counts_statement(keys=get_total_count_keys(entity=target.__tablename__, created_by=getattr(target, "created_by", None)), delta=1))
+
+# Soft-delete decrements the counters, restoring (deleted_at set back to None) increments them
+def update_total_counts_on_update(mapper, connection, target: SQLModel):
+    history = inspect(target).attrs.deleted_at.history
+
+    if not history.has_changes():
+        return
+
+    was_deleted = bool(history.deleted) and history.deleted[0] is not None
+    is_deleted = target.deleted_at is not None
+
+    if was_deleted != is_deleted:
+        connection.execute(get_update_total_counts_statement(keys=get_total_count_keys(entity=target.__tablename__, created_by=getattr(target, "created_by", None)), delta=-1 if is_deleted else 1))
+
+for counted_model in counted_models:
+    event.listen(counted_model, "after_insert", update_total_counts_on_insert)
+    event.listen(counted_model, "after_update", update_total_counts_on_update)
+
+# Statements filling the counters from the tables (used when the counter table is empty), counts are put into shard 0
+def get_fill_total_counts_statements() -> list:
+    statements = []
+
+    for model in counted_models:
+        counts = select(literal(model.__tablename__), literal(0), literal(0), func.count()).where(model.deleted_at == None)
+        statements.append(insert(TotalCounts).from_select(["entity", "created_by", "shard", "row_count"], counts).on_conflict_do_nothing())
+
+        if hasattr(model, "created_by"):
+            counts = select(literal(model.__tablename__), model.created_by, literal(0), func.count()).where(model.deleted_at == None).group_by(model.created_by)
+            statements.append(insert(TotalCounts).from_select(["entity", "created_by", "shard", "row_count"], counts).on_conflict_do_nothing())
+
+    return statements
+
+async def get_exact_count(session: AsyncSession, statement: Any) -> int:
+    results = await session.exec(select(func.count()).select_from(statement.order_by(None).subquery()))
+
+    return results.one()
+
+async def get_estimated_count(session: AsyncSession, statement: Any) -> int:
+    results = await session.execute(Explain(statement.order_by(None)))
+    plan = results.scalar()
+
+    if isinstance(plan, str): # Depends on the json codec of the driver
+        plan = json.loads(plan)
+
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+async def get_cached_count(session: AsyncSession, model: Any, created_by: int | None) -> int:
+    statement = select(func.coalesce(func.sum(TotalCounts.row_count), 0)).where(TotalCounts.entity == model.__tablename__, TotalCounts.created_by == (created_by or 0))
+    results = await session.exec(statement)
+
+    return int(results.one())
+
+# Headers with total number of rows of a listing ('count' query parameter), statement is the listing query without pagination (offset, limit, cursor)
+# Cached count is used only when cacheable (no filters other than creator), otherwise the estimate is used - 'X-Total-Count-Mode' says which one it is
+async def get_total_count_headers(session: AsyncSession, statement: Any, mode: TotalCountModes | None, model: Any = None, created_by: int | None = None, cacheable: bool = False) -> dict:
+    if mode is None:
+        return {}
+
+    if mode == TotalCountModes.CACHED and (not cacheable or model not in counted_models or (created_by is not None and not hasattr(model, "created_by"))):
+        mode = TotalCountModes.ESTIMATED
+
+    if mode == TotalCountModes.EXACT:
+        total_count = await get_exact_count(session=session, statement=statement)
+    elif mode == TotalCountModes.ESTIMATED:
+        total_count = await get_estimated_count(session=session, statement=statement)
+    else:
+        total_count = await get_cached_count(session=session, model=model, created_by=created_by)
+
+    return {"X-Total-Count": str(total_count), "X-Total-Count-Mode": mode.value}
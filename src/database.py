@@ -1,16 +1,57 @@
 # External imports
 from sqlmodel import SQLModel, create_engine, Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import text, func, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert
 
 # Internal imports
-from config import DATABASE_URL, ANONYMOUS_USER
+from config import DATABASE_URL, ASYNC_DATABASE_URL, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, ANONYMOUS_USER
 from users.models import Users
 from users.types import UserRoles, UserStatuses
+from uploads.models import Uploads, get_upload_search_vector_expression
+from uploads.types import ThumbnailStatuses
+from tags.models import TagUploadLinks, TagUploadCounts
+from counts import TotalCounts, get_fill_total_counts_statements
 
+# Synchronous engine is only used for startup tasks (creating tables and defaults)
 engine = create_engine(DATABASE_URL)
 
+# Asynchronous engine (asyncpg) used by all request handlers
+async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=DATABASE_POOL_SIZE, max_overflow=DATABASE_MAX_OVERFLOW, pool_pre_ping=True)
+
+# expire_on_commit=False so returned objects can still be read after the session is closed (lazy loading is not possible with async sessions)
+async_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+# Columns added to tables after they were first created - create_all does not change existing tables, so they are added by initialize_database
+def get_added_columns() -> list[tuple[str, str]]:
+    return [
+        ("files", "content_hash VARCHAR"),
+        ("files", "crc32 BIGINT"),
+        ("jobs", "run_after NUMERIC"),
+        ("uploads", f"thumbnail_status VARCHAR NOT NULL DEFAULT '{ThumbnailStatuses.NONE.value}'"), # Existing thumbnails are still served, only 'pending' changes responses
+        ("uploads", f"search_vector tsvector GENERATED ALWAYS AS ({get_upload_search_vector_expression()}) STORED") # Rewrites the whole table under ACCESS EXCLUSIVE lock, see README (Database Migrations)
+    ]
+
 def initialize_database():
     SQLModel.metadata.create_all(engine)
 
+    # Before the indexes, some of them are on the added columns. ALTER TABLE takes ACCESS EXCLUSIVE lock even when the column exists,
+    # so only missing columns are added, each in its own transaction (lock of a table rewrite is not held while the next column is added)
+    for table_name, column in get_added_columns():
+        with engine.begin() as connection:
+            if column.split()[0] not in [existing_column["name"] for existing_column in inspect(connection).get_columns(table_name)]:
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column}"))
+
+    # create_all skips indexes of already existing tables, indexes added later are created here
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except IntegrityError as e: # Unique index over rows that already have duplicates, the rest of the app works without it
+                print(f"Could not create unique index '{index.name}', remove the duplicate rows and restart: {e.orig}")
+
 def setup_database_defaults():
     anonymous = Users(username=ANONYMOUS_USER, password=None, role=UserRoles.SYSTEM.value, status=UserStatuses.NORMAL.value)
 
@@ -21,4 +62,28 @@ def setup_database_defaults():
         if results.first() is None:
             db_user = Users.model_validate(anonymous)
             session.add(db_user)
-            session.commit()
\ No newline at end of file
+            session.commit()
+
+# Counters of tag links are filled from the links when they are empty (first start with the counter table), after that they are kept up to date by the endpoints
+def setup_tag_upload_counts():
+    with Session(engine) as session:
+        statement = select(TagUploadCounts).limit(1)
+        results = session.exec(statement)
+
+        if results.first() is None:
+            counts = select(TagUploadLinks.tag_id, func.count()).join(Uploads, Uploads.id == TagUploadLinks.upload_id).where(Uploads.deleted_at == None).group_by(TagUploadLinks.tag_id)
+            statement = insert(TagUploadCounts).from_select(["tag_id", "upload_count"], counts).on_conflict_do_nothing()
+            session.execute(statement)
+            session.commit()
+
+# Total counts are filled from the tables when the counter table is empty (first start with it), after that they are kept up to date on insert and soft-delete
+def setup_total_counts():
+    with Session(engine) as session:
+        statement = select(TotalCounts).limit(1)
+        results = session.exec(statement)
+
+        if results.first() is None:
+            for statement in get_fill_total_counts_statements():
+                session.execute(statement)
+
+            session.commit()
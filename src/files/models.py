@@ -1,5 +1,6 @@
 # External imports
 from sqlmodel import Field, SQLModel
+from sqlalchemy import Index, BigInteger
 from decimal import Decimal
 
 # Internal imports
@@ -16,12 +17,46 @@ class FileBase(SQLModel):
     
 class Files(FileBase, table=True):
     id: int | None = Field(default=None, primary_key=True) # Id is optional because it is generated by the databse (just leave it like that)
+    content_hash: str | None = Field(default=None, index=True) # SHA-256 of the file content (hex), identical content is stored only once
+    crc32: int | None = Field(default=None, sa_type=BigInteger) # CRC-32 of the file content (computed with the hash), ZIP archives use it instead of reading the file. None for files saved before it was added
     created_at: Decimal = Field(default_factory=current_timestamp)
     deleted_at: Decimal | None = Field(default=None)
 
+# One not deleted file per index of an upload - concurrent uploads of the same index fail on insert instead of overwriting each other
+Index("ix_files_upload_id_generated_filename", Files.__table__.c.upload_id, Files.__table__.c.generated_filename, unique=True, postgresql_where=Files.__table__.c.deleted_at == None)
+
 class FileCreate(FileBase):
     pass
 
 class FileResponse(FileBase):
     id: int
-    created_at: Decimal
\ No newline at end of file
+    content_hash: str | None
+    created_at: Decimal
+
+class FileUploadSessionBase(SQLModel):
+    upload_id: int = Field(foreign_key="uploads.id")
+    filename: str # Original filename including extension
+    file_mime: str
+    file_size: int # Total size of the file declared by the client
+    file_index: int # Index of the file inside the upload (becomes the generated filename)
+
+class FileUploadSessions(FileUploadSessionBase, table=True):
+    id: int | None = Field(default=None, primary_key=True) # Id is optional because it is generated by the database (just leave it like that)
+    offset: int = Field(default=0) # Number of bytes already received
+    file_id: int | None = Field(default=None, foreign_key="files.id") # Set when the session is completed
+    created_by: int = Field(foreign_key="users.id")
+    created_at: Decimal = Field(default_factory=current_timestamp)
+    updated_at: Decimal = Field(default_factory=current_timestamp)
+    completed_at: Decimal | None = Field(default=None)
+
+class FileUploadSessionCreate(FileUploadSessionBase):
+    pass
+
+class FileUploadSessionResponse(FileUploadSessionBase):
+    id: int
+    offset: int
+    file_id: int | None
+    created_by: int
+    created_at: Decimal
+    updated_at: Decimal
+    completed_at: Decimal | None
@@ -1,35 +1,71 @@
 # External imports
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Depends, Request, Response, Header, Query, status
 from fastapi.responses import FileResponse as FileResponseFastAPI
-from sqlmodel import Session, select
+from sqlmodel import select, update
 import os
+import asyncio
+import base64
+import binascii
 
 # Internal imports
-from files.models import Files, FileResponse
-from database import engine
-from config import SAVE_DIR
-from utils import build_sqlmodel_get_all_query
+from files.models import Files, FileResponse, FileUploadSessions, FileUploadSessionCreate, FileUploadSessionResponse
+from files.utils import get_file_name_and_ext, get_upload_session_path, write_upload_session_chunk, PartialChunkError, get_owned_upload_session, build_file_response, build_path_response, get_cached_file_location, file_location_cache, hash_file, lock_upload_session_file, upload_session_hashes, insert_upload_file, check_content_hash, get_files_with_content
+from uploads.models import Uploads
+from users.models import UserResponse
+from users.utils import verify_authenticated_user
+from users.types import UserRoles
+from jobs.utils import add_new_files_jobs
+from uploads.utils import select_rendition, get_file_preview_renditions_dir
+from uploads.types import RenditionFormats
+from database import async_session
+from config import MAX_FILE_SIZE, FILE_CACHE_CONTROL, THUMBNAIL_CACHE_CONTROL
+from utils import build_sqlmodel_get_all_query, get_pagination_headers, current_timestamp
+from cache import CacheEntities, invalidate_cache
+from counts import TotalCountModes, get_total_count_headers
 
 files_router = APIRouter()
 
 @files_router.get("/files", tags=["files"], response_model=list[FileResponse])
-async def get_all_files(offset: int = 0, limit: int | None = 100, upload_id: int | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = None, order_by_direction: str | None =  None):
-    with Session(engine) as session:
+async def get_all_files(response: Response, offset: int = 0, limit: int | None = 100, cursor: str | None = None, upload_id: int | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = None, order_by_direction: str | None =  None, count: TotalCountModes | None = None):
+    async with async_session() as session:
         additional_filters = []
         if upload_id is not None:
             additional_filters.append(Files.upload_id == upload_id)
 
-        statement = build_sqlmodel_get_all_query(model=Files, offset=offset, limit=limit, created_before=created_before, created_after=created_after, created_by=created_by, additional_filters=additional_filters)
+        statement = build_sqlmodel_get_all_query(model=Files, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, order_by_direction=order_by_direction, additional_filters=additional_filters)
         
-        results = session.exec(statement)
+        results = await session.exec(statement)
+        files = results.all()
 
-        return results.all()
+        if count is not None:
+            statement = build_sqlmodel_get_all_query(model=Files, created_before=created_before, created_after=created_after, created_by=created_by, additional_filters=additional_filters)
+            response.headers.update(await get_total_count_headers(session=session, statement=statement, mode=count, model=Files, created_by=created_by, cacheable=not additional_filters and created_before is None and created_after is None))
+
+    response.headers.update(get_pagination_headers(items=files, limit=limit, order_by=order_by, order_by_direction=order_by_direction))
+
+    return files
+
+# Lookup of already stored content, so clients can skip uploading bytes the server already has
+@files_router.get("/files/by-hash/{sha256}", tags=["files"], response_model=list[FileResponse])
+async def get_files_by_hash(sha256: str):
+    sha256 = check_content_hash(content_hash=sha256)
+
+    async with async_session() as session:
+        return await get_files_with_content(session=session, content_hash=sha256)
+
+# Hit/miss counters of the download location cache (of the process that answers)
+@files_router.get("/files/cache/stats", tags=["files"], response_model=dict)
+async def get_file_location_cache_stats(current_user: UserResponse = Depends(verify_authenticated_user)):
+    if current_user.role != UserRoles.ADMIN.value:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only admin can view cache stats!")
+
+    return file_location_cache.get_stats()
 
 @files_router.get("/files/{file_id}", tags=["files"], response_model=FileResponse)
 async def get_file(file_id: int):
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Files).where(Files.id == file_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         file = results.one()
 
         if file is None:
@@ -38,18 +74,187 @@ async def get_file(file_id: int):
         return file
 
 @files_router.get("/files/{file_id}/download", tags=["files"], response_class=FileResponseFastAPI)
-async def download_file(file_id: int):
-    with Session(engine) as session:
-        statement = select(Files).where(Files.id == file_id)
-        results = session.exec(statement)
-        file = results.one()
+async def download_file(request: Request, file_id: int):
+    # Popular files are served without a database query (see files.utils.FileLocationCache)
+    location = await get_cached_file_location(file_id=file_id)
+
+    if location is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found!")
+
+    # Size, ETag and Last-Modified come from the database entry, the file is opened only when content is sent (not for 304)
+    return await build_file_response(request=request, file_path=location["path"], file_size=location["size"], media_type=location["mime"], etag=location["etag"], last_modified=location["last_modified"], cache_control=FILE_CACHE_CONTROL, download_filename=location["filename"])
+
+# Downscaled preview of an image file (best existing rendition for the requested size and format)
+@files_router.get("/files/{file_id}/preview", tags=["files"], response_class=FileResponseFastAPI)
+async def get_file_preview(request: Request, file_id: int, size: int | None = None, image_format: RenditionFormats = Query(default=RenditionFormats.JPEG, alias="format")):
+    async with async_session() as session:
+        statement = select(Files).where(Files.id == file_id, Files.deleted_at == None)
+        results = await session.exec(statement)
+        file = results.first()
 
         if file is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found!")
-        
-        file_path = os.path.join(SAVE_DIR, "uploads", str(file.upload_id), "files", f"{file.generated_filename}.{file.file_ext}")
 
-        if os.path.exists(file_path):
-            return file_path
-        else:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found!")
\ No newline at end of file
+    file_path = select_rendition(directory=get_file_preview_renditions_dir(upload_id=file.upload_id, generated_filename=file.generated_filename), size=size, image_format=image_format.value)
+
+    if file_path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preview not found!")
+
+    return await build_path_response(request=request, file_path=file_path, cache_control=THUMBNAIL_CACHE_CONTROL, not_found_detail="Preview not found!")
+
+# Resumable uploads (similar to the tus protocol): create a session, PATCH chunks at offsets, HEAD for the current offset and complete it into a file of the upload
+@files_router.post("/files/sessions", tags=["files"], response_model=FileUploadSessionResponse)
+async def new_upload_session(new_session: FileUploadSessionCreate, current_user: UserResponse = Depends(verify_authenticated_user)):
+    get_file_name_and_ext(filename=new_session.filename, file_mime=new_session.file_mime)
+
+    if new_session.file_size < 0 or new_session.file_index < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File size and file index cannot be negative!")
+
+    if new_session.file_size > MAX_FILE_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"File exceeds maximum allowed size of {MAX_FILE_SIZE} bytes!")
+
+    async with async_session() as session:
+        statement = select(Uploads).where(Uploads.id == new_session.upload_id, Uploads.deleted_at == None)
+        results = await session.exec(statement)
+        upload = results.first()
+
+        if upload is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
+
+        if current_user.id != upload.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add files to upload!")
+
+        statement = select(Files).where(Files.upload_id == upload.id, Files.generated_filename == str(new_session.file_index), Files.deleted_at == None)
+        results = await session.exec(statement)
+
+        if results.first() is not None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"File with index {new_session.file_index} already exists in upload {upload.id}!")
+
+        db_upload_session = FileUploadSessions.model_validate(FileUploadSessions(**new_session.model_dump(), created_by=current_user.id))
+        session.add(db_upload_session)
+        await session.commit()
+        await session.refresh(db_upload_session)
+
+    # Create empty file that the chunks will be written into
+    session_path = get_upload_session_path(session_id=db_upload_session.id)
+    os.makedirs(os.path.dirname(session_path), exist_ok=True)
+    open(session_path, "wb").close()
+
+    return db_upload_session
+
+@files_router.get("/files/sessions/{session_id}", tags=["files"], response_model=FileUploadSessionResponse)
+async def get_upload_session(session_id: int, current_user: UserResponse = Depends(verify_authenticated_user)):
+    async with async_session() as session:
+        return await get_owned_upload_session(session=session, session_id=session_id, current_user=current_user)
+
+@files_router.head("/files/sessions/{session_id}", tags=["files"])
+async def get_upload_session_offset(session_id: int, current_user: UserResponse = Depends(verify_authenticated_user)):
+    async with async_session() as session:
+        upload_session = await get_owned_upload_session(session=session, session_id=session_id, current_user=current_user)
+
+    return Response(status_code=status.HTTP_200_OK, headers={"Upload-Offset": str(upload_session.offset), "Upload-Length": str(upload_session.file_size), "Cache-Control": "no-store"})
+
+@files_router.patch("/files/sessions/{session_id}", tags=["files"], status_code=status.HTTP_204_NO_CONTENT)
+async def upload_session_chunk(request: Request, session_id: int, upload_offset: int = Header(), upload_checksum: str | None = Header(default=None), content_type: str | None = Header(default=None), current_user: UserResponse = Depends(verify_authenticated_user)):
+    if content_type != "application/offset+octet-stream":
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Content type of a chunk must be 'application/offset+octet-stream'!")
+
+    checksum = None
+
+    if upload_checksum is not None: # Format: 'sha256 <base64 digest>'
+        try:
+            algorithm, encoded_checksum = upload_checksum.split(" ", 1)
+            checksum = base64.b64decode(encoded_checksum, validate=True)
+        except (ValueError, binascii.Error):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Upload-Checksum header! Format: 'sha256 <base64 digest>'")
+
+        if algorithm.lower() != "sha256":
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only 'sha256' checksum algorithm is supported!")
+
+    async with async_session() as session:
+        await get_owned_upload_session(session=session, session_id=session_id, current_user=current_user)
+
+    session_path = get_upload_session_path(session_id=session_id)
+
+    # Session file stays locked while the chunk is written so two chunks of one session cannot be written at the same time, offset is read again under the lock
+    with lock_upload_session_file(path=session_path):
+        async with async_session() as session:
+            upload_session = await get_owned_upload_session(session=session, session_id=session_id, current_user=current_user)
+
+        if upload_session.completed_at is not None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session is already completed!")
+
+        if upload_offset != upload_session.offset:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Upload-Offset does not match the current offset {upload_session.offset}!")
+
+        file_hash = upload_session_hashes.get(session_id=upload_session.id, offset=upload_session.offset)
+        error = None
+
+        try:
+            written = await write_upload_session_chunk(path=session_path, stream=request.stream(), offset=upload_session.offset, max_length=upload_session.file_size - upload_session.offset, checksum=checksum, file_hash=file_hash)
+        except PartialChunkError as e:
+            # Received part of the chunk is kept, client continues from the new offset (HEAD)
+            written = e.written
+            error = e.error
+
+        new_offset = upload_session.offset + written
+
+        # Database row is locked only by this update
+        async with async_session() as session:
+            statement = update(FileUploadSessions).where(FileUploadSessions.id == upload_session.id, FileUploadSessions.offset == upload_session.offset, FileUploadSessions.completed_at == None).values(offset=new_offset, updated_at=current_timestamp())
+            results = await session.execute(statement)
+
+            if results.rowcount == 0:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session was changed by another request!")
+
+            await session.commit()
+
+        if file_hash is not None:
+            upload_session_hashes.set(session_id=upload_session.id, offset=new_offset, file_hash=file_hash)
+
+    if error is not None:
+        raise HTTPException(status_code=error.status_code, detail=error.detail, headers={"Upload-Offset": str(new_offset)})
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={"Upload-Offset": str(new_offset)})
+
+# Completes the session - saved file and its database entry are the same as if the file was sent in 'POST /uploads'
+@files_router.post("/files/sessions/{session_id}/complete", tags=["files"], response_model=FileResponse)
+async def complete_upload_session(session_id: int, current_user: UserResponse = Depends(verify_authenticated_user)):
+    async with async_session() as session:
+        upload_session = await get_owned_upload_session(session=session, session_id=session_id, current_user=current_user)
+
+        if upload_session.completed_at is not None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session is already completed!")
+
+    session_path = get_upload_session_path(session_id=session_id)
+
+    # No chunk can be written while the session is completed
+    with lock_upload_session_file(path=session_path):
+        async with async_session() as session:
+            upload_session = await get_owned_upload_session(session=session, session_id=session_id, current_user=current_user, lock=True)
+
+            if upload_session.completed_at is not None:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session is already completed!")
+
+            if upload_session.offset != upload_session.file_size:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Upload session is not complete! Received {upload_session.offset} of {upload_session.file_size} bytes.")
+
+            original_filename, file_ext = get_file_name_and_ext(filename=upload_session.filename, file_mime=upload_session.file_mime)
+
+            # Hash was updated as the chunks arrived, the file is read again only when they were received by another process
+            file_hash = upload_session_hashes.pop(session_id=upload_session.id, offset=upload_session.file_size) or await asyncio.to_thread(hash_file, session_path)
+
+            new_file = Files(upload_id=upload_session.upload_id, original_filename=original_filename, generated_filename=str(upload_session.file_index), file_size=upload_session.file_size, file_mime=upload_session.file_mime, file_ext=file_ext, content_hash=file_hash.hexdigest(), crc32=file_hash.crc32, created_by=upload_session.created_by)
+            db_file = await insert_upload_file(session=session, new_file=new_file, source=session_path)
+
+            upload_session.file_id = db_file.id
+            upload_session.completed_at = current_timestamp()
+            upload_session.updated_at = upload_session.completed_at
+            session.add(upload_session)
+
+            await add_new_files_jobs(session=session, upload_id=upload_session.upload_id, files=[db_file])
+            await session.commit()
+
+    await invalidate_cache(CacheEntities.UPLOADS) # Thumbnail status can change
+
+    return db_file
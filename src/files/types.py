@@ -0,0 +1,7 @@
+# External imports
+from enum import Enum
+
+class FileServingModes(Enum):
+    DIRECT = "direct" # File is streamed by the API
+    X_ACCEL_REDIRECT = "x-accel-redirect" # nginx sends the file from internal location (FILE_SERVING_INTERNAL_PREFIX)
+    X_SENDFILE = "x-sendfile" # Apache (mod_xsendfile) / lighttpd send the file by its absolute path
@@ -1,61 +1,609 @@
 # External import
-from fastapi import HTTPException, status, UploadFile
+from fastapi import HTTPException, status, UploadFile, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.formparsers import MultiPartParser
+from starlette.requests import ClientDisconnect
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
 import aiofiles
-from sqlmodel import Session
+from sqlmodel import insert, select, delete
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy import event, inspect
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import AsyncIterator
+from typing import BinaryIO
+import asyncio
+import hashlib
+import zlib
+import fcntl
+import shutil
+import mmap
+import uuid
+import time
 import os
 import mimetypes
+import logging
+import re
 
 # Internal imports
-from config import FILE_READ_CHUNK, SAVE_DIR, MAX_FILE_SIZE
-from database import engine
-from files.models import Files, FileResponse
+from counts import add_total_counts
+from config import FILE_WRITE_BUFFER, FILE_SERVE_CHUNK, MAX_RANGES, FILE_SERVING_MODE, FILE_SERVING_INTERNAL_PREFIX, FILE_HASH_CHUNK, UPLOAD_SESSION_HASH_CACHE_SIZE, UPLOAD_SESSION_EXPIRY, UPLOAD_SESSION_CLEANUP_INTERVAL, SAVE_DIR, TEMP_DIR, MAX_FILE_SIZE, FILE_SAVE_CONCURRENCY, FILE_LOCATION_CACHE_SIZE, FILE_LOCATION_CACHE_TTL, FILE_LOCATION_CACHE_NEGATIVE_TTL
+from database import async_session
+from files.models import Files, FileResponse, FileUploadSessions
+from files.types import FileServingModes
+from uploads.models import Uploads
+from users.models import UserResponse
+from utils import current_timestamp
 
-# Creates db entry of the file and saves the file to disk (Probably just for POST /uploads endpoint)
-async def create_file(file: UploadFile, upload_id: int, filename: str, created_by: int) -> FileResponse:
-    file_mime = file.content_type
+LOCK_NOT_AVAILABLE = "55P03" # Postgres error code of 'FOR UPDATE NOWAIT' on a locked row
 
-    original_filename, file_ext = os.path.splitext(file.filename)
+logger = logging.getLogger(__name__)
+
+# Checks the mime type against the file extension and returns the original filename (without extension) and the extension
+def get_file_name_and_ext(filename: str, file_mime: str) -> tuple[str, str]:
+    original_filename, file_ext = os.path.splitext(filename)
     file_ext = file_ext[1:] # Remove the dot
 
-    if file_mime != mimetypes.guess_type(file.filename)[0]:
+    if file_mime != mimetypes.guess_type(filename)[0]:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"File mime '{file_mime}' is not affiliated with file extension '{file_ext}'!")
 
+    return original_filename, file_ext
+
+# Saves the file to disk and returns the (not yet inserted) database entry of the file
+async def save_upload_file(file: UploadFile, upload_id: int, filename: str, created_by: int) -> Files:
+    file_mime = file.content_type
+    original_filename, file_ext = get_file_name_and_ext(filename=file.filename, file_mime=file_mime)
+
     generated_filename = filename
 
-    file_size = await stream_save_file(file=file, target=os.path.join(SAVE_DIR, "uploads", str(upload_id), "files", f"{generated_filename}.{file_ext}"))
+    file_path = get_upload_file_path(upload_id=upload_id, generated_filename=generated_filename, file_ext=file_ext)
 
-    new_file = Files(upload_id=upload_id, original_filename=original_filename, generated_filename=generated_filename, file_size=file_size, file_mime=file_mime, file_ext=file_ext, created_by=created_by)
+    file_size, content_hash, crc32 = await stream_save_file(file=file, target=file_path)
+    deduplicate_file(file_path=file_path, content_hash=content_hash)
 
-    with Session(engine) as session:
-        db_file = Files.model_validate(new_file)
-        session.add(db_file)
-        session.commit()
-        session.refresh(db_file)
-        return db_file
+    return Files(upload_id=upload_id, original_filename=original_filename, generated_filename=generated_filename, file_size=file_size, file_mime=file_mime, file_ext=file_ext, content_hash=content_hash, crc32=crc32, created_by=created_by)
 
-async def stream_save_file(file: UploadFile, target: str, max_file_size: int | None = MAX_FILE_SIZE) -> int:
-    file_size = 0  # Initialize size tracker
+# Creates db entry of the file and saves the file to disk
+async def create_file(file: UploadFile, upload_id: int, filename: str, created_by: int) -> FileResponse:
+    return (await create_files(files=[file], upload_id=upload_id, created_by=created_by, filenames=[filename]))[0]
+
+# Saves all files of an upload to disk concurrently and creates all db entries in a single transaction (Probably just for POST /uploads endpoint)
+async def create_files(files: list[UploadFile], upload_id: int, created_by: int, filenames: list[str] | None = None, max_concurrency: int = FILE_SAVE_CONCURRENCY) -> list[FileResponse]:
+    if filenames is None:
+        filenames = [str(index) for index in range(len(files))]
+
+    # Validate all files before anything is written to disk
+    for file in files:
+        get_file_name_and_ext(filename=file.filename, file_mime=file.content_type)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    errors = []
+
+    # Once a file fails, files still waiting for the semaphore are not saved. Files being saved are let finish (the copy runs in a thread
+    # that cannot be cancelled), so they can be removed afterwards instead of being written after the cleanup
+    async def save_with_limit(file: UploadFile, filename: str) -> Files | None:
+        async with semaphore:
+            if errors:
+                return None
+
+            try:
+                return await save_upload_file(file=file, upload_id=upload_id, filename=filename, created_by=created_by)
+            except Exception as e:
+                errors.append(e)
+                raise e
+
+    results = await asyncio.gather(*[save_with_limit(file=file, filename=filename) for file, filename in zip(files, filenames)], return_exceptions=True)
+    new_files = [result for result in results if isinstance(result, Files)]
+
+    try:
+        if errors:
+            raise errors[0]
+
+        if not new_files:
+            return []
+
+        async with async_session() as session:
+            db_files = await insert_files(session=session, new_files=new_files)
+            await session.commit()
+
+        return db_files
+    except BaseException as e:
+        # No database entry points to the saved files, remove them with their objects in the content store
+        for new_file in new_files:
+            remove_upload_file(file_path=get_upload_file_path(upload_id=new_file.upload_id, generated_filename=new_file.generated_filename, file_ext=new_file.file_ext), content_hash=new_file.content_hash)
+
+        raise e
+
+# Inserts all files with one bulk INSERT ... RETURNING (does not commit, so it can be part of a bigger transaction)
+async def insert_files(session: AsyncSession, new_files: list[Files]) -> list[Files]:
+    statement = insert(Files).returning(Files, sort_by_parameter_order=True)
+    results = await session.scalars(statement, [Files.model_validate(new_file).model_dump(exclude={"id"}) for new_file in new_files])
+    files = results.all()
+
+    # Bulk insert does not emit ORM events, new ids may be remembered as missing and counters are updated here
+    for file in files:
+        file_location_cache.invalidate(file_id=file.id)
+
+    await add_total_counts(session=session, rows=files)
+
+    return files
+
+def get_upload_file_path(upload_id: int, generated_filename: str, file_ext: str) -> str:
+    return os.path.join(SAVE_DIR, "uploads", str(upload_id), "files", f"{generated_filename}.{file_ext}")
+
+def get_upload_session_path(session_id: int) -> str:
+    return os.path.join(TEMP_DIR, "upload_sessions", f"{session_id}.part")
+
+# Chunk that failed part way (client disconnected, sent more than declared, ...) - bytes received before the failure are kept
+class PartialChunkError(Exception):
+    def __init__(self, error: HTTPException, written: int):
+        super().__init__(error.detail)
+        self.error = error
+        self.written = written
+
+# Writes a chunk of a resumable upload session at the given offset and returns the number of bytes written
+# Chunk is validated while it arrives (must not go past the declared size) and after it arrived (optional SHA-256 checksum)
+# Chunk with a checksum is discarded as a whole when it fails, without a checksum the received bytes are kept and PartialChunkError says how many
+# file_hash (hash of the content before offset) is updated with the written bytes, so the whole file does not have to be read again on completion
+async def write_upload_session_chunk(path: str, stream: AsyncIterator[bytes], offset: int, max_length: int, checksum: bytes | None = None, file_hash=None) -> int:
+    written = 0
+    chunk_hash = hashlib.sha256()
+
+    try:
+        async with aiofiles.open(path, "r+b") as out_file:
+            await out_file.seek(offset)
+
+            async for content in stream:
+                if written + len(content) > max_length:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Chunk exceeds the declared size of the file!")
 
+                await out_file.write(content)
+                written += len(content)
+
+                chunk_hash.update(content)
+                if file_hash is not None:
+                    file_hash.update(content)
+
+        if checksum is not None and chunk_hash.digest() != checksum:
+            raise HTTPException(status_code=460, detail="Chunk checksum mismatch!") # 460 = 'Checksum Mismatch' from the tus protocol
+
+        return written
+    except Exception as e:
+        if not isinstance(e, HTTPException):
+            e = HTTPException(status_code=status.HTTP_400_BAD_REQUEST if isinstance(e, ClientDisconnect) else status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error uploading chunk: {type(e).__name__} {str(e)}")
+
+        if checksum is not None or written == 0:
+            # Discard everything written by this chunk so the offset stays valid
+            os.truncate(path, offset)
+            raise e
+
+        # Resumed from the last received byte (the file is closed, so everything written is flushed)
+        os.truncate(path, offset + written)
+        raise PartialChunkError(error=e, written=written)
+
+# Exclusive lock of the session file, held while a chunk is written or the session is completed - one request at a time writes into a session
+# Lock is on the file (flock), so no database row stays locked during the transfer
+@contextmanager
+def lock_upload_session_file(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found!")
+
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session is being used by another request!")
+
+        yield
+    finally:
+        os.close(fd) # Releases the lock
+
+# Removes resumable upload sessions that were not completed and did not receive a chunk for UPLOAD_SESSION_EXPIRY seconds, with their files
+# Session whose file is locked (chunk is being written or the session is being completed) is skipped, files without a session (server stopped while creating one) are removed too
+async def remove_expired_upload_sessions() -> int:
+    expired_at = current_timestamp() - UPLOAD_SESSION_EXPIRY
+    removed = 0
+
+    async with async_session() as session:
+        statement = select(FileUploadSessions.id).where(FileUploadSessions.completed_at == None, FileUploadSessions.updated_at < expired_at)
+        results = await session.exec(statement)
+        session_ids = results.all()
+
+    for session_id in session_ids:
+        session_path = get_upload_session_path(session_id=session_id)
+
+        try:
+            with lock_upload_session_file(path=session_path):
+                async with async_session() as session:
+                    # Checked again under the lock, a chunk could have been received meanwhile
+                    statement = delete(FileUploadSessions).where(FileUploadSessions.id == session_id, FileUploadSessions.completed_at == None, FileUploadSessions.updated_at < expired_at)
+                    results = await session.execute(statement)
+                    await session.commit()
+
+                if results.rowcount == 0:
+                    continue
+
+                os.remove(session_path)
+        except HTTPException as e:
+            if e.status_code == status.HTTP_409_CONFLICT:
+                continue
+
+            # File is already missing, only the database row is removed
+            async with async_session() as session:
+                statement = delete(FileUploadSessions).where(FileUploadSessions.id == session_id, FileUploadSessions.completed_at == None, FileUploadSessions.updated_at < expired_at)
+                await session.execute(statement)
+                await session.commit()
+
+        upload_session_hashes.remove(session_id=session_id)
+        removed += 1
+
+    sessions_dir = os.path.dirname(get_upload_session_path(session_id=0))
+
+    try:
+        entries = [entry for entry in os.scandir(sessions_dir) if entry.name.endswith(".part") and entry.name[:-len(".part")].isdigit() and entry.stat().st_mtime < expired_at]
+    except FileNotFoundError:
+        entries = []
+
+    if entries:
+        async with async_session() as session:
+            statement = select(FileUploadSessions.id).where(FileUploadSessions.id.in_([int(entry.name[:-len(".part")]) for entry in entries]))
+            results = await session.exec(statement)
+            existing_ids = set(results.all())
+
+        for entry in entries:
+            if int(entry.name[:-len(".part")]) not in existing_ids:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+
+    return removed
+
+# Runs remove_expired_upload_sessions every UPLOAD_SESSION_CLEANUP_INTERVAL seconds, started with the server
+async def run_upload_session_cleanup():
+    while True:
+        try:
+            removed = await remove_expired_upload_sessions()
+
+            if removed:
+                print(f"Removed {removed} expired upload sessions")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Upload session cleanup error: {e}")
+
+        await asyncio.sleep(UPLOAD_SESSION_CLEANUP_INTERVAL)
+
+# SHA-256 (identifies the content) and CRC-32 (needed by ZIP archives) of a file, both computed in the same pass
+class ContentHash:
+    def __init__(self, sha256=None, crc32: int = 0):
+        self.sha256 = sha256 if sha256 is not None else hashlib.sha256()
+        self.crc32 = crc32
+
+    def update(self, content):
+        self.sha256.update(content)
+        self.crc32 = zlib.crc32(content, self.crc32)
+
+    def copy(self) -> "ContentHash":
+        return ContentHash(sha256=self.sha256.copy(), crc32=self.crc32)
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+# Running hashes of resumable upload sessions (session_id -> (offset, hash)), updated as chunks arrive
+# Hashes are kept per process - if a chunk of the session was received by another process, the file is hashed from disk on completion
+class UploadSessionHashes:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    # Copy of the hash of the content before offset (a failed chunk does not change the kept one), None if it is not known
+    def get(self, session_id: int, offset: int):
+        if offset == 0:
+            return ContentHash()
+
+        entry = self.entries.get(session_id)
+
+        if entry is None or entry[0] != offset:
+            return None
+
+        return entry[1].copy()
+
+    def set(self, session_id: int, offset: int, file_hash):
+        if self.max_size <= 0:
+            return
+
+        self.entries[session_id] = (offset, file_hash)
+        self.entries.move_to_end(session_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    # Hash of the whole file (offset is its size) and forgets the session, None if it is not known
+    def pop(self, session_id: int, offset: int) -> ContentHash | None:
+        file_hash = self.get(session_id=session_id, offset=offset)
+        self.entries.pop(session_id, None)
+
+        return file_hash
+
+    def remove(self, session_id: int):
+        self.entries.pop(session_id, None)
+
+upload_session_hashes = UploadSessionHashes(max_size=UPLOAD_SESSION_HASH_CACHE_SIZE)
+
+def hash_file(path: str) -> ContentHash:
+    file_hash = ContentHash()
+
+    with open(path, "rb") as file:
+        while content := file.read(FILE_HASH_CHUNK):
+            file_hash.update(content)
+
+    return file_hash
+
+# Inserts the database entry of a fully written file and moves the file (source) to its place in the upload directory (does not commit)
+# Upload is locked (FOR SHARE) so it cannot be deleted until the transaction ends, the unique index of the file index turns a concurrent upload of the same index into 409
+# File is moved only after the insert succeeded, so a rejected upload never overwrites the saved one
+async def insert_upload_file(session: AsyncSession, new_file: Files, source: str) -> Files:
+    statement = select(Uploads.id).where(Uploads.id == new_file.upload_id, Uploads.deleted_at == None).with_for_update(read=True)
+    results = await session.exec(statement)
+
+    if results.first() is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
+
+    try:
+        db_file = (await insert_files(session=session, new_files=[new_file]))[0]
+    except IntegrityError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"File with index {new_file.generated_filename} already exists in upload {new_file.upload_id}!")
+
+    file_path = get_upload_file_path(upload_id=db_file.upload_id, generated_filename=db_file.generated_filename, file_ext=db_file.file_ext)
+    await asyncio.to_thread(move_upload_session_file, source, file_path)
+    deduplicate_file(file_path=file_path, content_hash=db_file.content_hash)
+
+    return db_file
+
+# Moves a fully received file to its final location in the upload directory
+def move_upload_session_file(source: str, target: str):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    try:
+        os.replace(source, target)
+    except OSError:
+        shutil.move(source, target) # TEMP_DIR is on a different filesystem than SAVE_DIR
+
+# Saves the file to disk in chunks and returns its size, SHA-256 hash and CRC-32 (all computed in the same pass)
+async def stream_save_file(file: UploadFile, target: str, max_file_size: int | None = MAX_FILE_SIZE) -> tuple[int, str, int]:
     try:
         os.makedirs(os.path.dirname(target), exist_ok=True)
 
         await file.seek(0) # Rewind to the beginning of the file (must be await as it is async method: https://fastapi.tiangolo.com/tutorial/request-files/#uploadfile)
 
-        async with aiofiles.open(target, "wb") as out_file:
-            while content := await file.read(FILE_READ_CHUNK):
-                file_size += len(content)  # Increment total size
+        # Spooled file that already rolled over to disk (it is larger than the spool size) is copied by the kernel (copy_file_range/sendfile), in-memory ones are written in one buffered pass
+        # Both run in a thread, so there is a single thread hop per file instead of one per chunk
+        if file.size is not None and file.size > MultiPartParser.spool_max_size:
+            return await asyncio.to_thread(commit_disk_file, file.file.fileno(), target, max_file_size)
+        else:
+            return await asyncio.to_thread(copy_file_buffered, file.file, target, max_file_size)
+    except HTTPException as e:
+        raise e  # Propagate custom exceptions
+    except Exception as e:
+        if os.path.exists(target):
+            os.remove(target)
 
-                if max_file_size is not None and file_size > max_file_size: # Check if size exceeds limit
-                    os.remove(target)
-                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"File exceeds maximum allowed size of {max_size} bytes!")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error uploading file: {str(e)}")
+
+# Writes a request body straight to its final location (through a temporary name, so a failed upload never leaves a partial file), returns its size, SHA-256 hash and CRC-32
+async def stream_save_request(stream: AsyncIterator[bytes], target: str, max_file_size: int | None = MAX_FILE_SIZE) -> tuple[int, str, int]:
+    file_size = 0  # Initialize size tracker
+    file_hash = ContentHash()
+    temporary_target = f"{target}.{uuid.uuid4().hex}.part"
+
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        async with aiofiles.open(temporary_target, "wb") as out_file:
+            async for content in stream:
+                file_size += len(content)  # Increment total size
+                check_file_size(file_size=file_size, max_file_size=max_file_size) # Checked as bytes arrive, not after the whole body was received
 
+                file_hash.update(content)
                 await out_file.write(content)
 
-        return file_size
+        os.replace(temporary_target, target)
+
+        return file_size, file_hash.hexdigest(), file_hash.crc32
     except HTTPException as e:
         raise e  # Propagate custom exceptions
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error uploading file: {str(e)}")
+    finally:
+        if os.path.exists(temporary_target):
+            os.remove(temporary_target)
+
+def check_file_size(file_size: int, max_file_size: int | None):
+    if max_file_size is not None and file_size > max_file_size: # Check if size exceeds limit
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"File exceeds maximum allowed size of {max_file_size} bytes!")
+
+# Saves a file that is already on disk without copying it through Python buffers, returns its size, SHA-256 hash and CRC-32
+def commit_disk_file(source_fd: int, target: str, max_file_size: int | None = MAX_FILE_SIZE) -> tuple[int, str, int]:
+    file_size = os.fstat(source_fd).st_size
+    check_file_size(file_size=file_size, max_file_size=max_file_size) # Size is known up front, nothing is written if it is too big
+
+    # Hash straight from the page cache through mmap (no copies into Python buffers)
+    file_hash = ContentHash()
+
+    if file_size > 0:
+        with mmap.mmap(source_fd, 0, access=mmap.ACCESS_READ) as mapped_file:
+            file_hash.update(mapped_file)
+
+    try:
+        with open(target, "wb") as out_file:
+            out_fd = out_file.fileno()
+            preallocate_file(fd=out_fd, file_size=file_size)
+
+            copied = kernel_copy_file(source_fd=source_fd, out_fd=out_fd, file_size=file_size)
+
+            if copied < file_size:
+                # Kernel copy is not supported between these filesystems, continue with buffered copy
+                os.lseek(source_fd, copied, os.SEEK_SET)
+                out_file.seek(copied)
+                copy_fd_buffered(source_fd=source_fd, out_file=out_file, remaining=file_size - copied)
+
+        return file_size, file_hash.hexdigest(), file_hash.crc32
+    except Exception as e:
+        if os.path.exists(target):
+            os.remove(target)
+
+        raise e
+
+# Copies the file inside the kernel (copy_file_range, then sendfile), returns number of copied bytes (less than the size if neither is supported)
+def kernel_copy_file(source_fd: int, out_fd: int, file_size: int) -> int:
+    offset = 0
+
+    try:
+        while offset < file_size:
+            copied = os.copy_file_range(source_fd, out_fd, file_size - offset, offset, offset)
+
+            if copied == 0:
+                break
+
+            offset += copied
+
+        return offset
+    except (OSError, AttributeError):
+        pass # Not supported (for example different filesystems on older kernels), try sendfile from the same offset
+
+    try:
+        while offset < file_size:
+            os.lseek(out_fd, offset, os.SEEK_SET)
+            copied = os.sendfile(out_fd, source_fd, offset, file_size - offset)
+
+            if copied == 0:
+                break
+
+            offset += copied
+    except (OSError, AttributeError):
+        pass
+
+    return offset
+
+def copy_fd_buffered(source_fd: int, out_file, remaining: int):
+    buffer = bytearray(FILE_WRITE_BUFFER)
+    view = memoryview(buffer)
+
+    while remaining > 0:
+        read = os.readv(source_fd, [view[:min(remaining, FILE_WRITE_BUFFER)]])
+
+        if read == 0:
+            break
+
+        out_file.write(view[:read])
+        remaining -= read
+
+# Writes a (not file backed) file object with large preallocated buffer, returns its size, SHA-256 hash and CRC-32
+def copy_file_buffered(source: BinaryIO, target: str, max_file_size: int | None = MAX_FILE_SIZE) -> tuple[int, str, int]:
+    file_size = 0  # Initialize size tracker
+    file_hash = ContentHash()
+    buffer = bytearray(FILE_WRITE_BUFFER)
+    view = memoryview(buffer)
+
+    try:
+        with open(target, "wb") as out_file:
+            while read := source.readinto(buffer):
+                file_size += read  # Increment total size
+                check_file_size(file_size=file_size, max_file_size=max_file_size)
+
+                file_hash.update(view[:read])
+                out_file.write(view[:read])
+
+        return file_size, file_hash.hexdigest(), file_hash.crc32
+    except Exception as e:
+        if os.path.exists(target):
+            os.remove(target)
+
+        raise e
+
+def preallocate_file(fd: int, file_size: int):
+    if file_size > 0:
+        try:
+            os.posix_fallocate(fd, 0, file_size)
+        except (OSError, AttributeError):
+            pass # Filesystem does not support preallocation
+
+def get_content_store_path(content_hash: str) -> str:
+    return os.path.join(SAVE_DIR, "objects", content_hash[:2], content_hash)
+
+# Stores identical content only once - every file is a hardlink to an object in the content store (SAVE_DIR/objects), so the link count of an object is its reference count
+def deduplicate_file(file_path: str, content_hash: str):
+    object_path = get_content_store_path(content_hash=content_hash)
+
+    try:
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+
+        try:
+            os.link(file_path, object_path) # First time this content is seen, the saved file becomes the stored object
+        except FileExistsError:
+            # Content is already stored, replace the new copy with a hardlink to the existing object
+            temporary_link = f"{file_path}.link"
+            os.link(object_path, temporary_link)
+            os.replace(temporary_link, file_path)
+    except OSError as e:
+        # Hardlinks are not possible (for example content store is on a different filesystem), keep the separate copy
+        logger.warning("Could not deduplicate file '%s': %s", file_path, e)
+
+# Checks format of a SHA-256 content hash and returns it in lowercase (as it is stored)
+def check_content_hash(content_hash: str) -> str:
+    content_hash = content_hash.lower()
+
+    if re.fullmatch(r"[0-9a-f]{64}", content_hash) is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid SHA-256 hash! Must be 64 hexadecimal characters.")
+
+    return content_hash
+
+# Not deleted files of not deleted uploads with the given content
+async def get_files_with_content(session: AsyncSession, content_hash: str, limit: int | None = None) -> list[Files]:
+    statement = select(Files).join(Uploads, Uploads.id == Files.upload_id).where(Files.content_hash == content_hash, Files.deleted_at == None, Uploads.deleted_at == None).order_by(Files.id).limit(limit)
+    results = await session.exec(statement)
+
+    return results.all()
+
+# Links already stored content to target without receiving it again - hardlink to the object in the content store, copy of the existing file if hardlinks are not possible
+def link_stored_content(content_hash: str, file_path: str, target: str):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    for source in [get_content_store_path(content_hash=content_hash), file_path]:
+        try:
+            os.link(source, target)
+            return
+        except FileNotFoundError:
+            continue
+        except OSError:
+            shutil.copyfile(file_path, target)
+            return
+
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Stored content not found!")
+
+# Removes a saved file that has no database entry, its object in the content store is removed too when no other file links to it
+def remove_upload_file(file_path: str, content_hash: str):
+    try:
+        file_stat = os.stat(file_path)
+        os.remove(file_path)
+    except FileNotFoundError:
+        return
+
+    object_path = get_content_store_path(content_hash=content_hash)
+
+    try:
+        object_stat = os.stat(object_path)
+
+        if object_stat.st_ino == file_stat.st_ino and object_stat.st_nlink == 1:
+            os.remove(object_path)
+    except FileNotFoundError:
+        pass
 
 def save_file(file_path: str, data: bytes):
     try:
@@ -67,4 +615,313 @@ def save_file(file_path: str, data: bytes):
         with open(file_path, "wb") as file:
             file.write(data)
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
+
+# Returns the upload session if it belongs to the user (optionally locks the row until the transaction ends)
+async def get_owned_upload_session(session: AsyncSession, session_id: int, current_user: UserResponse, lock: bool = False) -> FileUploadSessions:
+    statement = select(FileUploadSessions).where(FileUploadSessions.id == session_id)
+
+    if lock:
+        statement = statement.with_for_update(nowait=True)
+
+    try:
+        results = await session.exec(statement)
+    except DBAPIError as e:
+        if getattr(e.orig, "sqlstate", None) != LOCK_NOT_AVAILABLE:
+            raise e
+
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session is being used by another request!")
+
+    upload_session = results.first()
+
+    if upload_session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found!")
+
+    if current_user.id != upload_session.created_by:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can access upload session!")
+
+    return upload_session
+
+# Strong ETag of a saved file - content hash if known (same content = same ETag), otherwise derived from the immutable database entry
+def get_file_etag(file: Files) -> str:
+    if file.content_hash:
+        return f'"{file.content_hash}"'
+
+    return make_etag(file.id, file.file_size, file.created_at)
+
+def make_etag(*parts) -> str:
+    return f'"{hashlib.sha256("-".join(str(part) for part in parts).encode()).hexdigest()[:32]}"'
+
+# Checks If-None-Match (preferred) or If-Modified-Since, so conditional requests can be answered without opening the file
+# last_modified is None for responses without a single modification time (only If-None-Match is checked)
+def is_not_modified(request: Request, etag: str, last_modified: float | None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+    if_modified_since = request.headers.get("if-modified-since")
+
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+# Range applies only if If-Range (when sent) still matches the current version of the file
+def is_range_valid(request: Request, etag: str, last_modified: float) -> bool:
+    if_range = request.headers.get("if-range")
+
+    if if_range is None:
+        return True
+
+    if_range = if_range.strip()
+
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag # Weak ETags never match (strong comparison)
+
+    try:
+        return int(last_modified) == int(parsedate_to_datetime(if_range).timestamp())
+    except (TypeError, ValueError):
+        return False
+
+# Parses 'bytes=0-99,200-,-50' into list of inclusive (start, end) ranges, returns None if no range is satisfiable
+# Unsatisfiable ranges ('-0', suffix of an empty file, start past the end) are left out, the rest of the set is still served
+def parse_range_header(range_header: str, file_size: int) -> list[tuple[int, int]] | None:
+    unit, _, ranges_specifier = range_header.partition("=")
+
+    if unit.strip().lower() != "bytes":
+        raise ValueError("Only 'bytes' range unit is supported!")
+
+    ranges = []
+
+    for range_specifier in ranges_specifier.split(","):
+        start, _, end = range_specifier.strip().partition("-")
+
+        # Only digits, int() would also accept signs and spaces
+        if not (start == "" or start.isdigit()) or not (end == "" or end.isdigit()):
+            raise ValueError("Invalid range!")
+
+        if start == "": # Suffix range - last N bytes
+            length = int(end)
+
+            if length == 0 or file_size == 0:
+                continue
+
+            ranges.append((max(file_size - length, 0), file_size - 1))
+        else:
+            start = int(start)
+
+            if end != "" and start > int(end):
+                raise ValueError("Invalid range!")
+
+            if start >= file_size:
+                continue
+
+            ranges.append((start, min(int(end), file_size - 1) if end != "" else file_size - 1))
+
+    if not ranges or len(ranges) > MAX_RANGES:
+        return None
+
+    return ranges
+
+async def iter_file_range(file, start: int, end: int, close: bool = True) -> AsyncIterator[bytes]:
+    try:
+        await file.seek(start)
+        remaining = end - start + 1
+
+        while remaining > 0:
+            content = await file.read(min(FILE_SERVE_CHUNK, remaining))
+
+            if not content:
+                break
+
+            remaining -= len(content)
+            yield content
+    finally:
+        if close:
+            await file.close()
+
+async def iter_multipart_ranges(file, ranges: list[tuple[int, int]], part_headers: list[bytes], boundary: str) -> AsyncIterator[bytes]:
+    try:
+        for (start, end), part_header in zip(ranges, part_headers):
+            yield part_header
+
+            async for content in iter_file_range(file=file, start=start, end=end, close=False):
+                yield content
+
+            yield b"\r\n"
+
+        yield f"--{boundary}--\r\n".encode()
+    finally:
+        await file.close()
+
+# Internal redirect for the reverse proxy, which then sends the file itself (including ranges) so no API worker is busy for the whole transfer
+def build_offload_response(file_path: str, media_type: str, headers: dict) -> Response:
+    file_path = os.path.abspath(file_path)
+    save_dir = os.path.abspath(SAVE_DIR)
+
+    # Only files from SAVE_DIR are reachable through the internal location
+    if os.path.commonpath([file_path, save_dir]) != save_dir:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="File is outside of SAVE_DIR!")
+
+    if FILE_SERVING_MODE == FileServingModes.X_ACCEL_REDIRECT.value:
+        headers = {**headers, "X-Accel-Redirect": FILE_SERVING_INTERNAL_PREFIX + quote(os.path.relpath(file_path, save_dir))}
+    elif FILE_SERVING_MODE == FileServingModes.X_SENDFILE.value:
+        headers = {**headers, "X-Sendfile": file_path}
+    else:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unknown file serving mode '{FILE_SERVING_MODE}'!")
+
+    return Response(media_type=media_type, headers=headers)
+
+# Serves a file with ETag, Last-Modified and Cache-Control headers, answers conditional requests (304) and byte ranges (206, including multiple ranges)
+async def build_file_response(request: Request, file_path: str, file_size: int, media_type: str, etag: str, last_modified: float, cache_control: str, download_filename: str | None = None) -> Response:
+    headers = {"ETag": etag, "Last-Modified": formatdate(float(last_modified), usegmt=True), "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+
+    if download_filename is not None:
+        headers["Content-Disposition"] = f"inline; filename*=utf-8''{quote(download_filename)}"
+
+    if is_not_modified(request=request, etag=etag, last_modified=last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if FILE_SERVING_MODE != FileServingModes.DIRECT.value:
+        return build_offload_response(file_path=file_path, media_type=media_type, headers=headers)
+
+    ranges = None
+    range_header = request.headers.get("range")
+
+    if range_header is not None and is_range_valid(request=request, etag=etag, last_modified=last_modified):
+        try:
+            ranges = parse_range_header(range_header=range_header, file_size=file_size)
+
+            if ranges is None:
+                return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={**headers, "Content-Range": f"bytes */{file_size}"})
+        except ValueError:
+            ranges = None # Invalid header is ignored (full response)
+
+    # File is opened only when its content is actually sent
+    try:
+        file = await aiofiles.open(file_path, "rb")
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found!")
+
+    if ranges is None:
+        return StreamingResponse(iter_file_range(file=file, start=0, end=file_size - 1), media_type=media_type, headers={**headers, "Content-Length": str(file_size)})
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        return StreamingResponse(iter_file_range(file=file, start=start, end=end), status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=media_type, headers={**headers, "Content-Range": f"bytes {start}-{end}/{file_size}", "Content-Length": str(end - start + 1)})
+
+    # Multiple ranges - multipart/byteranges
+    boundary = uuid.uuid4().hex
+    part_headers = [f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Range: bytes {start}-{end}/{file_size}\r\n\r\n".encode() for start, end in ranges]
+    content_length = sum(len(part_header) + (end - start + 1) + 2 for part_header, (start, end) in zip(part_headers, ranges)) + len(f"--{boundary}--\r\n")
+
+    return StreamingResponse(iter_multipart_ranges(file=file, ranges=ranges, part_headers=part_headers, boundary=boundary), status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=f"multipart/byteranges; boundary={boundary}", headers={**headers, "Content-Length": str(content_length)})
+
+# Serves a generated file (thumbnail, rendition, profile picture) - version is taken from the file's stat (no database entry exists for them)
+async def build_path_response(request: Request, file_path: str, cache_control: str, media_type: str | None = None, not_found_detail: str = "File not found!") -> Response:
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=not_found_detail)
+
+    if media_type is None:
+        media_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+
+    etag = make_etag(stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+
+    return await build_file_response(request=request, file_path=file_path, file_size=stat_result.st_size, media_type=media_type, etag=etag, last_modified=stat_result.st_mtime, cache_control=cache_control)
+
+# Bounded LRU cache of file_id -> location of a downloadable file (None for missing/deleted ids), entries expire after TTL
+# Cache is per process, entries are invalidated by ORM events in this process and by TTL for changes made by other processes
+class FileLocationCache:
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict() # file_id -> (expires_at, location)
+        self.hits = 0
+        self.misses = 0
+
+    # Returns (found, location), location is None for a cached missing file
+    def get(self, file_id: int) -> tuple[bool, dict | None]:
+        entry = self.entries.get(file_id)
+
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return False, None
+
+        self.entries.move_to_end(file_id)
+        self.hits += 1
+
+        return True, entry[1]
+
+    def set(self, file_id: int, location: dict | None):
+        if self.max_size <= 0:
+            return
+
+        ttl = self.ttl if location is not None else self.negative_ttl
+        self.entries[file_id] = (time.monotonic() + ttl, location)
+        self.entries.move_to_end(file_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, file_id: int):
+        self.entries.pop(file_id, None)
+
+    def invalidate_upload(self, upload_id: int):
+        for file_id in [file_id for file_id, (_, location) in self.entries.items() if location is not None and location["upload_id"] == upload_id]:
+            del self.entries[file_id]
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self) -> dict:
+        requests = self.hits + self.misses
+
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / requests if requests else 0.0}
+
+file_location_cache = FileLocationCache(max_size=FILE_LOCATION_CACHE_SIZE, ttl=FILE_LOCATION_CACHE_TTL, negative_ttl=FILE_LOCATION_CACHE_NEGATIVE_TTL)
+
+def get_file_location(file: Files) -> dict:
+    return {
+        "upload_id": file.upload_id,
+        "path": get_upload_file_path(upload_id=file.upload_id, generated_filename=file.generated_filename, file_ext=file.file_ext),
+        "size": file.file_size,
+        "mime": file.file_mime,
+        "etag": get_file_etag(file=file),
+        "last_modified": file.created_at,
+        "filename": f"{file.original_filename}.{file.file_ext}"
+    }
+
+# Location of a downloadable file (not deleted, upload not deleted), None if there is no such file
+async def get_cached_file_location(file_id: int) -> dict | None:
+    found, location = file_location_cache.get(file_id=file_id)
+
+    if found:
+        return location
+
+    async with async_session() as session:
+        statement = select(Files).join(Uploads, Uploads.id == Files.upload_id).where(Files.id == file_id, Files.deleted_at == None, Uploads.deleted_at == None)
+        results = await session.exec(statement)
+        file = results.first()
+
+    location = get_file_location(file=file) if file is not None else None
+    file_location_cache.set(file_id=file_id, location=location)
+
+    return location
+
+# Soft-delete (or any change of deleted_at) through the ORM removes cached locations
+@event.listens_for(Files, "after_update")
+def invalidate_file_location(mapper, connection, target: Files):
+    if inspect(target).attrs.deleted_at.history.has_changes():
+        file_location_cache.invalidate(file_id=target.id)
+
+@event.listens_for(Uploads, "after_update")
+def invalidate_upload_file_locations(mapper, connection, target: Uploads):
+    if inspect(target).attrs.deleted_at.history.has_changes():
+        file_location_cache.invalidate_upload(upload_id=target.id)
@@ -0,0 +1,22 @@
+# External imports
+from sqlmodel import Field, SQLModel, Column
+from decimal import Decimal
+from sqlalchemy.dialects.postgresql import JSONB
+
+# Internal imports
+from utils import current_timestamp
+from jobs.types import JobStatuses
+
+# Jobs are persisted in the database so they survive restarts and can be picked up by any API worker
+class Jobs(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True) # Id is optional because it is generated by the database (just leave it like that)
+    type: str = Field(index=True)
+    status: str = Field(default=JobStatuses.PENDING.value, index=True)
+    payload: dict = Field(sa_column=Column(JSONB))
+    result: dict | None = Field(default=None, sa_column=Column(JSONB)) # For example media info (duration, dimensions) found while generating a thumbnail
+    attempts: int = Field(default=0)
+    error: str | None = Field(default=None)
+    created_at: Decimal = Field(default_factory=current_timestamp)
+    run_after: Decimal | None = Field(default=None) # Retried job is not claimed before this time (backoff)
+    started_at: Decimal | None = Field(default=None)
+    finished_at: Decimal | None = Field(default=None)
@@ -0,0 +1,13 @@
+# External imports
+from enum import Enum
+
+class JobTypes(Enum):
+    UPLOAD_THUMBNAIL = "upload_thumbnail"
+    UPLOAD_RENDITIONS = "upload_renditions" # Downscaled file previews (and thumbnail renditions)
+    RENDITION_BACKFILL = "rendition_backfill" # Queues UPLOAD_RENDITIONS jobs for existing uploads
+
+class JobStatuses(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed" # Failed on all attempts
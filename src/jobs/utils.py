@@ -0,0 +1,278 @@
+# External imports
+from sqlmodel import select, update, or_, and_
+from sqlmodel.ext.asyncio.session import AsyncSession
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import os
+
+# Internal imports
+from database import async_session
+from jobs.models import Jobs
+from jobs.types import JobTypes, JobStatuses
+from uploads.models import Uploads
+from uploads.types import ThumbnailStatuses
+from uploads.utils import generate_upload_thumbnail, remove_temporary_thumbnail_sources, generate_upload_renditions, get_thumbnail_sources, get_rendition_files, get_upload_thumbnail_renditions_dir
+from files.models import Files
+from config import JOB_WORKERS, JOB_POLL_INTERVAL, JOB_TIMEOUT, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY, RENDITION_BACKFILL_BATCH_SIZE
+from utils import current_timestamp
+from cache import CacheEntities, invalidate_cache
+
+JOB_TIMEOUT_ERROR = "Timed out!"
+
+# Adds a new job to the session (job is queued when the session is committed, so it is part of the same transaction as the caller's changes)
+def add_job(session: AsyncSession, job_type: JobTypes, payload: dict) -> Jobs:
+    job = Jobs(type=job_type.value, payload=payload)
+    session.add(job)
+
+    return job
+
+# Queues thumbnail generation of an upload, sources are tried in order (see uploads.utils.generate_upload_thumbnail)
+def add_upload_thumbnail_job(session: AsyncSession, upload: Uploads, sources: list[dict]) -> Jobs | None:
+    if not sources:
+        upload.thumbnail_status = ThumbnailStatuses.NONE.value
+        session.add(upload)
+        return None
+
+    upload.thumbnail_status = ThumbnailStatuses.PENDING.value
+    session.add(upload)
+
+    return add_job(session=session, job_type=JobTypes.UPLOAD_THUMBNAIL, payload={"upload_id": upload.id, "sources": sources})
+
+# Queues creation of downscaled previews of the files (thumbnail renditions are created by the thumbnail job)
+def add_upload_renditions_job(session: AsyncSession, upload_id: int, files: list[Files]) -> Jobs | None:
+    rendition_files = get_rendition_files(files=files)
+
+    if not rendition_files:
+        return None
+
+    return add_job(session=session, job_type=JobTypes.UPLOAD_RENDITIONS, payload={"upload_id": upload_id, "files": rendition_files})
+
+# Queues thumbnail generation from newly added files when the upload does not have a thumbnail yet (for files added after the upload was created)
+async def add_missing_upload_thumbnail_job(session: AsyncSession, upload_id: int, files: list[Files]) -> Jobs | None:
+    statement = select(Uploads).where(Uploads.id == upload_id)
+    results = await session.exec(statement)
+    upload = results.first()
+
+    if upload is None or upload.thumbnail_status not in [ThumbnailStatuses.NONE.value, ThumbnailStatuses.FAILED.value]:
+        return None
+
+    sources = get_thumbnail_sources(files=files)
+
+    if not sources:
+        return None
+
+    return add_upload_thumbnail_job(session=session, upload=upload, sources=sources)
+
+# Queues jobs for files added to an existing upload (thumbnail if the upload does not have one yet and file previews)
+async def add_new_files_jobs(session: AsyncSession, upload_id: int, files: list[Files]):
+    await add_missing_upload_thumbnail_job(session=session, upload_id=upload_id, files=files)
+    add_upload_renditions_job(session=session, upload_id=upload_id, files=files)
+
+# Job that failed for good (after all attempts) - thumbnail of its upload is marked as failed and temporary sources are removed
+async def fail_upload_thumbnail_job(job: Jobs):
+    async with async_session() as session:
+        statement = update(Uploads).where(Uploads.id == job.payload["upload_id"]).values(thumbnail_status=ThumbnailStatuses.FAILED.value)
+        await session.execute(statement)
+        await session.commit()
+
+    remove_temporary_thumbnail_sources(sources=job.payload["sources"])
+    await invalidate_cache(CacheEntities.UPLOADS)
+
+# Claims the oldest pending job (whose retry delay passed) or a job left running for twice JOB_TIMEOUT (its worker crashed or the server was restarted,
+# a live worker gives up on the job itself after JOB_TIMEOUT)
+# SKIP LOCKED so multiple API workers never claim the same job, stale job that already used all attempts is failed instead of claimed
+async def claim_job() -> Jobs | None:
+    while True:
+        async with async_session() as session:
+            now = current_timestamp()
+            is_pending = and_(Jobs.status == JobStatuses.PENDING.value, or_(Jobs.run_after == None, Jobs.run_after <= now))
+            is_stale = and_(Jobs.status == JobStatuses.RUNNING.value, or_(Jobs.started_at == None, Jobs.started_at < now - 2 * JOB_TIMEOUT))
+            statement = select(Jobs).where(or_(is_pending, is_stale)).order_by(Jobs.id).limit(1).with_for_update(skip_locked=True)
+            results = await session.exec(statement)
+            job = results.first()
+
+            if job is None:
+                return None
+
+            if job.status == JobStatuses.RUNNING.value and job.attempts >= JOB_MAX_ATTEMPTS:
+                job.status = JobStatuses.FAILED.value
+                job.error = JOB_TIMEOUT_ERROR
+                job.finished_at = current_timestamp()
+
+                session.add(job)
+                await session.commit()
+
+                if job.type == JobTypes.UPLOAD_THUMBNAIL.value:
+                    await fail_upload_thumbnail_job(job=job)
+
+                continue
+
+            job.status = JobStatuses.RUNNING.value
+            job.started_at = current_timestamp()
+            job.attempts += 1
+
+            session.add(job)
+            await session.commit()
+
+            return job
+
+# Failed job is tried again unless it used all attempts or timed out - process of a timed out job keeps running in the pool until it
+# finishes (it cannot be stopped), a retry would most likely time out as well while taking another process
+def is_job_retried(job: Jobs, error: str | None) -> bool:
+    return error is not None and error != JOB_TIMEOUT_ERROR and job.attempts < JOB_MAX_ATTEMPTS
+
+# Runs the function in a process of the pool, error is JOB_TIMEOUT_ERROR when it does not finish in JOB_TIMEOUT
+async def run_in_executor(executor: ProcessPoolExecutor, function, *args):
+    loop = asyncio.get_running_loop()
+
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(executor, function, *args), timeout=JOB_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise TimeoutError(JOB_TIMEOUT_ERROR)
+
+def get_job_error(e: Exception) -> str:
+    if isinstance(e, TimeoutError) and str(e) == JOB_TIMEOUT_ERROR:
+        return JOB_TIMEOUT_ERROR
+
+    return f"{type(e).__name__}: {e}"
+
+# Finishes only the attempt the job was claimed with - a job that timed out and was claimed again by another worker is left to that worker
+# Retries are delayed by JOB_RETRY_DELAY doubled with every attempt
+async def finish_job(job: Jobs, error: str | None = None, result: dict | None = None):
+    run_after = None
+
+    if error is None:
+        job_status = JobStatuses.COMPLETED
+    elif is_job_retried(job=job, error=error):
+        job_status = JobStatuses.PENDING # Retry later
+        run_after = current_timestamp() + JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+    else:
+        job_status = JobStatuses.FAILED
+
+    async with async_session() as session:
+        statement = update(Jobs).where(Jobs.id == job.id, Jobs.status == JobStatuses.RUNNING.value, Jobs.attempts == job.attempts).values(status=job_status.value, error=error, result=result, run_after=run_after, finished_at=current_timestamp())
+        await session.execute(statement)
+        await session.commit()
+
+async def run_upload_thumbnail_job(job: Jobs, executor: ProcessPoolExecutor) -> tuple[str | None, dict | None]:
+    upload_id = job.payload["upload_id"]
+    error = None
+    media_info = None
+
+    try:
+        media_info = await run_in_executor(executor, generate_upload_thumbnail, upload_id, job.payload["sources"])
+        thumbnail_status = ThumbnailStatuses.READY if media_info is not None else ThumbnailStatuses.NONE
+    except Exception as e:
+        error = get_job_error(e)
+        thumbnail_status = ThumbnailStatuses.PENDING if is_job_retried(job=job, error=error) else ThumbnailStatuses.FAILED
+
+    async with async_session() as session:
+        statement = update(Uploads).where(Uploads.id == upload_id).values(thumbnail_status=thumbnail_status.value)
+        await session.execute(statement)
+        await session.commit()
+
+    if thumbnail_status != ThumbnailStatuses.PENDING:
+        remove_temporary_thumbnail_sources(sources=job.payload["sources"])
+
+    await invalidate_cache(CacheEntities.UPLOADS)
+
+    return error, media_info
+
+async def run_upload_renditions_job(job: Jobs, executor: ProcessPoolExecutor) -> tuple[str | None, dict | None]:
+    try:
+        result = await run_in_executor(executor, generate_upload_renditions, job.payload["upload_id"], job.payload["files"])
+
+        return None, result
+    except Exception as e:
+        return get_job_error(e), None
+
+# Goes through all uploads in batches (by id) and queues renditions of uploads that do not have them yet
+async def run_rendition_backfill_job(job: Jobs, executor: ProcessPoolExecutor) -> tuple[str | None, dict | None]:
+    last_upload_id = job.payload.get("last_upload_id", 0)
+    queued = 0
+
+    try:
+        while True:
+            async with async_session() as session:
+                statement = select(Uploads).where(Uploads.deleted_at == None, Uploads.id > last_upload_id).order_by(Uploads.id).limit(RENDITION_BACKFILL_BATCH_SIZE)
+                results = await session.exec(statement)
+                uploads = results.all()
+
+                if not uploads:
+                    break
+
+                missing_uploads = [upload for upload in uploads if not os.path.isdir(get_upload_thumbnail_renditions_dir(upload_id=upload.id))]
+
+                if missing_uploads:
+                    # Files of the whole batch in one query
+                    statement = select(Files).where(Files.upload_id.in_([upload.id for upload in missing_uploads]), Files.deleted_at == None).order_by(Files.upload_id, Files.id)
+                    results = await session.exec(statement)
+
+                    files_by_upload = {}
+                    for file in results.all():
+                        files_by_upload.setdefault(file.upload_id, []).append(file)
+
+                    for upload in missing_uploads:
+                        add_job(session=session, job_type=JobTypes.UPLOAD_RENDITIONS, payload={"upload_id": upload.id, "files": get_rendition_files(files=files_by_upload.get(upload.id, []))})
+                        queued += 1
+
+                last_upload_id = uploads[-1].id
+
+                # Progress is saved with the batch, so a retried backfill continues where it stopped
+                # started_at is refreshed so a long backfill is not taken for stale, the batch is dropped if the job was claimed again by another worker
+                statement = update(Jobs).where(Jobs.id == job.id, Jobs.status == JobStatuses.RUNNING.value, Jobs.attempts == job.attempts).values(payload={**job.payload, "last_upload_id": last_upload_id}, started_at=current_timestamp())
+                results = await session.execute(statement)
+
+                if results.rowcount == 0:
+                    await session.rollback()
+                    return "Claimed by another worker!", {"queued": queued, "last_upload_id": last_upload_id}
+
+                await session.commit()
+
+        return None, {"queued": queued, "last_upload_id": last_upload_id}
+    except Exception as e:
+        return f"{type(e).__name__}: {e}", {"queued": queued, "last_upload_id": last_upload_id}
+
+# Job handlers return the error message (None on success) and the result of the job
+job_handlers = {
+    JobTypes.UPLOAD_THUMBNAIL.value: run_upload_thumbnail_job,
+    JobTypes.UPLOAD_RENDITIONS.value: run_upload_renditions_job,
+    JobTypes.RENDITION_BACKFILL.value: run_rendition_backfill_job
+}
+
+async def run_job_worker(executor: ProcessPoolExecutor):
+    while True:
+        try:
+            job = await claim_job()
+
+            if job is None:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            handler = job_handlers.get(job.type)
+
+            if handler is None:
+                await finish_job(job=job, error=f"Unknown job type '{job.type}'!")
+                continue
+
+            error, result = await handler(job=job, executor=executor)
+            await finish_job(job=job, error=error, result=result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Job worker error: {e}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+# Starts the worker tasks, one task per process of the pool (jobs left running by a stopped/crashed server are claimed again once they time out, see claim_job)
+async def start_job_workers() -> tuple[ProcessPoolExecutor, list[asyncio.Task]]:
+    executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+    tasks = [asyncio.create_task(run_job_worker(executor=executor)) for _ in range(JOB_WORKERS)]
+
+    return executor, tasks
+
+async def stop_job_workers(executor: ProcessPoolExecutor, tasks: list[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -1,16 +1,23 @@
 # External imports
-from fastapi import APIRouter, HTTPException, Depends, status, Body
-from sqlmodel import Session, select
+from fastapi import APIRouter, HTTPException, Depends, status, Body, Request, Response, Query
+from fastapi.responses import StreamingResponse
+from sqlmodel import select, delete
 
 # Internal imports
-from database import engine
+from database import async_session
 from scatter_collections.models import Collections, CollectionCreate, CollectionResponse, UploadCollectionLinks
 from tags.models import TagCollectionLinks, Tags
 from uploads.models import Uploads, UploadResponse
+from files.models import Files
+from archives.types import ArchiveFormats
+from archives.utils import get_upload_archive_entries, get_archive_name, build_archive_response
 from users.utils import verify_authenticated_user
 from users.models import UserResponse
 from config import ANONYMOUS_USER
 from scatter_collections.types import CollectionPrivacy
+from cache import CacheEntities, cached_response, invalidate_cache
+from counts import TotalCountModes, get_total_count_headers
+from utils import build_sqlmodel_get_all_query, get_pagination_headers, check_ids_exist, insert_links
 
 collections_router = APIRouter()
 
@@ -19,9 +26,9 @@ async def new_collection(new_collection: CollectionCreate, current_user: UserRes
     if current_user.username == ANONYMOUS_USER and new_collection.privacy == CollectionPrivacy.PRIVATE: # Creating private collection is not allowed as anonymous user
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Creating private collection is not allowed as anonymous user!")
 
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Collections).where(Collections.title == new_collection.title)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         collection = results.first()
 
         if collection is not None:
@@ -30,27 +37,42 @@ async def new_collection(new_collection: CollectionCreate, current_user: UserRes
     # Create collection database entry
     new_collection = Collections(**new_collection.dict(), created_by=current_user.id)
     
-    with Session(engine) as session:
+    async with async_session() as session:
         db_collection = Collections.model_validate(new_collection)
         session.add(db_collection)
-        session.commit()
-        session.refresh(db_collection)
+        await session.commit()
+        await session.refresh(db_collection)
         new_collection = db_collection
 
+    await invalidate_cache(CacheEntities.COLLECTIONS)
+
     return new_collection
 
 @collections_router.get("/collections", tags=["collections"], response_model=list[CollectionResponse])
-async def get_all_collections():
-    with Session(engine) as session:
-        statement = select(Collections).where(Collections.deleted_at == None)
-        results = session.exec(statement)
-        return results.all()
+async def get_all_collections(request: Request, offset: int = 0, limit: int | None = 100, cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = None, order_by_direction: str | None = "asc", count: TotalCountModes | None = None):
+    total_count_headers = {}
+
+    async def build():
+        nonlocal total_count_headers
+
+        async with async_session() as session:
+            statement = build_sqlmodel_get_all_query(model=Collections, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, order_by_direction=order_by_direction)
+            results = await session.exec(statement)
+            collections = results.all()
+
+            if count is not None:
+                statement = build_sqlmodel_get_all_query(model=Collections, created_before=created_before, created_after=created_after, created_by=created_by)
+                total_count_headers = await get_total_count_headers(session=session, statement=statement, mode=count, model=Collections, created_by=created_by, cacheable=created_before is None and created_after is None)
+
+            return collections
+
+    return await cached_response(request=request, entities=[CacheEntities.COLLECTIONS], response_model=list[CollectionResponse], build=build, build_headers=lambda collections: {**get_pagination_headers(items=collections, limit=limit, order_by=order_by, order_by_direction=order_by_direction), **total_count_headers})
 
 @collections_router.get("/collections/{collection_id}", tags=["collections"], response_model=CollectionResponse)
 async def get_collection(collection_id: int):
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Collections).where(Collections.id == collection_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         collection = results.first()
 
         if collection is None:
@@ -60,180 +82,139 @@ async def get_collection(collection_id: int):
 
 @collections_router.post("/collections/{collection_id}/uploads", tags=["collections"], response_model=list[UploadCollectionLinks])
 async def add_uploads_to_collection(collection_id: int, upload_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
-    current_collection = None
-
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Collections).where(Collections.id == collection_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         collection = results.first()
 
         if collection is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Collection not found!")
-        else:
-            current_collection = collection
 
-    if current_user.id != current_collection.created_by and current_collection.privacy == CollectionPrivacy.PRIVATE:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add uploads to private collection!")
+        if current_user.id != collection.created_by and collection.privacy == CollectionPrivacy.PRIVATE.value:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add uploads to private collection!")
 
-    links = []
+        # All uploads are validated by one query and linked by one statement (already added uploads are skipped)
+        await check_ids_exist(session=session, model=Uploads, ids=upload_ids, name="Upload")
+        links = await insert_links(session=session, model=UploadCollectionLinks, links=[{"upload_id": upload_id, "collection_id": collection.id, "created_by": current_user.id} for upload_id in dict.fromkeys(upload_ids)])
+        await session.commit()
 
-    for upload_id in upload_ids:
-        with Session(engine) as session:
-            statement = select(Uploads).where(Uploads.id == upload_id)
-            results = session.exec(statement)
-            upload = results.first()
-
-            if upload is None:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Upload {upload_id} not found!")
-
-        with Session(engine) as session:
-            statement = select(UploadCollectionLinks).where(UploadCollectionLinks.upload_id == upload_id, UploadCollectionLinks.collection_id == current_collection.id)
-            results = session.exec(statement)
-            upload_collection_link = results.first()
-
-            if upload_collection_link is not None:
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Upload {upload_id} already added to collection {current_collection.id}!")
-
-    for upload_id in upload_ids:
-        upload_collection_link = UploadCollectionLinks(upload_id=upload_id, collection_id=collection_id, created_by=current_user.id)
-
-        with Session(engine) as session:
-            db_upload_collection_link = UploadCollectionLinks.model_validate(upload_collection_link)
-            session.add(db_upload_collection_link)
-            session.commit()
-            session.refresh(db_upload_collection_link)
-            upload_collection_link = db_upload_collection_link
-
-        links.append(upload_collection_link)
+    await invalidate_cache(CacheEntities.UPLOADS) # Embedded in uploads ('include')
 
     return links
 
 @collections_router.delete("/collections/{collection_id}/uploads", tags=["collections"], response_model=bool)
 async def remove_uploads_from_collection(collection_id: int, upload_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
-    current_collection = None
-
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Collections).where(Collections.id == collection_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         collection = results.first()
 
         if collection is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Collection not found!")
-        else:
-            current_collection = collection
 
-    if current_user.id != current_collection.created_by:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can remove uploads from collection! (Private or Public)")
+        if current_user.id != collection.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can remove uploads from collection! (Private or Public)")
 
-    for upload_id in upload_ids:
-        with Session(engine) as session:
-            statement = select(UploadCollectionLinks).where(UploadCollectionLinks.upload_id == upload_id, UploadCollectionLinks.collection_id == current_collection.id)
-            results = session.exec(statement)
-            upload_collection_link = results.first()
+        statement = delete(UploadCollectionLinks).where(UploadCollectionLinks.collection_id == collection.id, UploadCollectionLinks.upload_id.in_(upload_ids))
+        await session.execute(statement)
+        await session.commit()
 
-            if upload_collection_link is not None:
-                session.delete(upload_collection_link)
-                session.commit()
+    await invalidate_cache(CacheEntities.UPLOADS) # Embedded in uploads ('include')
 
     return True
 
 @collections_router.get("/collections/{collection_id}/uploads", tags=["collections"], response_model=list[UploadResponse])
-async def get_all_uploads_in_collection(collection_id: int):
-    uploads = []
+async def get_all_uploads_in_collection(response: Response, collection_id: int, offset: int = 0, limit: int | None = None, cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = None, order_by_direction: str | None = "asc", count: TotalCountModes | None = None):
+    forbidden_order_by = ["metadata_json", "metadata_type"]
 
-    with Session(engine) as session:
-        statement = select(UploadCollectionLinks).where(UploadCollectionLinks.collection_id == collection_id)
-        results = session.exec(statement)
+    # One query - uploads joined through their links
+    async with async_session() as session:
+        statement = build_sqlmodel_get_all_query(model=Uploads, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, forbidden_order_by=forbidden_order_by, order_by_direction=order_by_direction, additional_filters=[UploadCollectionLinks.collection_id == collection_id])
+        statement = statement.join(UploadCollectionLinks, UploadCollectionLinks.upload_id == Uploads.id)
+        results = await session.exec(statement)
+        uploads = results.all()
 
-        for upload_collection_link in results.all():
-            statement = select(Uploads).where(Uploads.id == upload_collection_link.upload_id)
-            results1 = session.exec(statement)
-            uploads.append(results1.first())
+        if count is not None:
+            statement = build_sqlmodel_get_all_query(model=Uploads, created_before=created_before, created_after=created_after, created_by=created_by, additional_filters=[UploadCollectionLinks.collection_id == collection_id])
+            statement = statement.join(UploadCollectionLinks, UploadCollectionLinks.upload_id == Uploads.id)
+            response.headers.update(await get_total_count_headers(session=session, statement=statement, mode=count))
 
-    return uploads
+    response.headers.update(get_pagination_headers(items=uploads, limit=limit, order_by=order_by, order_by_direction=order_by_direction))
 
-@collections_router.post("/collections/{collection_id}/tags", tags=["collections"], response_model=list[TagCollectionLinks])
-async def add_tags_to_collection(collection_id: int, tag_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
-    current_collection = None
+    return uploads
 
-    with Session(engine) as session:
-        statement = select(Collections).where(Collections.id == collection_id)
-        results = session.exec(statement)
+# Streams files of all uploads in the collection as one archive built on the fly (folder per upload)
+@collections_router.get("/collections/{collection_id}/archive", tags=["collections"], response_class=StreamingResponse)
+async def get_collection_archive(request: Request, collection_id: int, archive_format: ArchiveFormats = Query(default=ArchiveFormats.ZIP, alias="format")):
+    async with async_session() as session:
+        statement = select(Collections).where(Collections.id == collection_id, Collections.deleted_at == None)
+        results = await session.exec(statement)
         collection = results.first()
 
         if collection is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Collection not found!")
-        else:
-            current_collection = collection
 
-    if current_user.id != current_collection.created_by:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add tags to collection! (Private or Public)")
+        statement = select(Uploads).join(UploadCollectionLinks, UploadCollectionLinks.upload_id == Uploads.id).where(UploadCollectionLinks.collection_id == collection.id, Uploads.deleted_at == None).order_by(Uploads.id)
+        results = await session.exec(statement)
+        uploads = results.all()
+
+        # Files of all uploads in one query
+        statement = select(Files).where(Files.upload_id.in_([upload.id for upload in uploads]), Files.deleted_at == None).order_by(Files.upload_id, Files.id)
+        results = await session.exec(statement)
 
-    links = []
+        files_by_upload = {}
+        for file in results.all():
+            files_by_upload.setdefault(file.upload_id, []).append(file)
 
-    for tag_id in tag_ids:
-        with Session(engine) as session:
-            statement = select(Tags).where(Tags.id == tag_id)
-            results = session.exec(statement)
-            tag = results.first()
+    entries = []
 
-            if tag is None:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Tag {tag_id} not found!")
+    for upload in uploads:
+        entries += get_upload_archive_entries(upload=upload, files=files_by_upload.get(upload.id, []), prefix=f"{upload.id} - {get_archive_name(upload.title)}/")
 
-        with Session(engine) as session:
-            statement = select(TagCollectionLinks).where(TagCollectionLinks.tag_id == tag_id, TagCollectionLinks.collection_id == current_collection.id)
-            results = session.exec(statement)
-            tag_collection_link = results.first()
+    return await build_archive_response(request=request, entries=entries, archive_format=archive_format, archive_name=collection.title)
 
-            if tag_collection_link is not None:
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Tag {tag_id} already added to collection {current_collection.id}!")
+@collections_router.post("/collections/{collection_id}/tags", tags=["collections"], response_model=list[TagCollectionLinks])
+async def add_tags_to_collection(collection_id: int, tag_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
+    async with async_session() as session:
+        statement = select(Collections).where(Collections.id == collection_id)
+        results = await session.exec(statement)
+        collection = results.first()
 
-    for tag_id in tag_ids:
-        tag_collection_link = TagCollectionLinks(tag_id=tag_id, collection_id=current_collection.id, created_by=current_user.id)
+        if collection is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Collection not found!")
 
-        with Session(engine) as session:
-            db_tag_collection_link = TagCollectionLinks.model_validate(tag_collection_link)
-            session.add(db_tag_collection_link)
-            session.commit()
-            session.refresh(db_tag_collection_link)
-            tag_collection_link = db_tag_collection_link
+        if current_user.id != collection.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add tags to collection! (Private or Public)")
 
-        links.append(tag_collection_link)
+        # All tags are validated by one query and linked by one statement (already added tags are skipped)
+        await check_ids_exist(session=session, model=Tags, ids=tag_ids, name="Tag")
+        links = await insert_links(session=session, model=TagCollectionLinks, links=[{"tag_id": tag_id, "collection_id": collection.id, "created_by": current_user.id} for tag_id in dict.fromkeys(tag_ids)])
+        await session.commit()
 
     return links
 
 @collections_router.delete("/collections/{collection_id}/tags", tags=["collections"], response_model=bool)
 async def remove_tags_from_collection(collection_id: int, tag_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
-    current_collection = None
-
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Collections).where(Collections.id == collection_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         collection = results.first()
 
         if collection is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Collection not found!")
-        else:
-            current_collection = collection
-
-    if current_user.id != current_collection.created_by:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can remove tags from collection! (Private or Public)")
 
-    for tag_id in tag_ids:
-        with Session(engine) as session:
-            statement = select(TagCollectionLinks).where(TagCollectionLinks.tag_id == tag_id, TagCollectionLinks.collection_id == current_collection.id)
-            results = session.exec(statement)
-            tag_collection_link = results.first()
+        if current_user.id != collection.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can remove tags from collection! (Private or Public)")
 
-            if tag_collection_link is not None:
-                session.delete(tag_collection_link)
-                session.commit()
+        statement = delete(TagCollectionLinks).where(TagCollectionLinks.collection_id == collection.id, TagCollectionLinks.tag_id.in_(tag_ids))
+        await session.execute(statement)
+        await session.commit()
 
     return True
 
 @collections_router.get("/collections/{collection_id}/tags", tags=["collections"], response_model=list[TagCollectionLinks])
 async def get_all_tags_of_collection(collection_id: int):
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(TagCollectionLinks).where(TagCollectionLinks.collection_id == collection_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         return results.all()
\ No newline at end of file
@@ -33,6 +33,12 @@ class TagCollectionLinks(SQLModel, table=True):
 
 class TagUploadLinks(SQLModel, table=True):
     tag_id: int | None = Field(default=None, foreign_key="tags.id", primary_key=True)
-    upload_id: int | None = Field(default=None, foreign_key="uploads.id", primary_key=True)
+    upload_id: int | None = Field(default=None, foreign_key="uploads.id", primary_key=True, index=True) # Primary key index starts with tag_id, this one is for lookups by upload
     created_at: Decimal = Field(default_factory=current_timestamp)
-    created_by: int = Field(foreign_key="users.id")
\ No newline at end of file
+    created_by: int = Field(foreign_key="users.id")
+
+# Number of not deleted uploads linked to the tag, kept up to date by the endpoints that add or remove links and on soft-delete of uploads (see tags.utils)
+# Tag facets of all uploads are read from here instead of counting the links
+class TagUploadCounts(SQLModel, table=True):
+    tag_id: int = Field(foreign_key="tags.id", primary_key=True)
+    upload_count: int = Field(default=0)
@@ -1,15 +1,18 @@
 # External imports
-from fastapi import APIRouter, HTTPException, Depends, status
-from sqlmodel import Session, select
+from fastapi import APIRouter, HTTPException, Depends, status, Request, Response
+from sqlmodel import select
 
 # Internal imports
-from database import engine
+from database import async_session
 from tags.models import Tags, TagCreate, TagResponse, TagCollectionLinks, TagUploadLinks
 from scatter_collections.models import CollectionResponse, Collections
 from uploads.models import Uploads, UploadResponse
 from users.utils import verify_authenticated_user
 from users.models import UserResponse
 from config import ANONYMOUS_USER
+from cache import CacheEntities, cached_response, invalidate_cache
+from counts import TotalCountModes, get_total_count_headers
+from utils import build_sqlmodel_get_all_query, get_pagination_headers
 
 tags_router = APIRouter()
 
@@ -18,9 +21,9 @@ async def new_tag(new_tag: TagCreate, current_user: UserResponse = Depends(verif
     if current_user.username == ANONYMOUS_USER:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Cannot create new tag as anonymous user!")
 
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Tags).where(Tags.name == new_tag.name)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         tag = results.first()
 
         if tag is not None:
@@ -28,27 +31,42 @@ async def new_tag(new_tag: TagCreate, current_user: UserResponse = Depends(verif
     
     new_tag = Tags(**new_tag.dict(), created_by=current_user.id)
 
-    with Session(engine) as session:
+    async with async_session() as session:
         db_tag = Tags.model_validate(new_tag)
         session.add(db_tag)
-        session.commit()
-        session.refresh(db_tag)
+        await session.commit()
+        await session.refresh(db_tag)
         new_tag = db_tag
 
+    await invalidate_cache(CacheEntities.TAGS)
+
     return new_tag
 
 @tags_router.get("/tags", tags=["tags"], response_model=list[TagResponse])
-async def get_all_tags():
-    with Session(engine) as session:
-        statement = select(Tags).where(Tags.deleted_at == None)
-        results = session.exec(statement)
-        return results.all()
+async def get_all_tags(request: Request, offset: int = 0, limit: int | None = 100, cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = None, order_by_direction: str | None = "asc", count: TotalCountModes | None = None):
+    total_count_headers = {}
+
+    async def build():
+        nonlocal total_count_headers
+
+        async with async_session() as session:
+            statement = build_sqlmodel_get_all_query(model=Tags, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, order_by_direction=order_by_direction)
+            results = await session.exec(statement)
+            tags = results.all()
+
+            if count is not None:
+                statement = build_sqlmodel_get_all_query(model=Tags, created_before=created_before, created_after=created_after, created_by=created_by)
+                total_count_headers = await get_total_count_headers(session=session, statement=statement, mode=count, model=Tags, created_by=created_by, cacheable=created_before is None and created_after is None)
+
+            return tags
+
+    return await cached_response(request=request, entities=[CacheEntities.TAGS], response_model=list[TagResponse], build=build, build_headers=lambda tags: {**get_pagination_headers(items=tags, limit=limit, order_by=order_by, order_by_direction=order_by_direction), **total_count_headers})
 
 @tags_router.get("/tags/{tag_id}", tags=["tags"], response_model=TagResponse)
 async def get_tag(tag_id: int):
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Tags).where(Tags.id == tag_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         tag = results.first()
 
         if tag is None:
@@ -57,31 +75,39 @@ async def get_tag(tag_id: int):
         return tag
 
 @tags_router.get("/tags/{tag_id}/collections", tags=["tags"], response_model=list[CollectionResponse])
-async def get_all_collections_with_tag(tag_id: int):
-    collections = []
-
-    with Session(engine) as session:
-        statement = select(TagCollectionLinks).where(TagCollectionLinks.tag_id == tag_id)
-        results = session.exec(statement)
-        
-        for tag_collection_link in results.all():
-            statement = select(Collections).where(Collections.id == tag_collection_link.collection_id)
-            results1 = session.exec(statement)
-            collections.append(results1.first())
+async def get_all_collections_with_tag(response: Response, tag_id: int, offset: int = 0, limit: int | None = None, cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = None, order_by_direction: str | None = "asc", count: TotalCountModes | None = None):
+    # One query - collections joined through their links
+    async with async_session() as session:
+        statement = build_sqlmodel_get_all_query(model=Collections, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, order_by_direction=order_by_direction, additional_filters=[TagCollectionLinks.tag_id == tag_id])
+        statement = statement.join(TagCollectionLinks, TagCollectionLinks.collection_id == Collections.id)
+        results = await session.exec(statement)
+        collections = results.all()
+
+        if count is not None:
+            statement = build_sqlmodel_get_all_query(model=Collections, created_before=created_before, created_after=created_after, created_by=created_by, additional_filters=[TagCollectionLinks.tag_id == tag_id])
+            statement = statement.join(TagCollectionLinks, TagCollectionLinks.collection_id == Collections.id)
+            response.headers.update(await get_total_count_headers(session=session, statement=statement, mode=count))
+
+    response.headers.update(get_pagination_headers(items=collections, limit=limit, order_by=order_by, order_by_direction=order_by_direction))
 
     return collections
 
 @tags_router.get("/tags/{tag_id}/uploads", tags=["tags"], response_model=list[UploadResponse])
-async def get_all_uploads_with_tag(tag_id: int):
-    uploads = []
-
-    with Session(engine) as session:
-        statement = select(TagUploadLinks).where(TagUploadLinks.tag_id == tag_id)
-        results = session.exec(statement)
-        
-        for tag_upload_link in results.all():
-            statement = select(Uploads).where(Uploads.id == tag_upload_link.upload_id)
-            results1 = session.exec(statement)
-            uploads.append(results1.first())
+async def get_all_uploads_with_tag(response: Response, tag_id: int, offset: int = 0, limit: int | None = None, cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = None, order_by_direction: str | None = "asc", count: TotalCountModes | None = None):
+    forbidden_order_by = ["metadata_json", "metadata_type"]
+
+    # One query - uploads joined through their links
+    async with async_session() as session:
+        statement = build_sqlmodel_get_all_query(model=Uploads, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, forbidden_order_by=forbidden_order_by, order_by_direction=order_by_direction, additional_filters=[TagUploadLinks.tag_id == tag_id])
+        statement = statement.join(TagUploadLinks, TagUploadLinks.upload_id == Uploads.id)
+        results = await session.exec(statement)
+        uploads = results.all()
+
+        if count is not None:
+            statement = build_sqlmodel_get_all_query(model=Uploads, created_before=created_before, created_after=created_after, created_by=created_by, additional_filters=[TagUploadLinks.tag_id == tag_id])
+            statement = statement.join(TagUploadLinks, TagUploadLinks.upload_id == Uploads.id)
+            response.headers.update(await get_total_count_headers(session=session, statement=statement, mode=count))
+
+    response.headers.update(get_pagination_headers(items=uploads, limit=limit, order_by=order_by, order_by_direction=order_by_direction))
 
     return uploads
\ No newline at end of file
@@ -0,0 +1,42 @@
+# External imports
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.postgresql import insert
+from collections import Counter
+
+# Internal imports
+from tags.models import TagUploadLinks, TagUploadCounts
+from uploads.models import Uploads
+
+# Statement adding delta to the counters of the tags, tags are updated in order of their ids so concurrent updates cannot deadlock
+def get_update_tag_upload_counts_statement(tag_ids: list[int], delta: int):
+    counts = Counter(tag_ids)
+
+    statement = insert(TagUploadCounts).values([{"tag_id": tag_id, "upload_count": count * delta} for tag_id, count in sorted(counts.items())])
+
+    return statement.on_conflict_do_update(index_elements=[TagUploadCounts.tag_id], set_={"upload_count": TagUploadCounts.upload_count + statement.excluded.upload_count})
+
+# Adds delta (1 for added links, -1 for removed links) to the counters of the tags, call in the same transaction as the change of the links
+# Links of deleted uploads are not counted - the endpoints change links only of not deleted uploads
+async def update_tag_upload_counts(session: AsyncSession, tag_ids: list[int], delta: int):
+    if tag_ids:
+        await session.execute(get_update_tag_upload_counts_statement(tag_ids=tag_ids, delta=delta))
+
+# Soft-delete of an upload removes it from the counters of its tags, restoring (deleted_at set back to None) adds it back
+def update_tag_upload_counts_on_update(mapper, connection, target: Uploads):
+    history = inspect(target).attrs.deleted_at.history
+
+    if not history.has_changes():
+        return
+
+    was_deleted = bool(history.deleted) and history.deleted[0] is not None
+    is_deleted = target.deleted_at is not None
+
+    if was_deleted != is_deleted:
+        tag_ids = connection.execute(select(TagUploadLinks.tag_id).where(TagUploadLinks.upload_id == target.id)).scalars().all()
+
+        if tag_ids:
+            connection.execute(get_update_tag_upload_counts_statement(tag_ids=tag_ids, delta=-1 if is_deleted else 1))
+
+event.listen(Uploads, "after_update", update_tag_upload_counts_on_update)
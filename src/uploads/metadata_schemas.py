@@ -1,6 +1,9 @@
 # External imports
 from enum import Enum
 
+# Fields marked with "x-sortable" can be used in 'order_by' of '/uploads' and get an expression index (see uploads.models), unknown keywords are ignored by jsonschema
+# Fields marked with "x-searchable" (value is the weight: A - highest, D - lowest) are part of the full-text search document of an upload
+
 # Enum to define different schema types
 class MetadataTypes(str, Enum):
     REDDIT = "reddit"
@@ -10,9 +13,9 @@ class MetadataTypes(str, Enum):
 reddit_schema = {
     "type": "object",
     "properties": {
-        "author": {"type": ["string", "null"]},
+        "author": {"type": ["string", "null"], "x-sortable": True},
         "author_flair_text": {"type": ["string", "null"]},
-        "created_utc": {"type": "number"},
+        "created_utc": {"type": "number", "x-sortable": True},
         "distinguished": {"type": ["string", "null"]},
         "edited": {"type": ["number", "null"]},
         "id": {"type": "string"},
@@ -22,16 +25,16 @@ reddit_schema = {
         "link_flair_text": {"type": ["string", "null"]},
         "locked": {"type": "boolean"},
         "name": {"type": "string"},
-        "num_comments": {"type": "integer"},
+        "num_comments": {"type": "integer", "x-sortable": True},
         "over_18": {"type": "boolean"},
         "permalink": {"type": "string"},
-        "score": {"type": "integer"},
-        "selftext": {"type": ["string", "null"]},
+        "score": {"type": "integer", "x-sortable": True},
+        "selftext": {"type": ["string", "null"], "x-searchable": "D"},
         "spoiler": {"type": "boolean"},
         "stickied": {"type": "boolean"},
-        "subreddit": {"type": "string"},
-        "title": {"type": "string"},
-        "upvote_ratio": {"type": "number"},
+        "subreddit": {"type": "string", "x-sortable": True, "x-searchable": "B"},
+        "title": {"type": "string", "x-sortable": True},
+        "upvote_ratio": {"type": "number", "x-sortable": True},
         "url": {"type": "string"}
     },
     "required": [
@@ -48,7 +51,7 @@ nhentai_schema = {
             "type": "object",
             "properties": {
                 "before": {"type": ["string", "null"]},
-                "pretty": {"type": "string"},
+                "pretty": {"type": "string", "x-sortable": True, "x-searchable": "B"},
                 "after": {"type": ["string", "null"]}
             },
             "required": ["pretty"]
@@ -57,7 +60,7 @@ nhentai_schema = {
             "type": "object",
             "properties": {
                 "before": {"type": ["string", "null"]},
-                "pretty": {"type": ["string", "null"]},
+                "pretty": {"type": ["string", "null"], "x-searchable": "B"},
                 "after": {"type": ["string", "null"]}
             },
         },
@@ -72,7 +75,8 @@ nhentai_schema = {
         },
         "tags": {
             "type": "array",
-            "items": {"type": "string"}
+            "items": {"type": "string"},
+            "x-searchable": "C"
         },
         "artists": {
             "type": "array",
@@ -90,8 +94,8 @@ nhentai_schema = {
             "type": "array",
             "items": {"type": "string"}
         },
-        "pages": {"type": "integer"},
-        "uploaded": {"type": "number"}
+        "pages": {"type": "integer", "x-sortable": True},
+        "uploaded": {"type": "number", "x-sortable": True}
     },
     "required": [
         "title1", "title2", "id", "parodies", "characters", "tags", 
@@ -103,4 +107,32 @@ nhentai_schema = {
 metadata_schemas = {
     MetadataTypes.REDDIT: reddit_schema,
     MetadataTypes.NHENTAI: nhentai_schema
-}
\ No newline at end of file
+}
+
+# Returns paths (list of keys) and schemas of all fields marked with the keyword (for example "x-sortable")
+def get_marked_metadata_fields(schema: dict, mark: str, path: list[str] = []) -> list[tuple[list[str], dict]]:
+    fields = []
+
+    for key, field_schema in schema.get("properties", {}).items():
+        if field_schema.get(mark):
+            fields.append((path + [key], field_schema))
+
+        fields += get_marked_metadata_fields(schema=field_schema, mark=mark, path=path + [key])
+
+    return fields
+
+def is_numeric_metadata_field(field_schema: dict) -> bool:
+    field_types = field_schema.get("type")
+    field_types = field_types if isinstance(field_types, list) else [field_types]
+
+    return "number" in field_types or "integer" in field_types
+
+# SQL expression of a metadata field (text, numeric fields are cast so they are ordered as numbers)
+# Keys are written as literals (not parameters) and the same expression is used for the indexes and the queries, so the planner can match them
+def get_metadata_expression(path: list[str], field_schema: dict) -> str:
+    expression = "metadata_json" + "".join(f"->'{key}'" for key in path[:-1]) + f"->>'{path[-1]}'"
+
+    if is_numeric_metadata_field(field_schema):
+        return f"CAST({expression} AS NUMERIC)"
+
+    return expression
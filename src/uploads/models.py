@@ -1,10 +1,18 @@
 # External imports
 from sqlmodel import Field, SQLModel, Column
 from decimal import Decimal
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import Index, Computed, text
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 
 # Internal imports
 from utils import current_timestamp
+from uploads.types import ThumbnailStatuses
+from uploads.metadata_schemas import metadata_schemas, get_marked_metadata_fields, get_metadata_expression
+from files.models import FileResponse
+from tags.models import TagResponse, TagUploadLinks
+from scatter_collections.models import CollectionResponse, UploadCollectionLinks
+from users.models import UserResponse
+from config import SEARCH_TEXT_CONFIG
 
 class UploadBase(SQLModel):
     title: str = Field(index=True, unique=True)
@@ -15,11 +23,50 @@ class Uploads(UploadBase, table=True):
     type: str
     metadata_type: str | None = Field(default=None)
     metadata_json: dict | None = Field(sa_column=Column(JSONB))
+    thumbnail_status: str = Field(default=ThumbnailStatuses.NONE.value)
     created_by: int = Field(foreign_key="users.id")
     created_at: Decimal = Field(default_factory=current_timestamp)
     updated_at: Decimal = Field(default_factory=current_timestamp)
     deleted_at: Decimal | None = Field(default=None)
 
+# GIN index for 'metadata_contains' (@>) and 'metadata_path' (@@) filters, jsonb_path_ops is smaller and faster than the default but supports only these operators
+Index("ix_uploads_metadata_json", Uploads.__table__.c.metadata_json, postgresql_using="gin", postgresql_ops={"metadata_json": "jsonb_path_ops"})
+
+# Expression index for every sortable metadata field, partial by metadata type (ordering by metadata requires 'filter_by_metadata'), id is the tie-breaker of the order
+def add_metadata_indexes():
+    for metadata_type, schema in metadata_schemas.items():
+        for path, field_schema in get_marked_metadata_fields(schema=schema, mark="x-sortable"):
+            expression = get_metadata_expression(path=path, field_schema=field_schema)
+            Index(f"ix_uploads_metadata_{metadata_type.value}_{'_'.join(path)}", text(f"({expression})"), Uploads.__table__.c.id, postgresql_where=Uploads.__table__.c.metadata_type == metadata_type.value)
+
+add_metadata_indexes()
+
+# Weighted full-text document of an upload - title (A), description (B) and metadata fields marked with "x-searchable" (with their weight)
+def get_upload_search_vector_expression() -> str:
+    text_config = f"'{SEARCH_TEXT_CONFIG}'::regconfig"
+    parts = [f"setweight(to_tsvector({text_config}, coalesce(title, '')), 'A')", f"setweight(to_tsvector({text_config}, coalesce(description, '')), 'B')"]
+    paths = []
+
+    for schema in metadata_schemas.values():
+        for path, field_schema in get_marked_metadata_fields(schema=schema, mark="x-searchable"):
+            if path in paths: # Same field in multiple schemas
+                continue
+
+            paths.append(path)
+            weight = field_schema["x-searchable"]
+
+            if field_schema.get("type") == "array":
+                expression = "metadata_json" + "".join(f"->'{key}'" for key in path)
+                parts.append(f"setweight(jsonb_to_tsvector({text_config}, coalesce({expression}, '[]'::jsonb), '[\"string\"]'), '{weight}')")
+            else:
+                parts.append(f"setweight(to_tsvector({text_config}, coalesce({get_metadata_expression(path=path, field_schema=field_schema)}, '')), '{weight}')")
+
+    return " || ".join(parts)
+
+# Stored generated column, so the document is computed once on write - it is not mapped to the model (never selected with uploads or written by inserts), use 'Uploads.__table__.c.search_vector'
+Uploads.__table__.append_column(Column("search_vector", TSVECTOR, Computed(get_upload_search_vector_expression(), persisted=True)))
+Index("ix_uploads_search_vector", Uploads.__table__.c.search_vector, postgresql_using="gin")
+
 class UploadCreate(UploadBase):
     pass
 
@@ -28,6 +75,29 @@ class UploadResponse(UploadBase):
     type: str
     metadata_type: str | None
     metadata_json: dict | None
+    thumbnail_status: str
     created_by: int
     created_at: Decimal
-    updated_at: Decimal
\ No newline at end of file
+    updated_at: Decimal
+
+# Upload with related resources requested by 'include' (only the requested fields are returned)
+class UploadDetailResponse(UploadResponse):
+    files: list[FileResponse] | None = None
+    tags: list[TagResponse] | None = None
+    collections: list[CollectionResponse] | None = None
+    creator: UserResponse | None = None
+
+# Upload found by '/uploads/search', headline is the title and description with matched words highlighted
+class UploadSearchResponse(UploadResponse):
+    rank: float
+    headline: str | None = None
+
+# Links every upload to every tag and collection
+class UploadLinksCreate(SQLModel):
+    upload_ids: list[int]
+    tag_ids: list[int] = []
+    collection_ids: list[int] = []
+
+class UploadLinksResponse(SQLModel):
+    tag_links: list[TagUploadLinks] # Only newly created links (already existing ones are skipped)
+    collection_links: list[UploadCollectionLinks]
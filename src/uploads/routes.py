@@ -1,30 +1,51 @@
 # External imports
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, Form, status, Body
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, Form, status, Body, Query, Request, Header
 import os
 from collections import Counter
-from sqlmodel import Session, select, desc, asc, text
-from fastapi.responses import FileResponse
+from sqlmodel import select, delete
+from sqlalchemy import literal_column, text, cast, func, Numeric, String, Float
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.exc import DBAPIError
+from fastapi.responses import FileResponse as FileResponseFastAPI, JSONResponse, StreamingResponse, Response
+import aiofiles
+import asyncio
+import hashlib
+import mimetypes
+import uuid
 import json
+import re
 from jsonschema import validate, ValidationError
-from io import BytesIO
 
 # Internal imports
-from uploads.models import Uploads, UploadResponse
+from uploads.models import Uploads, UploadResponse, UploadDetailResponse, UploadSearchResponse, UploadLinksCreate, UploadLinksResponse
 from users.models import UserResponse
 from users.utils import verify_authenticated_user
-from files.utils import create_file, save_file
-from database import engine
-from uploads.metadata_schemas import MetadataTypes, metadata_schemas
-from uploads.utils import create_upload_thumbnail
-from config import SAVE_DIR
+from files.utils import create_files, save_file, stream_save_file, stream_save_request, get_file_name_and_ext, get_upload_file_path, insert_upload_file, build_path_response, make_etag, is_not_modified, check_content_hash, get_files_with_content, link_stored_content
+from files.models import Files, FileResponse
+from database import async_session
+from uploads.metadata_schemas import MetadataTypes, metadata_schemas, get_marked_metadata_fields, get_metadata_expression, is_numeric_metadata_field
+from uploads.utils import build_search_query, get_metadata_type_filter, get_upload_tag_filters, get_upload_tag_facets, parse_upload_includes, load_upload_includes, validate_user_thumbnail, get_thumbnail_sources, get_upload_thumbnail_path, get_upload_thumbnail_paths, get_sprite_path, create_sprite_sheet, load_sprite_map, evict_sprite_sheets
+from uploads.types import ThumbnailStatuses, RenditionFormats, ThumbnailBatchLayouts, UploadIncludes
+from users.types import UserRoles
+from jobs.utils import add_job, add_upload_thumbnail_job, add_upload_renditions_job, add_new_files_jobs
+from jobs.types import JobTypes
+from jobs.models import Jobs
+from archives.types import ArchiveFormats
+from archives.utils import get_upload_archive_entries, build_archive_response
+from config import SAVE_DIR, MAX_FILE_SIZE, THUMBNAIL_CACHE_CONTROL, FILE_CACHE_CONTROL, MAX_THUMBNAIL_BATCH, SPRITE_TILE_HEIGHT, SEARCH_TEXT_CONFIG, MAX_SEARCH_LIMIT
 from tags.models import Tags, TagUploadLinks
-from utils import build_sqlmodel_get_all_query
+from scatter_collections.models import Collections, UploadCollectionLinks
+from scatter_collections.types import CollectionPrivacy
+from utils import build_sqlmodel_get_all_query, get_pagination_headers, parse_id_list, check_ids_exist, insert_links
+from cache import CacheEntities, cached_response, invalidate_cache
+from counts import TotalCountModes, get_total_count_headers
+from tags.utils import update_tag_upload_counts
 
 uploads_router = APIRouter()
 
 @uploads_router.post("/uploads", tags=["uploads"], response_model=UploadResponse)
 async def new_upload(
-    files: list[UploadFile],
+    files: list[UploadFile] | None = None, # Can be omitted when files are sent later through resumable upload sessions ('/files/sessions')
     thumbnail: UploadFile | None = None,
     metadata_type: MetadataTypes | None = Form(default=None),
     metadata_json: str | None = Form(default=None),
@@ -32,12 +53,15 @@ async def new_upload(
     description: str | None = Form(default=None),
     current_user: UserResponse = Depends(verify_authenticated_user)):
 
+    if thumbnail is not None:
+        validate_user_thumbnail(file=thumbnail)
+
     if (metadata_type is None) != (metadata_json is None): # Same as (metadata_type is None and metadata_json is not None) or (metadata_type is not None and metadata_json is None)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="When uploading metadata, define both 'metadata_type' and 'metadata_json'! If not uploading metadata do not define either of them!")
 
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Uploads).where(Uploads.title == title)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         upload = results.first()
 
         if upload is not None:
@@ -67,35 +91,43 @@ async def new_upload(
     else:
         metadata_json_validated = None
 
+    if files is None:
+        files = []
+
     # Get the most common primary mime type
     primary_mimes = [file.content_type.split('/')[0] for file in files]
     primary_mime_counts = Counter(primary_mimes)
-    most_common_mime = primary_mime_counts.most_common(1)[0][0]
+    most_common_mime = primary_mime_counts.most_common(1)[0][0] if primary_mime_counts else "unknown" # Files will be added through upload sessions
 
     # Create upload database entry
     new_upload = Uploads(title=title, description=description, type=most_common_mime, metadata_type=metadata_type, metadata_json=metadata_json_validated, created_by=current_user.id)
     
-    with Session(engine) as session:
+    async with async_session() as session:
         db_upload = Uploads.model_validate(new_upload)
         session.add(db_upload)
-        session.commit()
-        session.refresh(db_upload)
+        await session.commit()
+        await session.refresh(db_upload)
         new_upload = db_upload
 
-    # Save all the files
-    for index, file in enumerate(files):
-        await create_file(file=file, upload_id=new_upload.id, filename=str(index), created_by=current_user.id)
+    # Save all the files (concurrently) and create their database entries in one transaction
+    db_files = await create_files(files=files, upload_id=new_upload.id, created_by=current_user.id)
+
+    # Queue thumbnail generation (done by background job workers so decoding media does not slow down the upload)
+    thumbnail_sources = []
 
-    # Generate thumbnail
     if thumbnail is not None:
-        create_upload_thumbnail(file=thumbnail, upload_id=new_upload.id, is_user_uploaded=True)
-    else:
-        for file in files:
-            await file.seek(0) # Always seek to 0 before reading a file
-            generation_success = create_upload_thumbnail(file=file, upload_id=new_upload.id)
+        thumbnail_ext = os.path.splitext(thumbnail.filename)[1]
+        thumbnail_source_path = os.path.join(SAVE_DIR, "uploads", str(new_upload.id), f"thumbnail_source{thumbnail_ext}")
+        await stream_save_file(file=thumbnail, target=thumbnail_source_path)
+        thumbnail_sources.append({"path": thumbnail_source_path, "mime": thumbnail.content_type, "temporary": True})
+
+    # Uploaded files are fallback when user uploaded thumbnail cannot be used
+    thumbnail_sources += get_thumbnail_sources(files=db_files)
 
-            if generation_success:
-                break
+    async with async_session() as session:
+        add_upload_thumbnail_job(session=session, upload=new_upload, sources=thumbnail_sources)
+        add_upload_renditions_job(session=session, upload_id=new_upload.id, files=db_files)
+        await session.commit()
 
     # Save backup metadata
     if metadata_json_validated is not None:
@@ -103,171 +135,506 @@ async def new_upload(
 
         save_file(file_path=os.path.join(SAVE_DIR, "uploads", str(new_upload.id), "metadata.json"), data=json_data)
 
+    await invalidate_cache(CacheEntities.UPLOADS)
+
     return new_upload
 
-@uploads_router.get("/uploads", tags=["uploads"], response_model=list[UploadResponse])
-async def get_all_uploads(offset: int = 0, limit: int | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, filter_by_metadata: str | None = None, order_by: str | None = None, order_by_direction: str | None = "asc"):
+# Queues a background job that creates renditions (thumbnail sizes and file previews) for existing uploads that do not have them yet
+@uploads_router.post("/uploads/renditions/backfill", tags=["uploads"], response_model=Jobs)
+async def backfill_upload_renditions(current_user: UserResponse = Depends(verify_authenticated_user)):
+    if current_user.role != UserRoles.ADMIN.value:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only admin can backfill renditions!")
+
+    async with async_session() as session:
+        job = add_job(session=session, job_type=JobTypes.RENDITION_BACKFILL, payload={"last_upload_id": 0})
+        await session.commit()
+        await session.refresh(job)
+
+    return job
+
+# 'include' (comma separated: files, tags, collections, creator) embeds related resources, each is loaded by one query for the whole page
+# 'metadata_contains' (JSON object, example: {"subreddit": "pics"}) and 'metadata_path' (jsonpath predicate, example: $.score > 100) filter by metadata, both use the GIN index
+# Ordering by metadata (example: metadata/title1/pretty - from nhentai schema) is possible only by fields marked as sortable in the schema and requires 'filter_by_metadata'
+# 'tags_all', 'tags_any' and 'tags_none' (comma separated tag ids) filter by tags, example: tags_all=1,2&tags_none=3 - tags 1 and 2 but not 3
+# 'facets' adds 'X-Tag-Facets' header - JSON object of tag id to number of uploads of the whole filtered set (not only the page) with the tag, tags used in filters are left out
+# Only TAG_FACET_LIMIT most used tags are in the header
+@uploads_router.get("/uploads", tags=["uploads"], response_model=list[UploadDetailResponse], response_model_exclude_unset=True)
+async def get_all_uploads(request: Request, offset: int = 0, limit: int | None = None, cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, filter_by_metadata: str | None = None, metadata_contains: str | None = None, metadata_path: str | None = None, tags_all: str | None = None, tags_any: str | None = None, tags_none: str | None = None, facets: bool = False, order_by: str | None = None, order_by_direction: str | None = "asc", include: str | None = None, count: TotalCountModes | None = None):
     forbidden_order_by = ["metadata_json", "metadata_type"]
+    metadata_type = None
+    metadata_field = None
+    includes = parse_upload_includes(include=include)
+    all_tag_ids = parse_id_list(ids=tags_all, name="tags_all")
+    any_tag_ids = parse_id_list(ids=tags_any, name="tags_any")
+    none_tag_ids = parse_id_list(ids=tags_none, name="tags_none")
+    additional_filters = get_upload_tag_filters(tags_all=all_tag_ids, tags_any=any_tag_ids, tags_none=none_tag_ids)
+    tag_facets = None
+    total_count_headers = {}
+
+    if filter_by_metadata:
+        try:
+            metadata_type = MetadataTypes(filter_by_metadata.lower())
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid filter_by_metadata! Valid options: {', '.join(metadata_type.value for metadata_type in MetadataTypes)}")
+
+        additional_filters.append(get_metadata_type_filter(metadata_type=metadata_type))
+
+    if metadata_contains is not None:
+        try:
+            contained_metadata = json.loads(metadata_contains)
+        except ValueError:
+            contained_metadata = None
+
+        if not isinstance(contained_metadata, dict):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Query 'metadata_contains' must be a JSON object!")
+
+        additional_filters.append(Uploads.metadata_json.contains(contained_metadata))
+
+    if metadata_path is not None:
+        additional_filters.append(Uploads.metadata_json.op("@@")(text("CAST(:metadata_path AS JSONPATH)").bindparams(metadata_path=metadata_path)))
+
+    if order_by and order_by.startswith("metadata/"):
+        if metadata_type is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cannot order by metadata while different kinds are present! Please use filter_by_metadata.")
+
+        sortable_fields = {"/".join(path): (path, field_schema) for path, field_schema in get_marked_metadata_fields(schema=metadata_schemas.get(metadata_type, {}), mark="x-sortable")}
+        metadata_field = sortable_fields.get(order_by.removeprefix("metadata/"))
 
-    with Session(engine) as session:
-        if order_by and order_by.startswith("metadata"): # Example: metadata/title1/pretty - from nhentai schema
-            if not filter_by_metadata:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cannot order by metadata while different kinds are present! Please use filter_by_metadata.")
-            
-            keys = order_by.split("/")  # Split the field path into components
-            schema = metadata_schemas[MetadataTypes(filter_by_metadata.upper())]
-
-            if schema is None:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid filter_by_metadata!")
-
-            current_schema = schema.get("properties", {})  # Start with the top-level properties
-            
-            # Just check for key existence does not extract data!
-            for key in keys:
-                if key not in current_schema:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid key in order_by! Key: {key}") # Key not found in the current schema
-                # Move to the next level of the schema if possible
-                current_schema = current_schema[key].get("properties", {})
-            
-            expression = "metadata_json"
-            for i, key in enumerate(keys):
-                if i < len(keys) - 1:
-                    # Use -> for intermediate keys
-                    expression += f"->'{key}'"
-                else:
-                    # Use ->> for the final key to extract it as text
-                    expression += f"->>'{key}'"
-
-            statement = build_sqlmodel_get_all_query(model=Uploads, offset=offset, limit=limit, created_before=created_before, created_after=created_after, created_by=created_by, order_by=None)
-
-            if order_by_direction.lower() == "asc":
-                statement = statement.order_by(asc(text(expression)))
-            elif order_by_direction.lower() == "desc":
-                statement = statement.order_by(desc(text(expression)))
+        if metadata_field is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Cannot order by this metadata field! Sortable fields: {', '.join('metadata/' + field for field in sortable_fields) or 'none'}")
+
+    # Built only when the response is not cached yet
+    async def build():
+        nonlocal tag_facets, total_count_headers
+
+        async with async_session() as session:
+            if metadata_field is not None:
+                path, field_schema = metadata_field
+                expression = literal_column(get_metadata_expression(path=path, field_schema=field_schema), type_=Numeric if is_numeric_metadata_field(field_schema) else String)
+
+                statement = build_sqlmodel_get_all_query(model=Uploads, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, order_by_expression=expression, order_by_direction=order_by_direction, additional_filters=additional_filters)
             else:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid order_by_direction field! Valid options: asc, desc")
-        else:
-            statement = build_sqlmodel_get_all_query(model=Uploads, offset=offset, limit=limit, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, forbidden_order_by=forbidden_order_by, order_by_direction=order_by_direction)
+                statement = build_sqlmodel_get_all_query(model=Uploads, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by=order_by, forbidden_order_by=forbidden_order_by, order_by_direction=order_by_direction, additional_filters=additional_filters)
+
+            try:
+                results = await session.exec(statement)
+                uploads = results.all()
+            except DBAPIError:
+                if metadata_path is None:
+                    raise
+
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid metadata_path!")
+
+            # Same filters without pagination
+            filtered_statement = build_sqlmodel_get_all_query(model=Uploads, created_before=created_before, created_after=created_after, created_by=created_by, additional_filters=additional_filters)
+
+            if count is not None:
+                total_count_headers = await get_total_count_headers(session=session, statement=filtered_statement, mode=count, model=Uploads, created_by=created_by, cacheable=not additional_filters and created_before is None and created_after is None)
+
+            if facets:
+                # Counters are used when nothing is filtered
+                filtered = additional_filters or created_before is not None or created_after is not None or created_by is not None
+                tag_facets = await get_upload_tag_facets(session=session, statement=filtered_statement if filtered else None, excluded_tag_ids=all_tag_ids + none_tag_ids)
+
+            return await load_upload_includes(session=session, uploads=uploads, includes=includes)
+
+    # Next cursor holds the same value the rows are ordered by (number for numeric fields, otherwise text extracted from metadata the same way as '->>' does)
+    def get_order_value(upload: dict):
+        if metadata_field is None:
+            return upload[order_by or "id"]
+
+        path, field_schema = metadata_field
+
+        value = upload["metadata_json"]
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+
+        if value is None or isinstance(value, str) or (is_numeric_metadata_field(field_schema) and isinstance(value, (int, float))):
+            return value
+
+        return json.dumps(value)
+
+    def build_headers(uploads: list[dict]) -> dict:
+        headers = {**get_pagination_headers(items=uploads, limit=limit, order_by=order_by, order_by_direction=order_by_direction, get_value=get_order_value), **total_count_headers}
+
+        if tag_facets is not None:
+            headers["X-Tag-Facets"] = json.dumps(tag_facets, separators=(",", ":"))
+
+        return headers
+
+    # Embedded resources are invalidated together with the uploads listing
+    entities = [CacheEntities.UPLOADS]
+    if UploadIncludes.CREATOR in includes:
+        entities.append(CacheEntities.USERS)
+
+    return await cached_response(request=request, entities=entities, response_model=list[UploadDetailResponse], build=build, build_headers=build_headers, exclude_unset=True)
+
+# Ranked full-text search over titles, descriptions and searchable metadata (see uploads.metadata_schemas), the last word of 'q' matches as a prefix
+# Ordered by rank (best first), next page is requested with cursor from 'X-Next-Cursor' header
+# 'highlight' adds headline (title and description with matched words wrapped in <b></b>), it is computed only for the returned page
+@uploads_router.get("/uploads/search", tags=["uploads"], response_model=list[UploadSearchResponse])
+async def search_uploads(request: Request, q: str, limit: int = Query(default=20, ge=1, le=MAX_SEARCH_LIMIT), cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, highlight: bool = False):
+    search_query = build_search_query(q=q)
+
+    if search_query is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Query 'q' must contain at least one word!")
+
+    # Built only when the response is not cached yet
+    async def build():
+        text_config = cast(SEARCH_TEXT_CONFIG, REGCONFIG)
+        ts_query = func.to_tsquery(text_config, search_query)
+        search_vector = Uploads.__table__.c.search_vector
+        rank = func.ts_rank_cd(search_vector, ts_query, type_=Float)
+
+        # Match uses the GIN index, rank is then computed only for matching uploads
+        statement = build_sqlmodel_get_all_query(model=Uploads, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, created_by=created_by, order_by="rank", order_by_expression=rank, order_by_direction="desc", additional_filters=[search_vector.op("@@")(ts_query)])
+        statement = statement.add_columns(rank.label("rank"))
+
+        if highlight:
+            statement = statement.add_columns(func.ts_headline(text_config, func.concat_ws(" ", Uploads.title, Uploads.description), ts_query, "StartSel=<b>, StopSel=</b>, MaxWords=35, MinWords=15").label("headline"))
+
+        async with async_session() as session:
+            results = await session.execute(statement)
+
+            return [{**upload.model_dump(), "rank": upload_rank, "headline": headline[0] if headline else None} for upload, upload_rank, *headline in results.all()]
+
+    return await cached_response(request=request, entities=[CacheEntities.UPLOADS], response_model=list[UploadSearchResponse], build=build, build_headers=lambda uploads: get_pagination_headers(items=uploads, limit=limit, order_by="rank", order_by_direction="desc", get_value=lambda upload: upload["rank"]))
+
+# Thumbnails of many uploads in one response (gallery grids) - multipart/mixed with one part per thumbnail or a sprite sheet with map of offsets
+# Uploads without a thumbnail are listed in 'X-Missing-Ids' header / 'missing' field, uploads with thumbnail being generated in 'X-Pending-Ids' / 'pending'
+@uploads_router.get("/uploads/thumbnails", tags=["uploads"])
+async def get_upload_thumbnails(request: Request, ids: str, layout: ThumbnailBatchLayouts = ThumbnailBatchLayouts.MULTIPART, size: int | None = None, image_format: RenditionFormats | None = Query(default=None, alias="format")):
+    try:
+        upload_ids = list(dict.fromkeys(int(upload_id) for upload_id in ids.split(",") if upload_id.strip())) # Unique, in requested order
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="'ids' must be comma separated upload ids!")
+
+    if not upload_ids or len(upload_ids) > MAX_THUMBNAIL_BATCH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Between 1 and {MAX_THUMBNAIL_BATCH} upload ids can be requested at once!")
+
+    # One query for the whole batch
+    async with async_session() as session:
+        statement = select(Uploads.id, Uploads.thumbnail_status).where(Uploads.id.in_(upload_ids), Uploads.deleted_at == None)
+        results = await session.exec(statement)
+        thumbnail_statuses = {upload_id: thumbnail_status for upload_id, thumbnail_status in results.all()}
+
+    pending_ids = [upload_id for upload_id in upload_ids if thumbnail_statuses.get(upload_id) == ThumbnailStatuses.PENDING.value]
+    available_ids = [upload_id for upload_id in upload_ids if upload_id in thumbnail_statuses and upload_id not in pending_ids]
+
+    if layout == ThumbnailBatchLayouts.SPRITE:
+        sprite_format = (image_format or RenditionFormats.JPEG).value
+        thumbnail_paths = await asyncio.to_thread(get_upload_thumbnail_paths, upload_ids=available_ids, size=size, image_format=sprite_format)
+    else:
+        thumbnail_paths = await asyncio.to_thread(get_upload_thumbnail_paths, upload_ids=available_ids, size=size, image_format=image_format.value if image_format is not None else None)
+
+    # Version of the batch - changes when any thumbnail is regenerated
+    thumbnail_versions = []
+    for upload_id, thumbnail_path in list(thumbnail_paths.items()):
+        try:
+            stat_result = os.stat(thumbnail_path)
+        except FileNotFoundError: # Removed after the lookup (regenerated or upload deleted), reported as missing
+            del thumbnail_paths[upload_id]
+            continue
+
+        thumbnail_versions.append(f"{upload_id}:{thumbnail_path}:{stat_result.st_size}:{stat_result.st_mtime_ns}")
+
+    missing_ids = [upload_id for upload_id in upload_ids if upload_id not in thumbnail_paths and upload_id not in pending_ids]
+
+    if layout == ThumbnailBatchLayouts.SPRITE:
+        tile_height = size or SPRITE_TILE_HEIGHT
+
+        if not thumbnail_paths:
+            return {"sprite": None, "tiles": {}, "missing": missing_ids, "pending": pending_ids}
+
+        # Sprite is cached on disk, keyed by the thumbnails it is made of
+        sprite_key = hashlib.sha256("|".join([str(tile_height), sprite_format, *thumbnail_versions]).encode()).hexdigest()
+        sprite_path = get_sprite_path(sprite_key=sprite_key, image_format=sprite_format)
+        offsets = await asyncio.to_thread(load_sprite_map, sprite_path)
+
+        if offsets is None:
+            offsets = await asyncio.to_thread(create_sprite_sheet, thumbnail_paths=thumbnail_paths, sprite_path=sprite_path, tile_height=tile_height, image_format=sprite_format)
+            await asyncio.to_thread(evict_sprite_sheets, keep_path=sprite_path)
+
+        return {"sprite": f"/uploads/thumbnails/sprites/{os.path.basename(sprite_path)}", "tiles": offsets, "missing": missing_ids, "pending": pending_ids}
+
+    etag = make_etag(*thumbnail_versions)
+    headers = {"ETag": etag, "Cache-Control": THUMBNAIL_CACHE_CONTROL, "X-Missing-Ids": ",".join(map(str, missing_ids)), "X-Pending-Ids": ",".join(map(str, pending_ids))}
+
+    if is_not_modified(request=request, etag=etag, last_modified=None): # Batch has no Last-Modified, ETag covers which thumbnails are in it
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    boundary = uuid.uuid4().hex
+
+    async def iter_thumbnail_parts():
+        for upload_id, thumbnail_path in thumbnail_paths.items():
+            try:
+                async with aiofiles.open(thumbnail_path, "rb") as thumbnail_file:
+                    content = await thumbnail_file.read()
+            except FileNotFoundError: # Removed after the lookup (regenerated)
+                continue
+
+            media_type = mimetypes.guess_type(thumbnail_path)[0] or "application/octet-stream"
+            yield f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Length: {len(content)}\r\nContent-Location: /uploads/{upload_id}/thumbnail\r\nX-Upload-Id: {upload_id}\r\n\r\n".encode()
+            yield content
+            yield b"\r\n"
 
-        results = session.exec(statement)
+        yield f"--{boundary}--\r\n".encode()
 
-        return results.all()
+    return StreamingResponse(iter_thumbnail_parts(), media_type=f"multipart/mixed; boundary={boundary}", headers=headers)
 
-@uploads_router.get("/uploads/{upload_id}", tags=["uploads"], response_model=UploadResponse)
-async def get_upload(upload_id: int):
-    with Session(engine) as session:
+# Sprite sheets are named by hash of their content, so they never change
+@uploads_router.get("/uploads/thumbnails/sprites/{sprite_name}", tags=["uploads"], response_class=FileResponseFastAPI)
+async def get_upload_thumbnails_sprite(request: Request, sprite_name: str):
+    if re.fullmatch(r"[0-9a-f]{64}\.(jpg|webp)", sprite_name) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sprite not found!")
+
+    return await build_path_response(request=request, file_path=os.path.join(SAVE_DIR, "sprites", sprite_name), cache_control=FILE_CACHE_CONTROL, not_found_detail="Sprite not found!")
+
+# Links many uploads to many tags and collections in one transaction (same rules as the single endpoints - owner of the upload for tags, owner of private collection)
+@uploads_router.post("/uploads/links", tags=["uploads"], response_model=UploadLinksResponse)
+async def add_upload_links(new_links: UploadLinksCreate, current_user: UserResponse = Depends(verify_authenticated_user)):
+    upload_ids = list(dict.fromkeys(new_links.upload_ids))
+    tag_ids = list(dict.fromkeys(new_links.tag_ids))
+    collection_ids = list(dict.fromkeys(new_links.collection_ids))
+
+    async with async_session() as session:
+        await check_ids_exist(session=session, model=Uploads, ids=upload_ids, name="Upload")
+
+        if tag_ids:
+            statement = select(Uploads.id).where(Uploads.id.in_(upload_ids), Uploads.created_by != current_user.id)
+            results = await session.exec(statement)
+            not_owned_ids = results.all()
+
+            if not_owned_ids:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Only owner can add tags to upload! Uploads: {', '.join(map(str, not_owned_ids))}")
+
+            await check_ids_exist(session=session, model=Tags, ids=tag_ids, name="Tag")
+
+        if collection_ids:
+            await check_ids_exist(session=session, model=Collections, ids=collection_ids, name="Collection")
+
+            statement = select(Collections.id).where(Collections.id.in_(collection_ids), Collections.privacy == CollectionPrivacy.PRIVATE.value, Collections.created_by != current_user.id)
+            results = await session.exec(statement)
+            not_owned_ids = results.all()
+
+            if not_owned_ids:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Only owner can add uploads to private collection! Collections: {', '.join(map(str, not_owned_ids))}")
+
+        tag_links = await insert_links(session=session, model=TagUploadLinks, links=[{"tag_id": tag_id, "upload_id": upload_id, "created_by": current_user.id} for upload_id in upload_ids for tag_id in tag_ids])
+        collection_links = await insert_links(session=session, model=UploadCollectionLinks, links=[{"upload_id": upload_id, "collection_id": collection_id, "created_by": current_user.id} for upload_id in upload_ids for collection_id in collection_ids])
+        await update_tag_upload_counts(session=session, tag_ids=[link.tag_id for link in tag_links], delta=1)
+        await session.commit()
+
+    await invalidate_cache(CacheEntities.UPLOADS) # Embedded in uploads ('include')
+
+    return UploadLinksResponse(tag_links=tag_links, collection_links=collection_links)
+
+@uploads_router.get("/uploads/{upload_id}", tags=["uploads"], response_model=UploadDetailResponse, response_model_exclude_unset=True)
+async def get_upload(upload_id: int, include: str | None = None):
+    includes = parse_upload_includes(include=include)
+
+    async with async_session() as session:
         statement = select(Uploads).where(Uploads.id == upload_id)
-        results = session.exec(statement)
-        upload = results.one()
+        results = await session.exec(statement)
+        upload = results.first()
 
         if upload is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
-                
-        return upload
+
+        return (await load_upload_includes(session=session, uploads=[upload], includes=includes))[0]
 
 @uploads_router.put("/uploads/{upload_id}", tags=["uploads"])
 async def update_upload(upload_id: int):
     pass
 
-@uploads_router.get("/uploads/{upload_id}/thumbnail", tags=["uploads"], response_class=FileResponse)
-async def get_upload_thumbnail(upload_id: int):
-    with Session(engine) as session:
+# Streams all files of the upload (and metadata.json) as one archive built on the fly
+@uploads_router.get("/uploads/{upload_id}/archive", tags=["uploads"], response_class=StreamingResponse)
+async def get_upload_archive(request: Request, upload_id: int, archive_format: ArchiveFormats = Query(default=ArchiveFormats.ZIP, alias="format")):
+    async with async_session() as session:
+        statement = select(Uploads).where(Uploads.id == upload_id, Uploads.deleted_at == None)
+        results = await session.exec(statement)
+        upload = results.first()
+
+        if upload is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
+
+        statement = select(Files).where(Files.upload_id == upload.id, Files.deleted_at == None).order_by(Files.id)
+        results = await session.exec(statement)
+        files = results.all()
+
+    entries = get_upload_archive_entries(upload=upload, files=files)
+
+    return await build_archive_response(request=request, entries=entries, archive_format=archive_format, archive_name=upload.title)
+
+@uploads_router.get("/uploads/{upload_id}/thumbnail", tags=["uploads"], response_class=FileResponseFastAPI)
+async def get_upload_thumbnail(request: Request, upload_id: int, size: int | None = None, image_format: RenditionFormats | None = Query(default=None, alias="format")):
+    async with async_session() as session:
         statement = select(Uploads).where(Uploads.id == upload_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         upload = results.one()
 
         if upload is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
-        
-        file_path = os.path.join(SAVE_DIR, "uploads", str(upload.id), "thumbnail.jpg")
 
-        if os.path.exists(file_path):
-            return file_path
-        else:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Thumbnail not found!")
+        if upload.thumbnail_status == ThumbnailStatuses.PENDING.value:
+            return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"status": upload.thumbnail_status, "detail": "Thumbnail is being generated!"})
 
-@uploads_router.post("/uploads/{upload_id}/tags", tags=["uploads"], response_model=list[TagUploadLinks])
-async def add_tags_to_upload(upload_id: int, tag_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
-    current_upload = None
+    # Best existing rendition for the requested size and format (original thumbnail.jpg is used if there are no renditions yet)
+    file_path = get_upload_thumbnail_path(upload_id=upload.id, size=size, image_format=image_format.value if image_format is not None else None)
 
-    with Session(engine) as session:
-        statement = select(Uploads).where(Uploads.id == upload_id)
-        results = session.exec(statement)
+    if file_path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Thumbnail not found!")
+
+    return await build_path_response(request=request, file_path=file_path, cache_control=THUMBNAIL_CACHE_CONTROL, not_found_detail="Thumbnail not found!")
+
+# Direct-to-disk upload of one file - body is the raw file (no multipart), written straight to the upload directory as it arrives
+@uploads_router.put("/uploads/{upload_id}/files/{index}", tags=["uploads"], response_model=FileResponse)
+async def put_upload_file(request: Request, upload_id: int, index: int, filename: str, content_type: str = Header(), content_length: int | None = Header(default=None), current_user: UserResponse = Depends(verify_authenticated_user)):
+    if index < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File index cannot be negative!")
+
+    original_filename, file_ext = get_file_name_and_ext(filename=filename, file_mime=content_type)
+
+    if content_length is not None and content_length > MAX_FILE_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"File exceeds maximum allowed size of {MAX_FILE_SIZE} bytes!")
+
+    async with async_session() as session:
+        statement = select(Uploads).where(Uploads.id == upload_id, Uploads.deleted_at == None)
+        results = await session.exec(statement)
         upload = results.first()
 
         if upload is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
-        else:
-            current_upload = upload
 
-    if current_user.id != current_upload.created_by:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add tags to upload!")
+        if current_user.id != upload.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add files to upload!")
+
+        # Rejects the body before it is received, concurrent uploads of the same index are rejected by insert_upload_file
+        statement = select(Files.id).where(Files.upload_id == upload.id, Files.generated_filename == str(index), Files.deleted_at == None)
+        results = await session.exec(statement)
+
+        if results.first() is not None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"File with index {index} already exists in upload {upload.id}!")
+
+    generated_filename = str(index)
+    file_path = get_upload_file_path(upload_id=upload.id, generated_filename=generated_filename, file_ext=file_ext)
+    temporary_path = f"{file_path}.{uuid.uuid4().hex}.upload" # Moved into place only after the database entry was inserted
+
+    try:
+        file_size, content_hash, crc32 = await stream_save_request(stream=request.stream(), target=temporary_path)
+
+        # Same database entry as files sent in 'POST /uploads'
+        new_file = Files(upload_id=upload.id, original_filename=original_filename, generated_filename=generated_filename, file_size=file_size, file_mime=content_type, file_ext=file_ext, content_hash=content_hash, crc32=crc32, created_by=current_user.id)
+
+        async with async_session() as session:
+            db_file = await insert_upload_file(session=session, new_file=new_file, source=temporary_path)
+            await add_new_files_jobs(session=session, upload_id=upload.id, files=[db_file])
+            await session.commit()
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
 
-    links = []
+    await invalidate_cache(CacheEntities.UPLOADS) # Thumbnail status can change
+
+    return db_file
+
+# Adds a file whose content is already stored (found by 'GET /files/by-hash/{sha256}') without sending its bytes - the stored object is hardlinked into the upload
+@uploads_router.post("/uploads/{upload_id}/files/by-hash", tags=["uploads"], response_model=FileResponse)
+async def add_upload_file_by_hash(upload_id: int, sha256: str = Body(), index: int = Body(), filename: str = Body(), current_user: UserResponse = Depends(verify_authenticated_user)):
+    if index < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File index cannot be negative!")
+
+    sha256 = check_content_hash(content_hash=sha256)
+
+    async with async_session() as session:
+        statement = select(Uploads).where(Uploads.id == upload_id, Uploads.deleted_at == None)
+        results = await session.exec(statement)
+        upload = results.first()
+
+        if upload is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
 
-    for tag_id in tag_ids:
-        with Session(engine) as session:
-            statement = select(Tags).where(Tags.id == tag_id)
-            results = session.exec(statement)
-            tag = results.first()
+        if current_user.id != upload.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add files to upload!")
 
-            if tag is None:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Tag {tag_id} not found!")
+        stored_files = await get_files_with_content(session=session, content_hash=sha256, limit=1)
 
-        with Session(engine) as session:
-            statement = select(TagUploadLinks).where(TagUploadLinks.tag_id == tag_id, TagUploadLinks.upload_id == current_upload.id)
-            results = session.exec(statement)
-            tag_upload_link = results.first()
+    if not stored_files:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No file with this content is stored!")
 
-            if tag_upload_link is not None:
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Tag {tag_id} already added to upload {current_upload.id}!")
+    stored_file = stored_files[0]
+    original_filename, file_ext = get_file_name_and_ext(filename=filename, file_mime=stored_file.file_mime)
 
-    for tag_id in tag_ids:
-        tag_upload_link = TagUploadLinks(tag_id=tag_id, upload_id=current_upload.id, created_by=current_user.id)
+    generated_filename = str(index)
+    file_path = get_upload_file_path(upload_id=upload.id, generated_filename=generated_filename, file_ext=file_ext)
+    temporary_path = f"{file_path}.{uuid.uuid4().hex}.upload" # Moved into place only after the database entry was inserted
 
-        with Session(engine) as session:
-            db_tag_upload_link = TagUploadLinks.model_validate(tag_upload_link)
-            session.add(db_tag_upload_link)
-            session.commit()
-            session.refresh(db_tag_upload_link)
-            tag_upload_link = db_tag_upload_link
+    try:
+        stored_path = get_upload_file_path(upload_id=stored_file.upload_id, generated_filename=stored_file.generated_filename, file_ext=stored_file.file_ext)
+        await asyncio.to_thread(link_stored_content, sha256, stored_path, temporary_path)
 
-        links.append(tag_upload_link)
+        new_file = Files(upload_id=upload.id, original_filename=original_filename, generated_filename=generated_filename, file_size=stored_file.file_size, file_mime=stored_file.file_mime, file_ext=file_ext, content_hash=sha256, crc32=stored_file.crc32, created_by=current_user.id)
+
+        async with async_session() as session:
+            db_file = await insert_upload_file(session=session, new_file=new_file, source=temporary_path)
+            await add_new_files_jobs(session=session, upload_id=upload.id, files=[db_file])
+            await session.commit()
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    await invalidate_cache(CacheEntities.UPLOADS) # Thumbnail status can change
+
+    return db_file
+
+@uploads_router.post("/uploads/{upload_id}/tags", tags=["uploads"], response_model=list[TagUploadLinks])
+async def add_tags_to_upload(upload_id: int, tag_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
+    async with async_session() as session:
+        statement = select(Uploads).where(Uploads.id == upload_id, Uploads.deleted_at == None)
+        results = await session.exec(statement)
+        upload = results.first()
+
+        if upload is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
+
+        if current_user.id != upload.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can add tags to upload!")
+
+        # All tags are validated by one query and linked by one statement (already added tags are skipped)
+        await check_ids_exist(session=session, model=Tags, ids=tag_ids, name="Tag")
+        links = await insert_links(session=session, model=TagUploadLinks, links=[{"tag_id": tag_id, "upload_id": upload.id, "created_by": current_user.id} for tag_id in dict.fromkeys(tag_ids)])
+        await update_tag_upload_counts(session=session, tag_ids=[link.tag_id for link in links], delta=1)
+        await session.commit()
+
+    await invalidate_cache(CacheEntities.UPLOADS) # Embedded in uploads ('include')
 
     return links
 
 @uploads_router.delete("/uploads/{upload_id}/tags", tags=["uploads"], response_model=bool)
 async def remove_tags_from_upload(upload_id: int, tag_ids: list[int] = Body(embed=True), current_user: UserResponse = Depends(verify_authenticated_user)):
-    current_upload = None
-
-    with Session(engine) as session:
-        statement = select(Uploads).where(Uploads.id == upload_id)
-        results = session.exec(statement)
+    async with async_session() as session:
+        statement = select(Uploads).where(Uploads.id == upload_id, Uploads.deleted_at == None)
+        results = await session.exec(statement)
         upload = results.first()
 
         if upload is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found!")
-        else:
-            current_upload = upload
 
-    if current_user.id != current_upload.created_by:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can remove tags from upload!")
+        if current_user.id != upload.created_by:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can remove tags from upload!")
 
-    for tag_id in tag_ids:
-        with Session(engine) as session:
-            statement = select(TagUploadLinks).where(TagUploadLinks.tag_id == tag_id, TagUploadLinks.upload_id == current_upload.id)
-            results = session.exec(statement)
-            tag_upload_link = results.first()
+        statement = delete(TagUploadLinks).where(TagUploadLinks.upload_id == upload.id, TagUploadLinks.tag_id.in_(tag_ids)).returning(TagUploadLinks.tag_id)
+        results = await session.execute(statement)
+        await update_tag_upload_counts(session=session, tag_ids=results.scalars().all(), delta=-1)
+        await session.commit()
 
-            if tag_upload_link is not None:
-                session.delete(tag_upload_link)
-                session.commit()
+    await invalidate_cache(CacheEntities.UPLOADS) # Embedded in uploads ('include')
 
     return True
 
 @uploads_router.get("/uploads/{upload_id}/tags", tags=["uploads"], response_model=list[TagUploadLinks])
 async def get_all_tags_of_upload(upload_id: int):
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(TagUploadLinks).where(TagUploadLinks.upload_id == upload_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         return results.all()
\ No newline at end of file
@@ -0,0 +1,24 @@
+# External imports
+from enum import Enum
+
+class ThumbnailStatuses(Enum):
+    NONE = "none" # No thumbnail (no supported file to generate it from)
+    PENDING = "pending" # Waiting for or being generated by a background job
+    READY = "ready"
+    FAILED = "failed"
+
+
+class RenditionFormats(Enum):
+    JPEG = "jpeg"
+    WEBP = "webp"
+
+class ThumbnailBatchLayouts(Enum):
+    MULTIPART = "multipart" # multipart/mixed, one part per thumbnail
+    SPRITE = "sprite" # One image with all thumbnails and JSON map of their offsets
+
+
+class UploadIncludes(Enum):
+    FILES = "files"
+    TAGS = "tags"
+    COLLECTIONS = "collections"
+    CREATOR = "creator"
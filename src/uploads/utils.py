@@ -1,57 +1,212 @@
 # External imports
 from fastapi import UploadFile, HTTPException, status
-from moviepy import VideoFileClip
+from sqlmodel import select
+from sqlalchemy import exists, func, literal
+from sqlmodel.ext.asyncio.session import AsyncSession
 from PIL import Image # PIL = pillow
 import os
+import json
+import uuid
+import time
+import shutil
+import re
+import subprocess
 from io import BytesIO
-from tempfile import NamedTemporaryFile
+from typing import BinaryIO
 
 # Internal imports
-from config import SAVE_DIR, TEMP_DIR, TARGET_THUMBNAIL_HEIGHT
+from files.models import Files
+from uploads.models import Uploads
+from uploads.types import UploadIncludes
+from uploads.metadata_schemas import MetadataTypes
+from tags.models import Tags, TagUploadLinks, TagUploadCounts
+from scatter_collections.models import Collections, UploadCollectionLinks
+from users.models import Users
+from files.utils import get_upload_file_path
+from config import SAVE_DIR, TARGET_THUMBNAIL_HEIGHT, FFMPEG_PATH, FFPROBE_PATH, VIDEO_FRAME_TIMEOUT, RENDITION_HEIGHTS, RENDITION_FORMATS, RENDITION_QUALITY, SPRITE_MAX_WIDTH, SPRITE_CACHE_MAX_FILES, SPRITE_CACHE_MAX_AGE, TAG_FACET_LIMIT, SEARCH_MIN_PREFIX_LENGTH
 
-# Methods directly facing the API (that's why they use UploadFile instead of BytesIO and can raise HTTPException)
-def create_upload_thumbnail(file: UploadFile, upload_id: int, is_user_uploaded: bool = False) -> bool:
-    thumbnail_location = os.path.join(SAVE_DIR, "uploads", str(upload_id), "thumbnail.jpg")
+THUMBNAIL_SUPPORTED_MIMES = ["image/jpeg", "image/png", "image/webp", "image/gif", "video/mp4", "video/webm"]
+PREVIEW_SUPPORTED_MIMES = ["image/jpeg", "image/png", "image/webp", "image/gif"] # Files that downscaled previews are created for
+RENDITION_EXTENSIONS = {"jpeg": "jpg", "webp": "webp"}
+
+# Methods directly facing the API (that's why they use UploadFile instead of file paths and can raise HTTPException)
+def validate_user_thumbnail(file: UploadFile):
+    supported_mimes = ["image/jpeg", "image/png", "image/webp"]
+
+    if file.content_type not in supported_mimes:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Thumbnail must be only 'image/jpeg', 'image/png' or 'image/webp'!")
+
+# Words of the search text as tsquery - all words have to match, the last one also as a prefix (search as you type) when it has at least SEARCH_MIN_PREFIX_LENGTH characters
+# Only letters and digits are kept, so operators of tsquery syntax in the text cannot cause errors
+def build_search_query(q: str) -> str | None:
+    words = re.findall(r"[^\W_]+", q.lower())
+
+    if not words:
+        return None
+
+    if len(words[-1]) >= SEARCH_MIN_PREFIX_LENGTH:
+        words[-1] = f"{words[-1]}:*"
+
+    return " & ".join(words)
+
+# Metadata type is rendered as a literal - partial indexes of sortable metadata fields have 'metadata_type = <literal>' as their predicate,
+# which a bound parameter does not match in a generic plan (asyncpg prepares every statement)
+def get_metadata_type_filter(metadata_type: MetadataTypes):
+    return Uploads.metadata_type == literal(metadata_type.value, literal_execute=True)
+
+# Filters of uploads by tags - all of 'tags_all', at least one of 'tags_any' and none of 'tags_none'
+# Every filter is a subquery of the links, so the listing stays one query
+def get_upload_tag_filters(tags_all: list[int], tags_any: list[int], tags_none: list[int]) -> list:
+    filters = []
+
+    if tags_all:
+        statement = select(TagUploadLinks.upload_id).where(TagUploadLinks.tag_id.in_(tags_all)).group_by(TagUploadLinks.upload_id).having(func.count() == len(tags_all))
+        filters.append(Uploads.id.in_(statement))
+
+    if tags_any:
+        statement = select(TagUploadLinks.upload_id).where(TagUploadLinks.tag_id.in_(tags_any))
+        filters.append(Uploads.id.in_(statement))
+
+    if tags_none:
+        filters.append(~exists().where(TagUploadLinks.upload_id == Uploads.id, TagUploadLinks.tag_id.in_(tags_none)))
+
+    return filters
+
+# Number of uploads per tag (most used first) - statement selects the filtered uploads, tags used by the filters are left out
+# Without a statement (no filters) the counts are read from the counters instead of counting the links
+async def get_upload_tag_facets(session: AsyncSession, statement, excluded_tag_ids: list[int]) -> dict[int, int]:
+    if statement is None:
+        facets_statement = select(TagUploadCounts.tag_id, TagUploadCounts.upload_count).join(Tags, Tags.id == TagUploadCounts.tag_id).where(TagUploadCounts.upload_count > 0, Tags.deleted_at == None).order_by(TagUploadCounts.upload_count.desc(), TagUploadCounts.tag_id).limit(TAG_FACET_LIMIT)
+    else:
+        upload_ids = statement.with_only_columns(Uploads.id).order_by(None)
+        upload_count = func.count().label("upload_count")
+        facets_statement = select(TagUploadLinks.tag_id, upload_count).join(Tags, Tags.id == TagUploadLinks.tag_id).where(TagUploadLinks.upload_id.in_(upload_ids), Tags.deleted_at == None).group_by(TagUploadLinks.tag_id).order_by(upload_count.desc(), TagUploadLinks.tag_id).limit(TAG_FACET_LIMIT)
+
+        if excluded_tag_ids:
+            facets_statement = facets_statement.where(TagUploadLinks.tag_id.not_in(excluded_tag_ids))
+
+    results = await session.exec(facets_statement)
+
+    return {tag_id: upload_count for tag_id, upload_count in results.all()}
+
+# Parses comma separated 'include' query parameter
+def parse_upload_includes(include: str | None) -> list[UploadIncludes]:
+    if not include:
+        return []
+
+    try:
+        return list(dict.fromkeys(UploadIncludes(value.strip().lower()) for value in include.split(",") if value.strip()))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid include! Valid options: {', '.join(value.value for value in UploadIncludes)}")
+
+# Returns uploads as dictionaries with requested related resources (none if includes is empty), every relation is loaded by one query for all uploads (never per upload)
+async def load_upload_includes(session: AsyncSession, uploads: list[Uploads], includes: list[UploadIncludes]) -> list[dict]:
+    upload_ids = [upload.id for upload in uploads]
+    related = {}
+
+    if UploadIncludes.FILES in includes:
+        statement = select(Files).where(Files.upload_id.in_(upload_ids), Files.deleted_at == None).order_by(Files.upload_id, Files.id)
+        results = await session.exec(statement)
+        related[UploadIncludes.FILES] = [(file.upload_id, file) for file in results.all()]
+
+    if UploadIncludes.TAGS in includes:
+        statement = select(TagUploadLinks.upload_id, Tags).join(Tags, Tags.id == TagUploadLinks.tag_id).where(TagUploadLinks.upload_id.in_(upload_ids), Tags.deleted_at == None).order_by(Tags.id)
+        results = await session.exec(statement)
+        related[UploadIncludes.TAGS] = results.all()
+
+    if UploadIncludes.COLLECTIONS in includes:
+        statement = select(UploadCollectionLinks.upload_id, Collections).join(Collections, Collections.id == UploadCollectionLinks.collection_id).where(UploadCollectionLinks.upload_id.in_(upload_ids), Collections.deleted_at == None).order_by(Collections.id)
+        results = await session.exec(statement)
+        related[UploadIncludes.COLLECTIONS] = results.all()
+
+    creators = {}
+
+    if UploadIncludes.CREATOR in includes:
+        statement = select(Users).where(Users.id.in_({upload.created_by for upload in uploads}))
+        results = await session.exec(statement)
+        creators = {user.id: user for user in results.all()}
+
+    # Grouped by upload (include -> upload_id -> rows)
+    related_by_upload = {}
+    for include, rows in related.items():
+        related_by_upload[include] = {}
+
+        for upload_id, row in rows:
+            related_by_upload[include].setdefault(upload_id, []).append(row)
+
+    upload_dicts = []
 
-    file.file.seek(0)
+    for upload in uploads:
+        upload_dict = upload.model_dump()
 
-    if is_user_uploaded:
-        supported_mimes = ["image/jpeg", "image/png", "image/webp"]
+        for include, rows_by_upload in related_by_upload.items():
+            upload_dict[include.value] = rows_by_upload.get(upload.id, [])
 
-        if file.content_type not in supported_mimes:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Thumbnail must be only 'image/jpeg', 'image/png' or 'image/webp'!")
+        if UploadIncludes.CREATOR in includes:
+            upload_dict[UploadIncludes.CREATOR.value] = creators.get(upload.created_by)
 
-    return create_thumbnail(file_mime=file.content_type, file=BytesIO(file.file.read()), thumbnail_location=thumbnail_location)
+        upload_dicts.append(upload_dict)
+
+    return upload_dicts
+
+# Returns thumbnail sources (for generate_upload_thumbnail) of already saved files that a thumbnail can be generated from
+def get_thumbnail_sources(files: list[Files]) -> list[dict]:
+    return [{"path": get_upload_file_path(upload_id=file.upload_id, generated_filename=file.generated_filename, file_ext=file.file_ext), "mime": file.file_mime} for file in files if file.file_mime in THUMBNAIL_SUPPORTED_MIMES]
 
 def create_profile_picture(file: UploadFile, user_id: int):
     supported_mimes = ["image/jpeg", "image/png", "image/webp"]
     profile_picture_location = os.path.join(SAVE_DIR, "users", str(user_id), "profile_picture.jpg")
 
     if file.content_type in supported_mimes:
+        file.file.seek(0)
+
+        # Image is opened only once and read directly from the spooled file, no copy in memory
         with Image.open(file.file) as img:
             width, height = img.size
 
             if width != height:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Profile picture must be 1:1 ratio (for example 512x512 pixel)!")
-        
-        file.file.seek(0)
-        create_thumbnail(file_mime=file.content_type, file=BytesIO(file.file.read()), thumbnail_location=profile_picture_location)
+
+            save_thumbnail_image(image=img, thumbnail_location=profile_picture_location)
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Profile picture file must be only 'image/jpeg', 'image/png' or 'image/webp'!")
 
-# Generates thumbnail or uses provided one and saves it to disk
-def create_thumbnail(file_mime: str, file: BytesIO, thumbnail_location: str, target_height: int = TARGET_THUMBNAIL_HEIGHT) -> bool:
-    supported_mimes = ["image/jpeg", "image/png", "image/webp", "image/gif", "video/mp4", "video/webm"]
+# Runs in a worker process of the job queue - tries the sources (already saved files) in order until a thumbnail is created
+# Source is a dict with 'path', 'mime' and optional 'temporary' (for example user uploaded thumbnail, removed by the job queue once the job finished or failed for good)
+# Returns media info of the source the thumbnail was created from or None if no source could be used
+def generate_upload_thumbnail(upload_id: int, sources: list[dict]) -> dict | None:
+    thumbnail_location = os.path.join(SAVE_DIR, "uploads", str(upload_id), "thumbnail.jpg")
 
-    thumbnail = None
+    for source in sources:
+        try:
+            media_info = create_thumbnail(file_mime=source["mime"], source=source["path"], thumbnail_location=thumbnail_location)
 
-    if file_mime in supported_mimes:
-        # Ensure the save directory exists
-        os.makedirs(os.path.dirname(thumbnail_location), exist_ok=True)
+            if media_info is not None:
+                with Image.open(thumbnail_location) as img:
+                    save_renditions(image=img, directory=get_upload_thumbnail_renditions_dir(upload_id=upload_id))
 
+                return {"source": source["path"], **media_info}
+        except Exception as e:
+            print(f"Thumbnail generation from '{source['path']}' failed: {e}")
+
+    return None
+
+# Temporary sources (user provided thumbnails) are kept until the job finished or failed for good, so retries can use them
+def remove_temporary_thumbnail_sources(sources: list[dict]):
+    for source in sources:
+        if source.get("temporary") and os.path.exists(source["path"]):
+            os.remove(source["path"])
+
+# Generates thumbnail or uses provided one and saves it to disk
+# Source is a path of an already saved file (required for videos) or an open binary file, media is read from it directly and never buffered as a whole
+# Returns media info (width, height and duration for videos) of the source or None if the mime type is not supported
+def create_thumbnail(file_mime: str, source: str | BinaryIO, thumbnail_location: str, target_height: int = TARGET_THUMBNAIL_HEIGHT) -> dict | None:
+    if file_mime in THUMBNAIL_SUPPORTED_MIMES:
         if file_mime == "image/gif":
             # Open the GIF file
-            with Image.open(file) as gif:
+            with Image.open(source) as gif:
+                media_info = {"width": gif.width, "height": gif.height}
+
                 # Get the total number of frames in the GIF
                 total_frames = gif.n_frames
 
@@ -61,58 +216,302 @@ def create_thumbnail(file_mime: str, file: BytesIO, thumbnail_location: str, tar
                 # Seek to the frame
                 gif.seek(frame_index)
 
-                # Create a thumbnail from the first frame (maybe when implemented downscaling to all types)
-                #img.thumbnail(size)
-
-                thumbnail = gif.copy()
-
-                # Save the thumbnail image
-                #gif.save(thumbnail_location)
+                save_thumbnail_image(image=gif, thumbnail_location=thumbnail_location, target_height=target_height)
         elif file_mime.split('/')[0] == "video":
-            with NamedTemporaryFile(dir=TEMP_DIR) as temp_file:
-                # Write the contents of the BytesIO object to the temporary file
-                temp_file.write(file.read())
-
-                # Load video from file
-                with VideoFileClip(temp_file.name) as video:
-                    # Calculate the time for 1/10th of the video duration
-                    duration = video.duration
-                    time_for_thumbnail = duration / 10
-                    
-                    # Get the frame at that time
-                    frame = video.get_frame(time_for_thumbnail)
-                    
-                    # Save the frame as an image
-                    image = Image.fromarray(frame)
-
-                    thumbnail = image.copy()
-
-                    #image.save(thumbnail_location)
-        else:
-            # Open the image file
-            with Image.open(file) as img:
-                thumbnail = img.copy()
-
-        # Get the current size of the image
-        width, height = thumbnail.size
-        
-        # Calculate the new height and width while keeping the aspect ratio
-        if height > target_height:
-            aspect_ratio = width / height
-            target_width = int(target_height * aspect_ratio)
-            
-            # Resize the image
-            thumbnail_resized = thumbnail.resize((target_width, target_height), Image.Resampling.LANCZOS)
+            if not isinstance(source, str):
+                raise ValueError("Video thumbnail can only be generated from a saved file path!")
+
+            thumbnail, media_info = extract_video_thumbnail_frame(file_path=source)
+            save_thumbnail_image(image=thumbnail, thumbnail_location=thumbnail_location, target_height=target_height)
         else:
-            # If image is smaller than 720p, keep the original
-            thumbnail_resized = thumbnail.copy()
+            # Open the image file (only the header is read here, pixels are decoded while resizing)
+            with Image.open(source) as img:
+                media_info = {"width": img.width, "height": img.height}
+                save_thumbnail_image(image=img, thumbnail_location=thumbnail_location, target_height=target_height)
+
+        return media_info
+    else:
+        return None
+
+# Scales down the (opened, not yet decoded) image to the target height and saves it as .jpg
+def save_thumbnail_image(image: Image.Image, thumbnail_location: str, target_height: int = TARGET_THUMBNAIL_HEIGHT):
+    # Ensure the save directory exists
+    os.makedirs(os.path.dirname(thumbnail_location), exist_ok=True)
+
+    thumbnail = resize_image(image=image, target_height=target_height)
+
+    # Save the image in .jpg format
+    thumbnail.save(thumbnail_location, "JPEG")
+
+# Scales down the image to the target height (keeps aspect ratio, never scales up) and converts it to RGB
+def resize_image(image: Image.Image, target_height: int) -> Image.Image:
+    # Get the current size of the image
+    width, height = image.size
+
+    # Calculate the new height and width while keeping the aspect ratio
+    if height > target_height:
+        aspect_ratio = width / height
+        target_width = max(1, int(target_height * aspect_ratio))
+
+        # JPEG only - decoder scales down by 1/2, 1/4 or 1/8 while decoding (never below the requested size), other formats ignore it
+        image.draft("RGB", (target_width, target_height))
+
+        # Palette images would be resized with NEAREST, convert them first so LANCZOS is used
+        if image.mode in ["1", "P"]:
+            image = image.convert("RGB")
+
+        # Reduce by integer factor first (cheap box reduce), then final high quality LANCZOS resample
+        resized = image.resize((target_width, target_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    else:
+        # If image is smaller than target height, keep the original
+        resized = image
+
+    # Convert the image to RGB (if it is not already in RGB mode)
+    return resized.convert("RGB")
+
+def get_upload_thumbnail_renditions_dir(upload_id: int) -> str:
+    return os.path.join(SAVE_DIR, "uploads", str(upload_id), "thumbnails")
 
-        # Convert the image to RGB (if it is not already in RGB mode)
-        thumbnail_resized = thumbnail_resized.convert("RGB")
+def get_file_preview_renditions_dir(upload_id: int, generated_filename: str) -> str:
+    return os.path.join(SAVE_DIR, "uploads", str(upload_id), "previews", generated_filename)
 
-        # Save the image in .jpg format
-        thumbnail_resized.save(thumbnail_location, "JPEG")
+# Saves the image in all configured rendition heights and formats as '{height}.{ext}' (heights above the image height are saved once in the original height)
+def save_renditions(image: Image.Image, directory: str, heights: list[int] = RENDITION_HEIGHTS, image_formats: list[str] = RENDITION_FORMATS):
+    os.makedirs(directory, exist_ok=True)
 
-        return True
+    rendition_heights = sorted({min(height, image.height) for height in heights}, reverse=True)
+    rendition = image
+
+    # Largest first, every smaller rendition is resampled from the previous one instead of the original
+    for height in rendition_heights:
+        rendition = resize_image(image=rendition, target_height=height)
+
+        for image_format in image_formats:
+            rendition.save(os.path.join(directory, f"{height}.{RENDITION_EXTENSIONS[image_format]}"), image_format.upper(), quality=RENDITION_QUALITY)
+
+# Path of the thumbnail to serve - best rendition for the requested size and format (original thumbnail.jpg if there are no renditions yet), None if there is none
+def get_upload_thumbnail_path(upload_id: int, size: int | None, image_format: str | None) -> str | None:
+    if size is not None or image_format is not None:
+        file_path = select_rendition(directory=get_upload_thumbnail_renditions_dir(upload_id=upload_id), size=size, image_format=image_format or "jpeg")
+
+        if file_path is not None:
+            return file_path
+
+    if image_format in [None, "jpeg"]:
+        file_path = os.path.join(SAVE_DIR, "uploads", str(upload_id), "thumbnail.jpg")
+
+        if os.path.exists(file_path):
+            return file_path
+
+    return None
+
+def get_upload_thumbnail_paths(upload_ids: list[int], size: int | None, image_format: str | None) -> dict[int, str]:
+    thumbnail_paths = {}
+
+    for upload_id in upload_ids:
+        thumbnail_path = get_upload_thumbnail_path(upload_id=upload_id, size=size, image_format=image_format)
+
+        if thumbnail_path is not None:
+            thumbnail_paths[upload_id] = thumbnail_path
+
+    return thumbnail_paths
+
+def get_sprite_path(sprite_key: str, image_format: str) -> str:
+    return os.path.join(SAVE_DIR, "sprites", f"{sprite_key}.{RENDITION_EXTENSIONS[image_format]}")
+
+# Places thumbnails (upload_id -> path) in rows of one height (shelf packing) and saves them as one image,
+# returns the offset map (upload_id -> x, y, width, height) which is saved next to the sprite as JSON
+def create_sprite_sheet(thumbnail_paths: dict[int, str], sprite_path: str, tile_height: int, image_format: str) -> dict:
+    tiles = []
+
+    for upload_id, thumbnail_path in thumbnail_paths.items():
+        with Image.open(thumbnail_path) as image:
+            tiles.append((upload_id, resize_image(image=image, target_height=tile_height)))
+
+    offsets = {}
+    x = 0
+    y = 0
+    row_height = 0
+
+    for upload_id, tile in tiles:
+        if x > 0 and x + tile.width > SPRITE_MAX_WIDTH: # Next row
+            x = 0
+            y += row_height
+            row_height = 0
+
+        offsets[str(upload_id)] = {"x": x, "y": y, "width": tile.width, "height": tile.height}
+        x += tile.width
+        row_height = max(row_height, tile.height)
+
+    sprite_width = max([offset["x"] + offset["width"] for offset in offsets.values()], default=1)
+    sprite_height = max(y + row_height, 1)
+    sprite = Image.new("RGB", (sprite_width, sprite_height))
+
+    for upload_id, tile in tiles:
+        sprite.paste(tile, (offsets[str(upload_id)]["x"], offsets[str(upload_id)]["y"]))
+
+    # Written under temporary names and renamed, so concurrent requests never see a partial sprite
+    os.makedirs(os.path.dirname(sprite_path), exist_ok=True)
+    temp_name = uuid.uuid4().hex
+    sprite_map_path = os.path.splitext(sprite_path)[0] + ".json"
+
+    sprite.save(f"{sprite_path}.{temp_name}.part", image_format.upper(), quality=RENDITION_QUALITY)
+    with open(f"{sprite_map_path}.{temp_name}.part", "w") as map_file:
+        json.dump(offsets, map_file)
+
+    os.replace(f"{sprite_map_path}.{temp_name}.part", sprite_map_path)
+    os.replace(f"{sprite_path}.{temp_name}.part", sprite_path)
+
+    return offsets
+
+# Offset map of an already generated sprite sheet, None if it was not generated yet
+# Modification time of the map is the last use of the sprite (the sprite itself is not touched, its ETag stays the same)
+def load_sprite_map(sprite_path: str) -> dict | None:
+    sprite_map_path = os.path.splitext(sprite_path)[0] + ".json"
+
+    try:
+        with open(sprite_map_path) as map_file:
+            offsets = json.load(map_file)
+
+        if not os.path.exists(sprite_path):
+            return None
+
+        os.utime(sprite_map_path)
+
+        return offsets
+    except FileNotFoundError: # Not generated yet or evicted in the meantime
+        return None
+
+# Removes sprite sheets not used for SPRITE_CACHE_MAX_AGE and the least recently used ones over SPRITE_CACHE_MAX_FILES (keep_path was just generated)
+def evict_sprite_sheets(keep_path: str | None = None):
+    sprites_dir = os.path.join(SAVE_DIR, "sprites")
+    sprite_maps = []
+
+    try:
+        with os.scandir(sprites_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json"):
+                    try:
+                        sprite_maps.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError: # Evicted by another request
+                        continue
+    except FileNotFoundError:
+        return
+
+    sprite_maps.sort(reverse=True) # Most recently used first
+    oldest_allowed = time.time() - SPRITE_CACHE_MAX_AGE
+    keep_name = os.path.splitext(keep_path)[0] if keep_path is not None else None
+
+    for position, (last_used, sprite_map_path) in enumerate(sprite_maps):
+        sprite_name = os.path.splitext(sprite_map_path)[0]
+
+        if sprite_name == keep_name or (position < SPRITE_CACHE_MAX_FILES and last_used >= oldest_allowed):
+            continue
+
+        # Map goes first, so the sprite is never served from a map that points to a removed image
+        for file_path in [sprite_map_path, *[f"{sprite_name}.{extension}" for extension in set(RENDITION_EXTENSIONS.values())]]:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+# Returns path of the best existing rendition - the smallest one at least as high as the requested size, otherwise the largest one
+def select_rendition(directory: str, size: int | None, image_format: str) -> str | None:
+    extension = f".{RENDITION_EXTENSIONS[image_format]}"
+    heights = []
+
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+
+                if ext == extension and name.isdigit():
+                    heights.append(int(name))
+    except FileNotFoundError:
+        return None
+
+    if not heights:
+        return None
+
+    if size is None:
+        height = max(heights)
     else:
-        return False
\ No newline at end of file
+        larger_heights = [height for height in heights if height >= size]
+        height = min(larger_heights) if larger_heights else max(heights)
+
+    return os.path.join(directory, f"{height}{extension}")
+
+# Runs in a worker process of the job queue - creates thumbnail renditions (from the generated thumbnail) and downscaled previews of image files
+# File is a dict with 'path', 'mime' and 'generated_filename', returns the number of created previews
+def generate_upload_renditions(upload_id: int, files: list[dict]) -> dict:
+    thumbnail_location = os.path.join(SAVE_DIR, "uploads", str(upload_id), "thumbnail.jpg")
+    previews = 0
+
+    if os.path.exists(thumbnail_location):
+        with Image.open(thumbnail_location) as img:
+            save_renditions(image=img, directory=get_upload_thumbnail_renditions_dir(upload_id=upload_id))
+
+    for file in files:
+        if file["mime"] not in PREVIEW_SUPPORTED_MIMES:
+            continue
+
+        try:
+            with Image.open(file["path"]) as img:
+                save_renditions(image=img, directory=get_file_preview_renditions_dir(upload_id=upload_id, generated_filename=file["generated_filename"]))
+                previews += 1
+        except Exception as e:
+            print(f"Preview generation from '{file['path']}' failed: {e}")
+
+    return {"previews": previews}
+
+# Returns files (for generate_upload_renditions) of already saved files that a preview can be generated from
+def get_rendition_files(files: list[Files]) -> list[dict]:
+    return [{"path": get_upload_file_path(upload_id=file.upload_id, generated_filename=file.generated_filename, file_ext=file.file_ext), "mime": file.file_mime, "generated_filename": file.generated_filename} for file in files if file.file_mime in PREVIEW_SUPPORTED_MIMES]
+
+# Returns a frame near 1/10th of the video and media info (duration, width, height) of the video
+# Uses ffmpeg to seek directly to the nearest keyframe (only that frame is decoded), moviepy is used when ffmpeg/ffprobe are not available
+def extract_video_thumbnail_frame(file_path: str, timeout: int = VIDEO_FRAME_TIMEOUT) -> tuple[Image.Image, dict]:
+    if shutil.which(FFMPEG_PATH) is None or shutil.which(FFPROBE_PATH) is None:
+        from moviepy import VideoFileClip # Imported only here, it is slow to import and not needed when ffmpeg is available
+
+        with VideoFileClip(file_path) as video:
+            frame = video.get_frame(video.duration / 10)
+            width, height = video.size
+
+            return Image.fromarray(frame), {"duration": video.duration, "width": width, "height": height}
+
+    media_info = probe_video(file_path=file_path, timeout=timeout)
+    time_for_thumbnail = media_info["duration"] / 10 if media_info["duration"] else 0
+
+    try:
+        frame = extract_video_keyframe(file_path=file_path, timestamp=time_for_thumbnail, timeout=timeout)
+    except (subprocess.SubprocessError, ValueError, OSError) as e:
+        print(f"Extracting keyframe at {time_for_thumbnail:.3f}s of '{file_path}' failed, using the first keyframe: {e}")
+        frame = extract_video_keyframe(file_path=file_path, timestamp=0, timeout=timeout)
+
+    return frame, media_info
+
+def probe_video(file_path: str, timeout: int = VIDEO_FRAME_TIMEOUT) -> dict:
+    command = [FFPROBE_PATH, "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height,duration:format=duration", "-of", "json", file_path]
+    result = subprocess.run(command, capture_output=True, timeout=timeout, check=True)
+    probe = json.loads(result.stdout)
+
+    if not probe.get("streams"):
+        raise ValueError("File does not contain a video stream!")
+
+    stream = probe["streams"][0]
+    duration = stream.get("duration") or probe.get("format", {}).get("duration") # Webm has duration only in the container (format)
+
+    return {"duration": float(duration) if duration else None, "width": int(stream["width"]), "height": int(stream["height"])}
+
+# Decodes only the keyframe at or before the timestamp (input seeking with -noaccurate_seek and non-keyframes skipped by the decoder)
+def extract_video_keyframe(file_path: str, timestamp: float, timeout: int = VIDEO_FRAME_TIMEOUT) -> Image.Image:
+    command = [FFMPEG_PATH, "-v", "error", "-skip_frame", "nokey", "-noaccurate_seek", "-ss", f"{timestamp:.3f}", "-i", file_path, "-map", "0:v:0", "-frames:v", "1", "-f", "image2pipe", "-vcodec", "ppm", "-"]
+    result = subprocess.run(command, capture_output=True, timeout=timeout, check=True)
+
+    if not result.stdout:
+        raise ValueError(f"No keyframe found at {timestamp:.3f}s!")
+
+    with Image.open(BytesIO(result.stdout)) as frame:
+        frame.load()
+        return frame.copy()
\ No newline at end of file
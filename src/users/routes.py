@@ -1,19 +1,22 @@
 # External imports
-from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, Body
-from sqlmodel import Session, select
+from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, Body, Request
+from sqlmodel import select
 from fastapi.responses import FileResponse
 import os
 from email_validator import validate_email, EmailNotValidError
 
 # Internal imports
 from users.models import Users, UserCreate, UserResponse, UserDeletionResponse
-from database import engine
+from database import async_session
 from auth.utils import hash_password
 from users.utils import check_password_structure, verify_authenticated_user
-from config import ANONYMOUS_USER, SAVE_DIR
+from config import ANONYMOUS_USER, SAVE_DIR, PROFILE_PICTURE_CACHE_CONTROL
 from users.types import UserStatuses
-from utils import current_timestamp
+from utils import current_timestamp, build_sqlmodel_get_all_query, get_pagination_headers
 from uploads.utils import create_profile_picture
+from files.utils import build_path_response
+from cache import CacheEntities, cached_response, invalidate_cache
+from counts import TotalCountModes, get_total_count_headers
 
 users_router = APIRouter()
 
@@ -30,9 +33,9 @@ async def new_user(new_user: UserCreate):
         except EmailNotValidError as e:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Email does not have valid format! Exception: {str(e)}")
 
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Users).where(Users.username == new_user.username)
-        results = session.exec(statement)
+        results = await session.exec(statement)
 
         if results.first() is not None:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="User with this username already exists!")
@@ -41,12 +44,14 @@ async def new_user(new_user: UserCreate):
         hashed_password = hash_password(new_user.password)
         new_user.password = hashed_password
 
-        with Session(engine) as session:
+        async with async_session() as session:
             db_user = Users.model_validate(new_user)
             session.add(db_user)
-            session.commit()
-            session.refresh(db_user)
+            await session.commit()
+            await session.refresh(db_user)
             new_user = db_user
+
+        await invalidate_cache(CacheEntities.USERS)
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid password! Must contain at least one uppercase letter, one lowercase letter, one digit, and one special symbol.")
 
@@ -54,12 +59,26 @@ async def new_user(new_user: UserCreate):
 
 # Get all users
 @users_router.get("/users", tags=["users"], response_model=list[UserResponse])
-async def get_all_users():
-    with Session(engine) as session:
-        statement = select(Users).where(Users.status != UserStatuses.DELETED.value)
-        results = session.exec(statement)
+async def get_all_users(request: Request, offset: int = 0, limit: int | None = 100, cursor: str | None = None, created_before: int | None = None, created_after: int | None = None, order_by: str | None = None, order_by_direction: str | None = "asc", count: TotalCountModes | None = None):
+    forbidden_order_by = ["password"]
+    total_count_headers = {}
+
+    async def build():
+        nonlocal total_count_headers
+
+        async with async_session() as session:
+            statement = build_sqlmodel_get_all_query(model=Users, offset=offset, limit=limit, cursor=cursor, created_before=created_before, created_after=created_after, order_by=order_by, forbidden_order_by=forbidden_order_by, order_by_direction=order_by_direction, additional_filters=[Users.status != UserStatuses.DELETED.value])
+            results = await session.exec(statement)
+            users = results.all()
+
+            # Deleted users have both status and deleted_at set, so the counters match the status filter
+            if count is not None:
+                statement = build_sqlmodel_get_all_query(model=Users, created_before=created_before, created_after=created_after, additional_filters=[Users.status != UserStatuses.DELETED.value])
+                total_count_headers = await get_total_count_headers(session=session, statement=statement, mode=count, model=Users, cacheable=created_before is None and created_after is None)
 
-        return results.all()
+            return users
+
+    return await cached_response(request=request, entities=[CacheEntities.USERS], response_model=list[UserResponse], build=build, build_headers=lambda users: {**get_pagination_headers(items=users, limit=limit, order_by=order_by, order_by_direction=order_by_direction), **total_count_headers})
 
 # Get a user logged in by the token !!! Must be before '/users/{user_id}' endpoint !!!
 @users_router.get("/users/me", tags=["users"], response_model=UserResponse)
@@ -80,9 +99,9 @@ async def delete_authenticated_user(user_to_delete: str = Body(embed=True), curr
     if current_user.username == ANONYMOUS_USER: # Login of anonymous user is not allowed in this endpoint
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No authentication token provided!")
 
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Users).where(Users.id == current_user.id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         user = results.first()
 
         if user is None:
@@ -94,8 +113,10 @@ async def delete_authenticated_user(user_to_delete: str = Body(embed=True), curr
         user.deleted_at = current_timestamp()
 
         session.add(user)
-        session.commit()
-        session.refresh(user)
+        await session.commit()
+        await session.refresh(user)
+
+    await invalidate_cache(CacheEntities.USERS)
 
     return UserDeletionResponse(
         message = f"User '{user.username}' with id {user.id} was successfully deleted.",
@@ -104,16 +125,13 @@ async def delete_authenticated_user(user_to_delete: str = Body(embed=True), curr
 
 # Get a profile picture of user logged in by the token
 @users_router.get("/users/me/profile_picture", tags=["users"], response_class=FileResponse)
-async def get_authenticated_user_profile_picture(current_user: UserResponse = Depends(verify_authenticated_user)):
+async def get_authenticated_user_profile_picture(request: Request, current_user: UserResponse = Depends(verify_authenticated_user)):
     if current_user.username == ANONYMOUS_USER: # Login of anonymous user is not allowed in this endpoint
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No authentication token provided!")
 
     file_path = os.path.join(SAVE_DIR, "users", str(current_user.id), "profile_picture.jpg")
 
-    if os.path.exists(file_path):
-        return file_path
-    else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile picture not found!")
+    return await build_path_response(request=request, file_path=file_path, cache_control=PROFILE_PICTURE_CACHE_CONTROL, media_type="image/jpeg", not_found_detail="Profile picture not found!")
 
 # Set a profile picture of user logged in by the token
 @users_router.post("/users/me/profile_picture", tags=["users"], response_model=bool)
@@ -132,9 +150,9 @@ async def set_authenticated_user_profile_picture(profile_picture: UploadFile | N
 # Get a user by ID
 @users_router.get("/users/{user_id}", tags=["users"], response_model=UserResponse)
 async def get_user(user_id: int):
-    with Session(engine) as session:
+    async with async_session() as session:
         statement = select(Users).where(Users.id == user_id)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         user = results.first()
 
         if user is None:
@@ -144,18 +162,17 @@ async def get_user(user_id: int):
 
 # Get a profile picture of user by ID
 @users_router.get("/users/{user_id}/profile_picture", tags=["users"], response_class=FileResponse)
-async def get_user_profile_picture(user_id: int):
-    with Session(engine) as session:
-        statement = select(Users).where(Users.id == user_id)
-        results = session.exec(statement)
-        user = results.first()
+async def get_user_profile_picture(request: Request, user_id: int):
+    file_path = os.path.join(SAVE_DIR, "users", str(user_id), "profile_picture.jpg")
 
-        if user is None:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found!")
-        
-        file_path = os.path.join(SAVE_DIR, "users", str(user_id), "profile_picture.jpg")
+    # Profile picture exists only for existing users, so the database is queried only when it is missing (for the correct error)
+    if not os.path.exists(file_path):
+        async with async_session() as session:
+            statement = select(Users).where(Users.id == user_id)
+            results = await session.exec(statement)
+            user = results.first()
+
+            if user is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found!")
 
-        if os.path.exists(file_path):
-            return file_path
-        else:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile picture not found!")
\ No newline at end of file
+    return await build_path_response(request=request, file_path=file_path, cache_control=PROFILE_PICTURE_CACHE_CONTROL, media_type="image/jpeg", not_found_detail="Profile picture not found!")
\ No newline at end of file
@@ -1,12 +1,12 @@
 # External imports
 import re
 from fastapi import Depends, HTTPException, status
-from sqlmodel import Session, select
+from sqlmodel import select
 
 # Internal imports
 from auth.utils import verify_token
 from users.models import Users, UserResponse
-from database import engine
+from database import async_session
 from users.types import UserRoles, UserStatuses
 from config import ANONYMOUS_USER
 
@@ -31,14 +31,14 @@ def check_password_structure(password) -> bool:
     # If all conditions are met
     return True
 
-def verify_authenticated_user(token_payload: dict | None = Depends(verify_token)) -> UserResponse:
-    with Session(engine) as session:
+async def verify_authenticated_user(token_payload: dict | None = Depends(verify_token)) -> UserResponse:
+    async with async_session() as session:
         if token_payload:
             statement = select(Users).where(Users.username == token_payload.get("sub"))
         else:
             statement = select(Users).where(Users.username == ANONYMOUS_USER, Users.role == UserRoles.SYSTEM.value)
             
-        results = session.exec(statement)
+        results = await session.exec(statement)
         user = results.first()
 
         if user is None:
@@ -1,7 +1,13 @@
 # External imports
 from datetime import datetime, timezone
-from typing import Type, TypeVar, Optional, Any
-from sqlmodel import SQLModel, select
+from typing import Type, TypeVar, Optional, Any, Callable
+from sqlmodel import SQLModel, select, asc, desc, or_, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+from decimal import Decimal
+import binascii
+import base64
+import json
 from fastapi import HTTPException, status
 
 def current_timestamp() -> float:
@@ -10,7 +16,93 @@ def current_timestamp() -> float:
 
 T = TypeVar("T", bound=SQLModel)
 
-def build_sqlmodel_get_all_query(model: Type[T], offset: int = 0, limit: int | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = "id", forbidden_order_by: list[str] = [], order_by_direction: str = "asc", additional_filters: list[Any] | None = None):
+# Ordering as it is stored in cursors (defaults filled in, so an omitted parameter matches its default)
+def get_cursor_order(order_by: str | None, order_by_direction: str | None) -> list[str]:
+    return [order_by or "id", (order_by_direction or "asc").lower()]
+
+# Opaque cursor of keyset pagination - ordering it belongs to, value of the order_by column and id of the last returned row
+def encode_cursor(value: Any, id: int, order_by: str | None = None, order_by_direction: str | None = None) -> str:
+    if isinstance(value, Decimal):
+        value = str(value)
+
+    return base64.urlsafe_b64encode(json.dumps([*get_cursor_order(order_by=order_by, order_by_direction=order_by_direction), value, id], separators=(",", ":")).encode()).decode().rstrip("=")
+
+# Cursor is valid only for the ordering it was created for, its value would be compared with a different column otherwise
+def decode_cursor(cursor: str, order_by: str | None = None, order_by_direction: str | None = None) -> tuple[Any, int]:
+    try:
+        cursor_order_by, cursor_order_by_direction, value, id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+
+        if not isinstance(id, int):
+            raise ValueError("Invalid id!")
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor!")
+
+    if [cursor_order_by, cursor_order_by_direction] != get_cursor_order(order_by=order_by, order_by_direction=order_by_direction):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Cursor is for order_by '{cursor_order_by}' and order_by_direction '{cursor_order_by_direction}'! Use the same ordering as the previous page.")
+
+    return value, id
+
+# Cursor values are JSON - checked against the type of the ordered column (numeric columns need Decimal back), expressions without a known type are used as they are
+def parse_cursor_value(column: Any, value: Any) -> Any:
+    try:
+        python_type = column.type.python_type
+    except (AttributeError, NotImplementedError):
+        return value
+
+    if value is None:
+        return None
+
+    if python_type is Decimal and isinstance(value, (int, float, str)) and not isinstance(value, bool):
+        try:
+            return Decimal(str(value)) # Through str so floats keep their JSON value (Decimal(0.1) is not 0.1)
+        except ArithmeticError:
+            pass
+    elif python_type is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    elif isinstance(value, python_type) and (python_type is bool or not isinstance(value, bool)):
+        return value
+
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor!")
+
+# Cursor of the next page, None if this is the last page
+def get_next_cursor(items: list, limit: int | None, order_by: str | None = None, order_by_direction: str | None = None, get_value: Callable[[Any], Any] | None = None) -> str | None:
+    if limit is None or not items or len(items) < limit:
+        return None
+
+    last_item = items[-1]
+    value = get_value(last_item) if get_value is not None else getattr(last_item, order_by or "id")
+
+    return encode_cursor(value=value, id=last_item["id"] if isinstance(last_item, dict) else last_item.id, order_by=order_by, order_by_direction=order_by_direction)
+
+def get_pagination_headers(items: list, limit: int | None, order_by: str | None = None, order_by_direction: str | None = None, get_value: Callable[[Any], Any] | None = None) -> dict:
+    next_cursor = get_next_cursor(items=items, limit=limit, order_by=order_by, order_by_direction=order_by_direction, get_value=get_value)
+
+    return {"X-Next-Cursor": next_cursor} if next_cursor is not None else {}
+
+# Rows after the cursor in the order (column, id) - NULLs are last in ascending and first in descending order (as in Postgres)
+# Every condition starts at the cursor value (column >= value), so an index of the column is scanned from there instead of from the first row
+def get_cursor_filter(column: Any, id_column: Any, value: Any, last_id: int, descending: bool) -> Any:
+    if getattr(column, "expression", column) is getattr(id_column, "expression", id_column):
+        return id_column < last_id if descending else id_column > last_id
+
+    nullable = getattr(getattr(column, "expression", column), "nullable", None) is not False # Unknown for expressions
+
+    if value is None:
+        if descending:
+            return or_(and_(column == None, id_column < last_id), column != None)
+
+        return and_(column == None, id_column > last_id)
+
+    if descending:
+        return and_(column <= value, or_(column < value, id_column < last_id))
+
+    after_value = and_(column >= value, or_(column > value, id_column > last_id))
+
+    return or_(after_value, column == None) if nullable else after_value
+
+# Pagination is either by offset or (faster for deep pages) by cursor from 'X-Next-Cursor' header of the previous page, order always ends with id so it is stable
+# With order_by_expression, order_by only names the ordering for the cursor
+def build_sqlmodel_get_all_query(model: Type[T], offset: int = 0, limit: int | None = None, created_before: int | None = None, created_after: int | None = None, created_by: int | None = None, order_by: str | None = "id", forbidden_order_by: list[str] = [], order_by_direction: str | None = "asc", additional_filters: list[Any] | None = None, cursor: str | None = None, order_by_expression: Any = None):
     if "deleted_at" not in forbidden_order_by:
         forbidden_order_by = list(forbidden_order_by) + ["deleted_at"]  # Avoid modifying original list
 
@@ -28,21 +120,38 @@ def build_sqlmodel_get_all_query(model: Type[T], offset: int = 0, limit: int | N
     if created_by is not None:
         statement = statement.where(model.created_by == created_by)
 
-    if order_by is not None:
+    column = model.id
+
+    if order_by_expression is not None: # Already validated by the caller (for example metadata field)
+        column = order_by_expression
+    elif order_by is not None:
+        if order_by in forbidden_order_by:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cannot order by this field!")
+
         try:
-            if order_by not in forbidden_order_by:
-                column = getattr(model, order_by)
-                if order_by_direction.lower() == "asc":
-                    statement = statement.order_by(asc(column))
-                elif order_by_direction.lower() == "desc":
-                    statement = statement.order_by(desc(column))
-                else:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid order_by_direction field! Valid options: asc, desc")
-            else:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cannot order by this field!")
+            column = getattr(model, order_by)
         except AttributeError:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid order_by field!")
 
+    order_by_direction = (order_by_direction or "asc").lower()
+
+    if order_by_direction not in ["asc", "desc"]:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid order_by_direction field! Valid options: asc, desc")
+
+    descending = order_by_direction == "desc"
+
+    if cursor is not None:
+        value, last_id = decode_cursor(cursor=cursor, order_by=order_by, order_by_direction=order_by_direction)
+        value = parse_cursor_value(column=column, value=value)
+
+        statement = statement.where(get_cursor_filter(column=column, id_column=model.id, value=value, last_id=last_id, descending=descending))
+
+    order = desc if descending else asc
+    statement = statement.order_by(order(column))
+
+    if column is not model.id:
+        statement = statement.order_by(order(model.id))
+
     if additional_filters is not None:
         for filter_condition in additional_filters:
             statement = statement.where(filter_condition)
@@ -50,6 +159,40 @@ def build_sqlmodel_get_all_query(model: Type[T], offset: int = 0, limit: int | N
     if limit is not None:
         statement = statement.limit(limit)
 
-    statement = statement.offset(offset)
+    if offset:
+        statement = statement.offset(offset)
+
+    return statement
+
+# Parses comma separated ids of a query parameter (example: '1,2,3'), duplicates are removed
+def parse_id_list(ids: str | None, name: str) -> list[int]:
+    if not ids:
+        return []
+
+    try:
+        return list(dict.fromkeys(int(id) for id in ids.split(",") if id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Query '{name}' must be comma separated ids!")
+
+# Validates all ids with one query, raises 404 listing every id that does not exist (or is deleted)
+async def check_ids_exist(session: AsyncSession, model: Type[T], ids: list[int], name: str):
+    if not ids:
+        return
+
+    statement = select(model.id).where(model.id.in_(ids), model.deleted_at == None)
+    results = await session.exec(statement)
+    existing_ids = set(results.all())
+    missing_ids = [id for id in dict.fromkeys(ids) if id not in existing_ids]
+
+    if missing_ids:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"{name} {', '.join(map(str, missing_ids))} not found!")
+
+# Inserts link rows in one statement, already existing links are skipped (ON CONFLICT DO NOTHING), returns only the inserted links
+async def insert_links(session: AsyncSession, model: Type[T], links: list[dict]) -> list[T]:
+    if not links:
+        return []
+
+    statement = insert(model).on_conflict_do_nothing().returning(model)
+    results = await session.scalars(statement, [model.model_validate(link).model_dump() for link in links])
 
-    return statement
\ No newline at end of file
+    return results.all()
@@ -0,0 +1,63 @@
+# External imports
+from sqlalchemy import event
+import tempfile
+import pytest
+import uuid
+import sys
+import os
+
+# Configuration is read when the modules are imported, so it is set up before the first import of them
+# Tests that need Postgres run against TEST_DATABASE_URL (its tables are created on startup) and are skipped without it
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL or "postgresql+psycopg2://localhost/scatter_test" # Engines connect lazily, modules can be imported without a database
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ["SAVE_DIR"] = tempfile.mkdtemp(prefix="scatter-save-")
+os.environ["TEMP_DIR"] = tempfile.mkdtemp(prefix="scatter-temp-")
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ["ENABLE_JOB_WORKERS"] = "false"
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+@pytest.fixture(scope="session")
+def client():
+    if TEST_DATABASE_URL is None:
+        pytest.skip("TEST_DATABASE_URL is not set")
+
+    from fastapi.testclient import TestClient
+    from app import app
+
+    with TestClient(app) as client: # Runs the startup (tables, indexes and defaults)
+        yield client
+
+# Run a coroutine function in the event loop of the app (database connections belong to it)
+@pytest.fixture(scope="session")
+def run(client):
+    return lambda function, *args: client.portal.call(function, *args)
+
+@pytest.fixture
+def auth_headers(client) -> dict:
+    username = f"user_{uuid.uuid4().hex[:12]}"
+    password = "Test-password-1"
+
+    response = client.post("/users", json={"username": username, "password": password})
+    assert response.status_code == 200, response.text
+
+    response = client.post("/token", data={"username": username, "password": password})
+    assert response.status_code == 200, response.text
+
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+# SQL statements sent to the database while the test runs (clear it right before the measured request)
+@pytest.fixture
+def executed_statements(client) -> list[str]:
+    from database import async_engine
+
+    statements = []
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
@@ -0,0 +1,102 @@
+# External imports
+from io import BytesIO
+import zipfile
+import zlib
+import tarfile
+import asyncio
+import random
+import pytest
+import os
+
+# Internal imports
+from archives.utils import get_zip_segments, get_tar_segments, get_segments_length, iter_archive_segments
+
+FILE_SIZES = [0, 1, 511, 512, 513, 100_000, 300_001]
+
+@pytest.fixture
+def entries(tmp_path) -> list[dict]:
+    entries = []
+
+    for index, size in enumerate(FILE_SIZES):
+        path = tmp_path / f"{index}.bin"
+        path.write_bytes(os.urandom(size))
+        entries.append({"name": f"folder/file {index} – ünïcode.bin", "path": str(path), "size": size, "mtime": 1_700_000_000 + index})
+
+    return entries
+
+def read_archive(segments: list[tuple], start: int, end: int, compute_crc: bool) -> bytes:
+    async def collect() -> bytes:
+        return b"".join([content async for content in iter_archive_segments(segments=segments, start=start, end=end, compute_crc=compute_crc)])
+
+    return asyncio.run(collect())
+
+def assert_ranges_match(segments: list[tuple], archive: bytes, compute_crc: bool):
+    randomizer = random.Random(0)
+
+    for _ in range(50):
+        start = randomizer.randrange(len(archive))
+        end = randomizer.randrange(start, len(archive))
+
+        assert read_archive(segments=segments, start=start, end=end, compute_crc=compute_crc) == archive[start:end + 1], f"Range {start}-{end}"
+
+def test_zip_archive_round_trip(entries):
+    segments = get_zip_segments(entries=entries)
+    archive = read_archive(segments=segments, start=0, end=get_segments_length(segments) - 1, compute_crc=True)
+
+    assert len(archive) == get_segments_length(segments)
+
+    with zipfile.ZipFile(BytesIO(archive)) as zip_file:
+        assert zip_file.testzip() is None # Checks CRCs of all files
+        assert zip_file.namelist() == [entry["name"] for entry in entries]
+
+        for entry in entries:
+            with open(entry["path"], "rb") as file:
+                assert zip_file.read(entry["name"]) == file.read()
+
+    assert_ranges_match(segments=segments, archive=archive, compute_crc=True)
+
+# With CRCs stored for the files, a range is served without reading the files before it
+def test_zip_stored_crcs_skip_files_before_range(entries):
+    for entry in entries:
+        with open(entry["path"], "rb") as file:
+            entry["crc"] = zlib.crc32(file.read())
+
+    segments = get_zip_segments(entries=entries)
+    archive = read_archive(segments=segments, start=0, end=get_segments_length(segments) - 1, compute_crc=True)
+
+    with zipfile.ZipFile(BytesIO(archive)) as zip_file:
+        assert zip_file.testzip() is None
+
+    # Every file but the last one is gone, only the stored CRCs are left for them
+    last_entry = entries[-1]
+    start = last_entry["offset"] + 1
+
+    for entry in entries[:-1]:
+        os.remove(entry["path"])
+
+    assert read_archive(segments=segments, start=start, end=len(archive) - 1, compute_crc=True) == archive[start:]
+
+def test_tar_archive_round_trip(entries):
+    segments = get_tar_segments(entries=entries)
+    archive = read_archive(segments=segments, start=0, end=get_segments_length(segments) - 1, compute_crc=False)
+
+    assert len(archive) == get_segments_length(segments)
+
+    with tarfile.open(fileobj=BytesIO(archive)) as tar_file:
+        assert tar_file.getnames() == [entry["name"] for entry in entries]
+
+        for entry in entries:
+            member = tar_file.getmember(entry["name"])
+            assert member.mtime == entry["mtime"]
+
+            with open(entry["path"], "rb") as file:
+                assert tar_file.extractfile(member).read() == file.read()
+
+    assert_ranges_match(segments=segments, archive=archive, compute_crc=False)
+
+def test_empty_zip_archive():
+    segments = get_zip_segments(entries=[])
+    archive = read_archive(segments=segments, start=0, end=get_segments_length(segments) - 1, compute_crc=True)
+
+    with zipfile.ZipFile(BytesIO(archive)) as zip_file:
+        assert zip_file.namelist() == []
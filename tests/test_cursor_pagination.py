@@ -0,0 +1,53 @@
+# External imports
+import base64
+import json
+import uuid
+
+# Cursors from 'X-Next-Cursor' walk the whole listing and are accepted only with the ordering they were created for
+
+def create_tags(client, auth_headers: dict, count: int) -> list[int]:
+    tag_ids = []
+
+    for _ in range(count):
+        response = client.post("/tags", json={"name": f"tag_{uuid.uuid4().hex}"}, headers=auth_headers)
+        assert response.status_code == 200, response.text
+        tag_ids.append(response.json()["id"])
+
+    return tag_ids
+
+def test_cursor_walks_listing(client, auth_headers):
+    tag_ids = create_tags(client=client, auth_headers=auth_headers, count=3)
+    params = {"limit": 1, "order_by": "created_at", "order_by_direction": "desc", "created_by": client.get("/users/me", headers=auth_headers).json()["id"]}
+    seen_ids = []
+
+    response = client.get("/tags", params=params)
+
+    while True:
+        assert response.status_code == 200, response.text
+        seen_ids += [tag["id"] for tag in response.json()]
+
+        if "x-next-cursor" not in response.headers:
+            break
+
+        response = client.get("/tags", params={**params, "cursor": response.headers["x-next-cursor"]})
+
+    assert seen_ids == list(reversed(tag_ids))
+
+def test_cursor_of_different_ordering_is_rejected(client, auth_headers):
+    create_tags(client=client, auth_headers=auth_headers, count=2)
+
+    response = client.get("/tags", params={"limit": 1, "order_by": "created_at", "order_by_direction": "desc"})
+    assert response.status_code == 200, response.text
+    cursor = response.headers["x-next-cursor"]
+
+    for params in [{"order_by": "created_at", "order_by_direction": "asc"}, {"order_by": "name", "order_by_direction": "desc"}, {}]:
+        response = client.get("/tags", params={"limit": 1, "cursor": cursor, **params})
+        assert response.status_code == 400, params
+
+def test_invalid_cursor_is_rejected(client):
+    # Damaged cursor, cursor without the ordering and cursor whose value does not fit the column
+    cursors = ["not-a-cursor", base64.urlsafe_b64encode(json.dumps([1, 1]).encode()).decode(), base64.urlsafe_b64encode(json.dumps(["created_at", "asc", "yesterday", 1]).encode()).decode()]
+
+    for cursor in cursors:
+        response = client.get("/tags", params={"limit": 1, "order_by": "created_at", "cursor": cursor})
+        assert response.status_code == 400, cursor
@@ -0,0 +1,91 @@
+# External imports
+from fastapi import HTTPException
+from starlette.requests import Request
+from email.utils import formatdate
+import asyncio
+import pytest
+import os
+
+# Internal imports
+import files.utils
+from files.types import FileServingModes
+from files.utils import build_file_response, make_etag
+from config import SAVE_DIR, FILE_SERVING_INTERNAL_PREFIX
+
+# With X-Accel-Redirect / X-Sendfile the API answers only with headers, the reverse proxy sends the file (ranges included) itself
+
+LAST_MODIFIED = 1_700_000_000
+ETAG = make_etag("offload")
+
+@pytest.fixture
+def file_path() -> str:
+    file_path = os.path.join(SAVE_DIR, "uploads", "1", "files", "0 ünïcode.bin")
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    with open(file_path, "wb") as file:
+        file.write(os.urandom(1000))
+
+    return file_path
+
+def get_response(monkeypatch, file_path: str, mode: FileServingModes, headers: dict | None = None):
+    monkeypatch.setattr(files.utils, "FILE_SERVING_MODE", mode.value)
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]})
+
+    return asyncio.run(build_file_response(request=request, file_path=file_path, file_size=1000, media_type="application/octet-stream", etag=ETAG, last_modified=LAST_MODIFIED, cache_control="public, max-age=60"))
+
+def assert_cache_headers(response):
+    assert response.headers["etag"] == ETAG
+    assert response.headers["last-modified"] == formatdate(LAST_MODIFIED, usegmt=True)
+    assert response.headers["cache-control"] == "public, max-age=60"
+    assert response.headers["accept-ranges"] == "bytes"
+
+def test_x_accel_redirect(file_path, monkeypatch):
+    response = get_response(file_path=file_path, mode=FileServingModes.X_ACCEL_REDIRECT, monkeypatch=monkeypatch)
+
+    assert response.status_code == 200
+    assert response.body == b""
+    assert response.headers["x-accel-redirect"] == FILE_SERVING_INTERNAL_PREFIX + "uploads/1/files/0%20%C3%BCn%C3%AFcode.bin"
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert "x-sendfile" not in response.headers
+    assert_cache_headers(response)
+
+def test_x_sendfile(file_path, monkeypatch):
+    response = get_response(file_path=file_path, mode=FileServingModes.X_SENDFILE, monkeypatch=monkeypatch)
+
+    assert response.status_code == 200
+    assert response.body == b""
+    assert response.headers["x-sendfile"] == os.path.abspath(file_path)
+    assert "x-accel-redirect" not in response.headers
+    assert_cache_headers(response)
+
+# Range is answered by the proxy from the redirected file, the API does not cut the body or set Content-Range
+@pytest.mark.parametrize("mode", [FileServingModes.X_ACCEL_REDIRECT, FileServingModes.X_SENDFILE])
+def test_range_is_left_to_proxy(file_path, monkeypatch, mode):
+    for range_header in ["bytes=0-99", "bytes=0-9,20-29", "bytes=5000-"]:
+        response = get_response(file_path=file_path, mode=mode, headers={"Range": range_header}, monkeypatch=monkeypatch)
+
+        assert response.status_code == 200, range_header
+        assert "content-range" not in response.headers
+        assert_cache_headers(response)
+
+# Conditional requests are still answered by the API, the file is not redirected to at all
+@pytest.mark.parametrize("mode", [FileServingModes.X_ACCEL_REDIRECT, FileServingModes.X_SENDFILE])
+def test_not_modified_is_not_offloaded(file_path, monkeypatch, mode):
+    for headers in [{"If-None-Match": ETAG}, {"If-None-Match": f"W/{ETAG}"}, {"If-Modified-Since": formatdate(LAST_MODIFIED, usegmt=True)}]:
+        response = get_response(file_path=file_path, mode=mode, headers=headers, monkeypatch=monkeypatch)
+
+        assert response.status_code == 304, headers
+        assert "x-accel-redirect" not in response.headers and "x-sendfile" not in response.headers
+        assert response.headers["etag"] == ETAG
+
+    response = get_response(file_path=file_path, mode=mode, headers={"If-None-Match": make_etag("other")}, monkeypatch=monkeypatch)
+    assert response.status_code == 200
+
+def test_file_outside_save_dir_is_not_offloaded(tmp_path, monkeypatch):
+    outside_path = tmp_path / "outside.bin"
+    outside_path.write_bytes(b"x")
+
+    with pytest.raises(HTTPException) as error:
+        get_response(file_path=str(outside_path), mode=FileServingModes.X_ACCEL_REDIRECT, monkeypatch=monkeypatch)
+
+    assert error.value.status_code == 500
@@ -0,0 +1,85 @@
+# External imports
+from starlette.requests import Request
+import asyncio
+import pytest
+import os
+
+# Internal imports
+from files.utils import build_file_response, make_etag, parse_range_header
+from config import MAX_RANGES
+
+# 'Range' requests of files served by the API - 206 for satisfiable ranges, 416 with 'Content-Range: bytes */<size>' when none is, invalid headers are ignored
+
+FILE_SIZE = 1000
+
+@pytest.mark.parametrize("range_header, ranges", [
+    ("bytes=0-99", [(0, 99)]),
+    ("bytes=900-", [(900, 999)]),
+    ("bytes=-50", [(950, 999)]),
+    ("bytes=-5000", [(0, 999)]),
+    ("bytes=990-5000", [(990, 999)]),
+    ("bytes=0-9, 20-29", [(0, 9), (20, 29)]),
+    ("bytes=-0,0-9", [(0, 9)]), # Unsatisfiable ranges of the set are left out
+    ("bytes=1000-,-10", [(990, 999)]),
+])
+def test_satisfiable_ranges(range_header, ranges):
+    assert parse_range_header(range_header=range_header, file_size=FILE_SIZE) == ranges
+
+@pytest.mark.parametrize("range_header, file_size", [
+    ("bytes=-0", FILE_SIZE),
+    ("bytes=-0,-0", FILE_SIZE),
+    ("bytes=1000-", FILE_SIZE),
+    ("bytes=1000-,-0", FILE_SIZE),
+    ("bytes=-10", 0),
+    ("bytes=0-", 0),
+    (f"bytes={','.join(['0-0'] * (MAX_RANGES + 1))}", FILE_SIZE),
+])
+def test_unsatisfiable_ranges(range_header, file_size):
+    assert parse_range_header(range_header=range_header, file_size=file_size) is None
+
+@pytest.mark.parametrize("range_header", ["items=0-9", "bytes=9-0", "bytes=--5", "bytes=-", "bytes=a-9", "bytes=0-+9", "bytes=-5,x"])
+def test_invalid_ranges(range_header):
+    with pytest.raises(ValueError):
+        parse_range_header(range_header=range_header, file_size=FILE_SIZE)
+
+def get_response(tmp_path, range_header: str, file_size: int = FILE_SIZE):
+    file_path = tmp_path / "file.bin"
+    file_path.write_bytes(os.urandom(file_size))
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": [(b"range", range_header.encode())]})
+
+    async def get():
+        response = await build_file_response(request=request, file_path=str(file_path), file_size=file_size, media_type="application/octet-stream", etag=make_etag("ranges"), last_modified=1_700_000_000, cache_control="no-cache")
+        body = b""
+
+        if hasattr(response, "body_iterator"):
+            async for chunk in response.body_iterator:
+                body += chunk
+        else:
+            body = response.body
+
+        return response, body, file_path.read_bytes()
+
+    return asyncio.run(get())
+
+@pytest.mark.parametrize("range_header, file_size", [("bytes=-0", FILE_SIZE), ("bytes=1000-,-0", FILE_SIZE), ("bytes=-10", 0)])
+def test_unsatisfiable_range_response(tmp_path, range_header, file_size):
+    response, body, _ = get_response(tmp_path=tmp_path, range_header=range_header, file_size=file_size)
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{file_size}"
+    assert body == b""
+
+def test_partly_satisfiable_range_response(tmp_path):
+    response, body, content = get_response(tmp_path=tmp_path, range_header="bytes=-0,10-19")
+
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 10-19/{FILE_SIZE}"
+    assert body == content[10:20]
+
+# Invalid header is ignored, the whole file is sent
+def test_invalid_range_response(tmp_path):
+    response, body, content = get_response(tmp_path=tmp_path, range_header="bytes=--5")
+
+    assert response.status_code == 200
+    assert "content-range" not in response.headers
+    assert body == content
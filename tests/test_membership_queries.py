@@ -0,0 +1,80 @@
+# External imports
+import uuid
+
+# Listings of collection and tag members are one query no matter how many members there are (no query per link)
+
+def create_upload(client, auth_headers: dict) -> int:
+    response = client.post("/uploads", data={"title": f"upload_{uuid.uuid4().hex}"}, headers=auth_headers)
+    assert response.status_code == 200, response.text
+
+    return response.json()["id"]
+
+def create_collection(client, auth_headers: dict) -> int:
+    response = client.post("/collections", json={"title": f"collection_{uuid.uuid4().hex}", "privacy": "public"}, headers=auth_headers)
+    assert response.status_code == 200, response.text
+
+    return response.json()["id"]
+
+def create_tag(client, auth_headers: dict) -> int:
+    response = client.post("/tags", json={"name": f"tag_{uuid.uuid4().hex}"}, headers=auth_headers)
+    assert response.status_code == 200, response.text
+
+    return response.json()["id"]
+
+# Number of statements of the request and its response
+def count_queries(client, executed_statements: list[str], url: str) -> tuple[int, list]:
+    executed_statements.clear()
+    response = client.get(url)
+    assert response.status_code == 200, response.text
+
+    return len(executed_statements), response.json()
+
+def test_collection_uploads_query_count(client, auth_headers, executed_statements):
+    query_counts = []
+
+    for members_count in [1, 10]:
+        collection_id = create_collection(client=client, auth_headers=auth_headers)
+        upload_ids = [create_upload(client=client, auth_headers=auth_headers) for _ in range(members_count)]
+
+        response = client.post(f"/collections/{collection_id}/uploads", json={"upload_ids": upload_ids}, headers=auth_headers)
+        assert response.status_code == 200, response.text
+
+        query_count, uploads = count_queries(client=client, executed_statements=executed_statements, url=f"/collections/{collection_id}/uploads")
+        assert sorted(upload["id"] for upload in uploads) == sorted(upload_ids)
+        query_counts.append(query_count)
+
+    assert query_counts[0] == query_counts[1] == 1
+
+def test_tag_uploads_query_count(client, auth_headers, executed_statements):
+    query_counts = []
+
+    for members_count in [1, 10]:
+        tag_id = create_tag(client=client, auth_headers=auth_headers)
+        upload_ids = [create_upload(client=client, auth_headers=auth_headers) for _ in range(members_count)]
+
+        for upload_id in upload_ids:
+            response = client.post(f"/uploads/{upload_id}/tags", json={"tag_ids": [tag_id]}, headers=auth_headers)
+            assert response.status_code == 200, response.text
+
+        query_count, uploads = count_queries(client=client, executed_statements=executed_statements, url=f"/tags/{tag_id}/uploads")
+        assert sorted(upload["id"] for upload in uploads) == sorted(upload_ids)
+        query_counts.append(query_count)
+
+    assert query_counts[0] == query_counts[1] == 1
+
+def test_tag_collections_query_count(client, auth_headers, executed_statements):
+    query_counts = []
+
+    for members_count in [1, 10]:
+        tag_id = create_tag(client=client, auth_headers=auth_headers)
+        collection_ids = [create_collection(client=client, auth_headers=auth_headers) for _ in range(members_count)]
+
+        for collection_id in collection_ids:
+            response = client.post(f"/collections/{collection_id}/tags", json={"tag_ids": [tag_id]}, headers=auth_headers)
+            assert response.status_code == 200, response.text
+
+        query_count, collections = count_queries(client=client, executed_statements=executed_statements, url=f"/tags/{tag_id}/collections")
+        assert sorted(collection["id"] for collection in collections) == sorted(collection_ids)
+        query_counts.append(query_count)
+
+    assert query_counts[0] == query_counts[1] == 1
@@ -0,0 +1,95 @@
+# External imports
+from sqlmodel import text
+from sqlalchemy import Numeric, String, literal, literal_column
+import pytest
+import json
+
+# Internal imports
+from counts import Explain
+from database import async_session, async_engine
+from uploads.models import Uploads
+from uploads.metadata_schemas import MetadataTypes, metadata_schemas, get_marked_metadata_fields, get_metadata_expression, is_numeric_metadata_field
+from uploads.utils import get_metadata_type_filter
+from utils import build_sqlmodel_get_all_query
+
+# Metadata filters and ordering of '/uploads' are planned with their indexes - sequential scans are disabled, so a plan without
+# the index means the statement does not match it (table of the test database is small, the planner would scan it otherwise)
+
+def get_index_names(plan: dict) -> set[str]:
+    index_names = {plan["Index Name"]} if "Index Name" in plan else set()
+
+    for child_plan in plan.get("Plans", []):
+        index_names |= get_index_names(child_plan)
+
+    return index_names
+
+def explain_index_names(run, statement) -> set[str]:
+    async def explain() -> dict:
+        async with async_session() as session:
+            await session.execute(text("SET LOCAL enable_seqscan = off"))
+            results = await session.execute(Explain(statement))
+            plan = results.scalar()
+
+            return json.loads(plan) if isinstance(plan, str) else plan
+
+    return get_index_names(run(explain)[0]["Plan"])
+
+# Plans of a prepared statement executed repeatedly with a generic plan (the plan asyncpg ends up with for statements it caches),
+# parameters are unknown to the planner then, so partial index predicates must match literals of the statement
+def explain_generic_index_names(run, statement, executions: int = 6) -> list[set[str]]:
+    compiled = statement.compile(dialect=async_engine.dialect, compile_kwargs={"render_postcompile": True})
+    parameters = ", ".join(str(literal(compiled.params[name]).compile(dialect=async_engine.dialect, compile_kwargs={"literal_binds": True})) for name in compiled.positiontup)
+
+    async def explain() -> list[set[str]]:
+        index_names = []
+
+        async with async_engine.connect() as connection:
+            await connection.exec_driver_sql("SET enable_seqscan = off")
+            await connection.exec_driver_sql("SET plan_cache_mode = force_generic_plan")
+            await connection.exec_driver_sql(f"PREPARE metadata_statement AS {compiled.string}")
+
+            try:
+                for _ in range(executions):
+                    results = await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) EXECUTE metadata_statement{f'({parameters})' if parameters else ''}")
+                    plan = results.scalar()
+                    index_names.append(get_index_names((json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]))
+            finally:
+                await connection.exec_driver_sql("DEALLOCATE metadata_statement")
+                await connection.exec_driver_sql("RESET ALL")
+
+        return index_names
+
+    return run(explain)
+
+# Same statement as 'GET /uploads?filter_by_metadata=<type>&order_by=metadata/<field>'
+def get_metadata_order_statements(metadata_type: MetadataTypes) -> list[tuple[str, object]]:
+    statements = []
+
+    for path, field_schema in get_marked_metadata_fields(schema=metadata_schemas[metadata_type], mark="x-sortable"):
+        expression = literal_column(get_metadata_expression(path=path, field_schema=field_schema), type_=Numeric if is_numeric_metadata_field(field_schema) else String)
+        statement = build_sqlmodel_get_all_query(model=Uploads, limit=20, order_by_expression=expression, order_by_direction="desc", additional_filters=[get_metadata_type_filter(metadata_type=metadata_type)])
+        statements.append((f"ix_uploads_metadata_{metadata_type.value}_{'_'.join(path)}", statement))
+
+    return statements
+
+def test_metadata_contains_uses_gin_index(run):
+    statement = build_sqlmodel_get_all_query(model=Uploads, additional_filters=[Uploads.metadata_json.contains({"subreddit": "pics"})])
+
+    assert "ix_uploads_metadata_json" in explain_index_names(run=run, statement=statement)
+
+# GIN index is used only for equality checks of the path ('==')
+def test_metadata_path_uses_gin_index(run):
+    statement = build_sqlmodel_get_all_query(model=Uploads, additional_filters=[Uploads.metadata_json.op("@@")(text("CAST(:metadata_path AS JSONPATH)").bindparams(metadata_path='$.subreddit == "pics"'))])
+
+    assert "ix_uploads_metadata_json" in explain_index_names(run=run, statement=statement)
+
+@pytest.mark.parametrize("metadata_type", [MetadataTypes.REDDIT, MetadataTypes.NHENTAI])
+def test_metadata_order_uses_expression_indexes(run, metadata_type):
+    for index_name, statement in get_metadata_order_statements(metadata_type=metadata_type):
+        assert index_name in explain_index_names(run=run, statement=statement), index_name
+
+@pytest.mark.parametrize("metadata_type", [MetadataTypes.REDDIT, MetadataTypes.NHENTAI])
+def test_metadata_order_uses_expression_indexes_in_generic_plan(run, metadata_type):
+    for index_name, statement in get_metadata_order_statements(metadata_type=metadata_type):
+        for execution, index_names in enumerate(explain_generic_index_names(run=run, statement=statement)):
+            assert index_name in index_names, f"{index_name}, execution {execution + 1}"
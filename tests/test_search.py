@@ -0,0 +1,96 @@
+# External imports
+from sqlmodel import text
+from sqlalchemy import Float, cast, func
+from sqlalchemy.dialects.postgresql import REGCONFIG
+import json
+import uuid
+
+# Internal imports
+from counts import Explain
+from database import async_session
+from uploads.models import Uploads
+from uploads.utils import build_search_query
+from utils import build_sqlmodel_get_all_query
+from config import SEARCH_TEXT_CONFIG
+
+# '/uploads/search' matches with the GIN index of 'search_vector', the last word is a prefix only when it is long enough
+
+ROWS = 20_000
+MATCHING_ROWS = 10
+
+def get_index_names(plan: dict) -> set[str]:
+    index_names = {plan["Index Name"]} if "Index Name" in plan else set()
+
+    for child_plan in plan.get("Plans", []):
+        index_names |= get_index_names(child_plan)
+
+    return index_names
+
+# Same statement as 'GET /uploads/search?q=<q>'
+def get_search_statement(q: str):
+    text_config = cast(SEARCH_TEXT_CONFIG, REGCONFIG)
+    ts_query = func.to_tsquery(text_config, build_search_query(q=q))
+    search_vector = Uploads.__table__.c.search_vector
+    rank = func.ts_rank_cd(search_vector, ts_query, type_=Float)
+
+    return build_sqlmodel_get_all_query(model=Uploads, limit=20, order_by="rank", order_by_expression=rank, order_by_direction="desc", additional_filters=[search_vector.op("@@")(ts_query)])
+
+def explain(run, statement, analyze: bool = False, settings: list[str] = []) -> dict:
+    async def explain() -> dict:
+        async with async_session() as session:
+            for setting in settings:
+                await session.execute(text(f"SET LOCAL {setting}"))
+
+            results = await session.execute(Explain(statement, analyze=analyze))
+            plan = results.scalar()
+
+            return json.loads(plan) if isinstance(plan, str) else plan
+
+    return run(explain)[0]
+
+def test_search_query_prefix_length():
+    assert build_search_query(q="Red c") == "red & c"
+    assert build_search_query(q="Red ca") == "red & ca"
+    assert build_search_query(q="Red car") == "red & car:*"
+    assert build_search_query(q="a:* | !b") == "a & b"
+    assert build_search_query(q=" _ ") is None
+
+# Sequential scans are disabled, so a plan without the index means the statement does not match it
+def test_search_uses_gin_index(run):
+    plan = explain(run=run, statement=get_search_statement(q="red car"), settings=["enable_seqscan = off"])
+
+    assert "ix_uploads_search_vector" in get_index_names(plan["Plan"])
+
+# Rare word among many uploads - the planner picks the index by itself and the search stays far from a scan of the whole table
+def test_search_is_fast_among_many_uploads(client, run, auth_headers):
+    user_id = client.get("/users/me", headers=auth_headers).json()["id"]
+    prefix = f"search{uuid.uuid4().hex}"
+    word = f"rare{uuid.uuid4().hex}"
+
+    async def create_uploads():
+        async with async_session() as session:
+            # Total count listeners are not set up here, so the counters are not changed by the rows of the test
+            await session.execute(text("INSERT INTO uploads (title, type, created_by, created_at, updated_at, thumbnail_status) SELECT :prefix || ' common words ' || n || CASE WHEN n % :every = 0 THEN ' ' || :word ELSE '' END, 'text/plain', :user_id, n, n, 'none' FROM generate_series(1, :rows) AS n"), {"prefix": prefix, "every": ROWS // MATCHING_ROWS, "word": word, "user_id": user_id, "rows": ROWS})
+            await session.execute(text("SELECT gin_clean_pending_list('ix_uploads_search_vector')")) # New entries are kept in a pending list until (auto)vacuum merges them
+            await session.execute(text("ANALYZE uploads"))
+            await session.commit()
+
+    async def remove_uploads():
+        async with async_session() as session:
+            await session.execute(text("DELETE FROM uploads WHERE created_by = :user_id"), {"user_id": user_id})
+            await session.commit()
+
+    run(create_uploads)
+
+    try:
+        response = client.get("/uploads/search", params={"q": word, "limit": 20})
+        assert response.status_code == 200, response.text
+        assert len(response.json()) == MATCHING_ROWS
+
+        plan = explain(run=run, statement=get_search_statement(q=word), analyze=True)
+        scan_plan = explain(run=run, statement=get_search_statement(q=word), analyze=True, settings=["enable_bitmapscan = off", "enable_indexscan = off"])
+
+        assert "ix_uploads_search_vector" in get_index_names(plan["Plan"])
+        assert plan["Execution Time"] * 5 < scan_plan["Execution Time"], (plan["Execution Time"], scan_plan["Execution Time"])
+    finally:
+        run(remove_uploads)
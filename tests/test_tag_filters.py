@@ -0,0 +1,84 @@
+# External imports
+import json
+import uuid
+
+# Internal imports
+import uploads.utils
+
+# 'tags_all', 'tags_any' and 'tags_none' of '/uploads' and the 'X-Tag-Facets' header (counts of the whole filtered set, at most TAG_FACET_LIMIT tags)
+
+def create_upload(client, auth_headers: dict) -> int:
+    response = client.post("/uploads", data={"title": f"upload_{uuid.uuid4().hex}"}, headers=auth_headers)
+    assert response.status_code == 200, response.text
+
+    return response.json()["id"]
+
+def create_tag(client, auth_headers: dict) -> int:
+    response = client.post("/tags", json={"name": f"tag_{uuid.uuid4().hex}"}, headers=auth_headers)
+    assert response.status_code == 200, response.text
+
+    return response.json()["id"]
+
+# Uploads of a new user - first has tags a and b, second a, third b and c
+def create_tagged_uploads(client, auth_headers: dict) -> tuple[int, list[int], list[int]]:
+    user_id = client.get("/users/me", headers=auth_headers).json()["id"]
+    upload_ids = [create_upload(client=client, auth_headers=auth_headers) for _ in range(3)]
+    tag_ids = [create_tag(client=client, auth_headers=auth_headers) for _ in range(3)]
+
+    for upload_id, upload_tag_ids in zip(upload_ids, [tag_ids[:2], tag_ids[:1], tag_ids[1:]]):
+        response = client.post(f"/uploads/{upload_id}/tags", json={"tag_ids": upload_tag_ids}, headers=auth_headers)
+        assert response.status_code == 200, response.text
+
+    return user_id, upload_ids, tag_ids
+
+def get_uploads(client, params: dict):
+    response = client.get("/uploads", params={key: ",".join(map(str, value)) if isinstance(value, list) else value for key, value in params.items()})
+    assert response.status_code == 200, response.text
+
+    return response
+
+def test_tag_filters(client, auth_headers):
+    user_id, upload_ids, (a, b, c) = create_tagged_uploads(client=client, auth_headers=auth_headers)
+
+    cases = [
+        ({"tags_all": [a, b]}, [upload_ids[0]]),
+        ({"tags_all": [a]}, upload_ids[:2]),
+        ({"tags_any": [a, c]}, upload_ids),
+        ({"tags_any": [c]}, [upload_ids[2]]),
+        ({"tags_none": [b]}, [upload_ids[1]]),
+        ({"tags_all": [b], "tags_none": [c]}, [upload_ids[0]]),
+        ({"tags_any": [a], "tags_none": [a]}, []),
+    ]
+
+    for params, expected_ids in cases:
+        response = get_uploads(client=client, params={"created_by": user_id, "order_by": "id", **params})
+        assert [upload["id"] for upload in response.json()] == expected_ids, params
+
+def test_invalid_tag_list_is_rejected(client):
+    for params in [{"tags_all": "1,x"}, {"tags_any": "1.5"}, {"tags_none": "-"}]:
+        response = client.get("/uploads", params=params)
+        assert response.status_code == 400, params
+
+# Counts are of the whole filtered set (not only the page), tags of 'tags_all' and 'tags_none' are left out
+def test_tag_facets(client, auth_headers):
+    user_id, upload_ids, (a, b, c) = create_tagged_uploads(client=client, auth_headers=auth_headers)
+
+    response = get_uploads(client=client, params={"created_by": user_id, "limit": 1, "facets": "true"})
+    assert json.loads(response.headers["x-tag-facets"]) == {str(a): 2, str(b): 2, str(c): 1}
+
+    response = get_uploads(client=client, params={"created_by": user_id, "tags_any": [b], "facets": "true"})
+    assert json.loads(response.headers["x-tag-facets"]) == {str(a): 1, str(b): 2, str(c): 1}
+
+    response = get_uploads(client=client, params={"created_by": user_id, "tags_all": [b], "tags_none": [c], "facets": "true"})
+    assert json.loads(response.headers["x-tag-facets"]) == {str(a): 1}
+
+    response = get_uploads(client=client, params={"created_by": user_id})
+    assert "x-tag-facets" not in response.headers
+
+def test_tag_facets_are_limited(client, auth_headers, monkeypatch):
+    user_id, upload_ids, (a, b, c) = create_tagged_uploads(client=client, auth_headers=auth_headers)
+    monkeypatch.setattr(uploads.utils, "TAG_FACET_LIMIT", 2)
+
+    # Most used first, ties by tag id
+    response = get_uploads(client=client, params={"created_by": user_id, "facets": "true"})
+    assert json.loads(response.headers["x-tag-facets"]) == {str(a): 2, str(b): 2}
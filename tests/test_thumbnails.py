@@ -0,0 +1,47 @@
+# External imports
+from PIL import Image
+import tracemalloc
+import pytest
+import os
+
+# Internal imports
+from uploads.utils import create_thumbnail
+
+MAX_PEAK_MEMORY = 4 * 1024 * 1024 # Python allocations while creating a thumbnail, the source file is never read into memory as a whole
+
+# Noise does not compress, so the JPEG is about as big as its pixel data
+def save_noise_image(path: str, side: int, image_format: str):
+    with Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)) as image:
+        image.save(path, image_format, quality=95)
+
+def get_thumbnail_peak_memory(file_mime: str, source: str, thumbnail_location: str) -> int:
+    tracemalloc.start()
+
+    try:
+        create_thumbnail(file_mime=file_mime, source=source, thumbnail_location=thumbnail_location)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+@pytest.mark.parametrize("side", [1000, 4000])
+def test_jpeg_thumbnail_peak_memory_is_bounded(tmp_path, side):
+    source = str(tmp_path / "source.jpg")
+    save_noise_image(path=source, side=side, image_format="JPEG")
+
+    peak = get_thumbnail_peak_memory(file_mime="image/jpeg", source=source, thumbnail_location=str(tmp_path / "thumbnail.jpg"))
+
+    assert peak < MAX_PEAK_MEMORY, f"Peak {peak} bytes for a {os.path.getsize(source)} bytes file"
+
+def test_thumbnail_peak_memory_does_not_grow_with_file_size(tmp_path):
+    peaks = []
+
+    for side in [1000, 4000]: # 16x more data
+        source = str(tmp_path / f"{side}.png")
+        save_noise_image(path=source, side=side, image_format="PNG")
+
+        peaks.append(get_thumbnail_peak_memory(file_mime="image/png", source=source, thumbnail_location=str(tmp_path / f"{side}_thumbnail.jpg")))
+
+    assert peaks[1] < MAX_PEAK_MEMORY
+    assert peaks[1] < 2 * peaks[0] + 1024 * 1024
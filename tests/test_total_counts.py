@@ -0,0 +1,102 @@
+# External imports
+from sqlmodel import select
+import asyncio
+import time
+import uuid
+
+# Internal imports
+from cache import CacheEntities, invalidate_cache
+from counts import TotalCounts
+from database import async_session
+from tags.models import Tags
+from utils import current_timestamp
+
+# 'count' query parameter of listings - 'X-Total-Count' and the mode it was computed with in 'X-Total-Count-Mode'
+
+HOLD_TIME = 0.5 # Seconds every concurrent transaction stays open after its insert
+CONCURRENT_INSERTS = 8
+
+def create_tags(client, auth_headers: dict, count: int) -> list[int]:
+    tag_ids = []
+
+    for _ in range(count):
+        response = client.post("/tags", json={"name": f"tag_{uuid.uuid4().hex}"}, headers=auth_headers)
+        assert response.status_code == 200, response.text
+        tag_ids.append(response.json()["id"])
+
+    return tag_ids
+
+def get_total_count(client, params: dict) -> tuple[int, str]:
+    response = client.get("/tags", params={"limit": 1, **params})
+    assert response.status_code == 200, response.text
+
+    return int(response.headers["x-total-count"]), response.headers["x-total-count-mode"]
+
+def test_total_count_modes(client, auth_headers):
+    user_id = client.get("/users/me", headers=auth_headers).json()["id"]
+    create_tags(client=client, auth_headers=auth_headers, count=3)
+
+    assert get_total_count(client=client, params={"created_by": user_id, "count": "exact"}) == (3, "exact")
+    assert get_total_count(client=client, params={"created_by": user_id, "count": "cached"}) == (3, "cached")
+
+    total_count, mode = get_total_count(client=client, params={"created_by": user_id, "count": "estimated"})
+    assert mode == "estimated" and total_count >= 0
+
+    # Counters exist only for the whole table and per creator, other filters fall back to the estimate
+    assert get_total_count(client=client, params={"created_by": user_id, "created_after": 0, "count": "cached"})[1] == "estimated"
+
+    exact_count, _ = get_total_count(client=client, params={"count": "exact"})
+    assert get_total_count(client=client, params={"count": "cached"}) == (exact_count, "cached")
+
+    response = client.get("/tags", params={"limit": 1, "created_by": user_id})
+    assert "x-total-count" not in response.headers and "x-total-count-mode" not in response.headers
+
+# Soft-delete and restore change the counters (ORM update events)
+def test_cached_count_follows_soft_delete(client, run, auth_headers):
+    user_id = client.get("/users/me", headers=auth_headers).json()["id"]
+    tag_id = create_tags(client=client, auth_headers=auth_headers, count=2)[0]
+
+    async def set_deleted(deleted: bool):
+        async with async_session() as session:
+            tag = await session.get(Tags, tag_id)
+            tag.deleted_at = current_timestamp() if deleted else None
+            await session.commit()
+
+        await invalidate_cache(CacheEntities.TAGS)
+
+    run(set_deleted, True)
+    assert get_total_count(client=client, params={"created_by": user_id, "count": "cached"}) == (1, "cached")
+    assert get_total_count(client=client, params={"created_by": user_id, "count": "exact"}) == (1, "exact")
+
+    run(set_deleted, False)
+    assert get_total_count(client=client, params={"created_by": user_id, "count": "cached"}) == (2, "cached")
+
+# Transactions inserting rows of the same creator at the same time do not wait for each other's counter rows
+def test_concurrent_inserts_do_not_wait_for_counters(client, run, auth_headers):
+    user_id = client.get("/users/me", headers=auth_headers).json()["id"]
+
+    async def insert_tag():
+        async with async_session() as session:
+            session.add(Tags(name=f"tag_{uuid.uuid4().hex}", created_by=user_id))
+            await session.flush() # Counters are updated by the insert event
+            await asyncio.sleep(HOLD_TIME)
+            await session.commit()
+
+    async def insert_tags() -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*[insert_tag() for _ in range(CONCURRENT_INSERTS)])
+        await invalidate_cache(CacheEntities.TAGS)
+
+        return time.perf_counter() - started
+
+    async def get_counter_rows() -> list[TotalCounts]:
+        async with async_session() as session:
+            results = await session.exec(select(TotalCounts).where(TotalCounts.entity == Tags.__tablename__, TotalCounts.created_by == user_id))
+
+            return results.all()
+
+    elapsed = run(insert_tags)
+
+    assert elapsed < CONCURRENT_INSERTS * HOLD_TIME / 2, elapsed
+    assert len(run(get_counter_rows)) > 1
+    assert get_total_count(client=client, params={"created_by": user_id, "count": "cached"}) == (CONCURRENT_INSERTS, "cached")